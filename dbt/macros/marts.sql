@@ -0,0 +1,27 @@
+-- Helpers for the incrementally maintained marts (models/marts)
+
+-- Newest value of a watermark column already in the mart being built, or -infinity on its first build
+{% macro mart_watermark(column) -%}
+    (SELECT COALESCE(MAX({{ column }}), '-infinity') FROM {{ this }})
+{%- endmacro %}
+
+-- Newest load of an Amazon report (stamped on the rows of a build as its amazon_loaded_utc watermark)
+{% macro amazon_loaded_utc(report_name) -%}
+    (SELECT MAX(loaded_at) FROM {{ source('ingestion_meta', 'load_manifest') }} WHERE source_name = 'amazon' AND report_name = '{{ report_name }}')
+{%- endmacro %}
+
+-- Amazon data years with a refresh file loaded (or superseded) since the mart's amazon_loaded_utc watermark.
+-- Refreshes are full-year snapshots, so each such year is recomputed in full.
+{% macro amazon_changed_years(report_name) -%}
+    SELECT DISTINCT CAST(LEFT(object_key, 4) AS INTEGER)
+    FROM {{ source('ingestion_meta', 'load_manifest') }}
+    WHERE source_name = 'amazon' AND report_name = '{{ report_name }}' AND loaded_at > {{ mart_watermark('amazon_loaded_utc') }}
+{%- endmacro %}
+
+-- Covering index for dashboard lookups, run as a post_hook: a btree on the lookup columns that also stores the columns dashboards
+-- read (INCLUDE), so their queries are answered by index-only scans without touching the table.
+{#- Run as a non-transactional post-hook: a full refresh keeps the previous table (and its index name) as a backup until the
+    transaction commits, which would otherwise make IF NOT EXISTS skip the new table. -#}
+{% macro covering_index(columns, include) -%}
+    CREATE INDEX IF NOT EXISTS "{{ this.identifier }}__covering" ON {{ this }} ({{ columns | join(', ') }}) INCLUDE ({{ include | join(', ') }})
+{%- endmacro %}
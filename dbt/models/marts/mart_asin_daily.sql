@@ -0,0 +1,32 @@
+-- Incremental: each build recomputes only the days of Amazon data years reloaded since the previous build and replaces those
+-- days' rows (delete+insert on activity_date). Run `dbt run --full-refresh -s mart_asin_daily` to rebuild from scratch.
+{{
+    config(
+        unique_key='activity_date',
+        indexes=[{'columns': ['activity_date', 'product_asin', 'device_type_group'], 'unique': True}, {'columns': ['mart_built_utc']}],
+        post_hook={"sql": "{{ covering_index(['product_asin', 'activity_date'],
+                                     ['device_type_group', 'items_shipped', 'items_returned', 'revenue_usd', 'commission_usd']) }}", "transaction": False}
+    )
+}}
+
+SELECT
+    ship_date AS activity_date,
+    product_asin,
+    device_type_group,
+    MAX(product_name) AS product_name,
+    COUNT(*) AS order_items,
+    SUM(items_shipped) AS items_shipped,
+    SUM(items_returned) AS items_returned,
+    SUM(revenue_usd) AS revenue_usd,
+    SUM(commission_usd) AS commission_usd,
+    {{ amazon_loaded_utc('Fee-Earnings') }} AS amazon_loaded_utc,
+    CURRENT_TIMESTAMP AS mart_built_utc
+FROM {{ ref('stg_amazon__commissions') }}
+{% if is_incremental() %}
+WHERE ship_date IN (
+    SELECT ship_date
+    FROM {{ ref('stg_amazon__commissions') }}
+    WHERE data_year IN ({{ amazon_changed_years('Fee-Earnings') }})
+)
+{% endif %}
+GROUP BY ship_date, product_asin, device_type_group
@@ -0,0 +1,40 @@
+-- Incremental: each build recomputes only the months containing days rebuilt in mart_asin_daily since the previous build and
+-- replaces those months' rows (delete+insert on activity_month). Run `dbt run --full-refresh -s mart_asin_monthly` to rebuild.
+{{
+    config(
+        unique_key='activity_month',
+        indexes=[{'columns': ['activity_month', 'product_asin', 'device_type_group'], 'unique': True}],
+        post_hook={"sql": "{{ covering_index(['product_asin', 'activity_month'],
+                                     ['device_type_group', 'items_shipped', 'items_returned', 'revenue_usd', 'commission_usd']) }}", "transaction": False}
+    )
+}}
+
+WITH
+{% if is_incremental() %}
+changed_months AS (
+    SELECT DISTINCT CAST(DATE_TRUNC('month', activity_date) AS DATE) AS activity_month
+    FROM {{ ref('mart_asin_daily') }}
+    WHERE mart_built_utc > {{ mart_watermark('daily_built_utc') }}
+),
+{% endif %}
+asin_days AS (
+    SELECT d.*
+    FROM {{ ref('mart_asin_daily') }} AS d
+    {% if is_incremental() %}
+    JOIN changed_months AS m
+        ON d.activity_date >= m.activity_month AND d.activity_date < m.activity_month + INTERVAL '1 month'
+    {% endif %}
+)
+SELECT
+    CAST(DATE_TRUNC('month', activity_date) AS DATE) AS activity_month,
+    product_asin,
+    device_type_group,
+    MAX(product_name) AS product_name,
+    SUM(order_items) AS order_items,
+    SUM(items_shipped) AS items_shipped,
+    SUM(items_returned) AS items_returned,
+    SUM(revenue_usd) AS revenue_usd,
+    SUM(commission_usd) AS commission_usd,
+    MAX(mart_built_utc) AS daily_built_utc
+FROM asin_days
+GROUP BY 1, product_asin, device_type_group
@@ -0,0 +1,79 @@
+-- Incremental: each build recomputes only the days touched since the previous build and replaces those days' rows
+-- (delete+insert on activity_date). Run `dbt run --full-refresh -s mart_video_daily` to rebuild from scratch.
+{{
+    config(
+        unique_key='activity_date',
+        indexes=[{'columns': ['activity_date', 'video_id'], 'unique': True}, {'columns': ['mart_built_utc']}],
+        post_hook={"sql": "{{ covering_index(['video_id', 'activity_date'],
+                                     ['views', 'engaged_views', 'minutes_watched', 'ad_revenue_usd', 'likes', 'shares', 'net_subscribers',
+                                      'attributed_items_shipped', 'attributed_revenue_usd', 'attributed_commission_usd']) }}", "transaction": False}
+    )
+}}
+
+WITH
+{% if is_incremental() %}
+-- Days whose YouTube rows were (re)loaded, days of Amazon data years reloaded, and every day with commissions if the video bridge changed
+changed_dates AS (
+    SELECT activity_date
+    FROM {{ ref('stg_yt_analytics__daily_video') }}
+    WHERE last_loaded_utc > {{ mart_watermark('yt_loaded_utc') }}
+    UNION
+    SELECT ship_date
+    FROM {{ ref('stg_amazon__commissions') }}
+    WHERE data_year IN ({{ amazon_changed_years('Fee-Earnings') }})
+    UNION
+    SELECT ship_date
+    FROM {{ ref('stg_amazon__commissions') }}
+    WHERE (SELECT MAX(last_loaded_utc) FROM {{ ref('stg_yt_analytics__videos_bridge') }}) > {{ mart_watermark('bridge_loaded_utc') }}
+),
+{% endif %}
+video_days AS (
+    SELECT *
+    FROM {{ ref('stg_yt_analytics__daily_video') }}
+    {% if is_incremental() %}
+    WHERE activity_date IN (SELECT activity_date FROM changed_dates)
+    {% endif %}
+),
+-- A product's commissions are split evenly between the videos featuring it
+video_products AS (
+    SELECT
+        video_id,
+        product_asin,
+        1.0 / COUNT(*) OVER (PARTITION BY product_asin) AS attribution_share
+    FROM {{ ref('stg_yt_analytics__videos_bridge') }}
+),
+attributed_days AS (
+    SELECT
+        c.ship_date AS activity_date,
+        vp.video_id,
+        SUM(c.items_shipped * vp.attribution_share) AS attributed_items_shipped,
+        SUM(c.revenue_usd * vp.attribution_share) AS attributed_revenue_usd,
+        SUM(c.commission_usd * vp.attribution_share) AS attributed_commission_usd
+    FROM {{ ref('stg_amazon__commissions') }} AS c
+    JOIN video_products AS vp USING (product_asin)
+    {% if is_incremental() %}
+    WHERE c.ship_date IN (SELECT activity_date FROM changed_dates)
+    {% endif %}
+    GROUP BY c.ship_date, vp.video_id
+)
+SELECT
+    COALESCE(v.activity_date, a.activity_date) AS activity_date,
+    COALESCE(v.video_id, a.video_id) AS video_id,
+    COALESCE(v.views, 0) AS views,
+    COALESCE(v.engaged_views, 0) AS engaged_views,
+    COALESCE(v.minutes_watched, 0) AS minutes_watched,
+    COALESCE(v.ad_revenue_usd, 0) AS ad_revenue_usd,
+    COALESCE(v.likes, 0) AS likes,
+    COALESCE(v.shares, 0) AS shares,
+    COALESCE(v.subscribers_gained, 0) - COALESCE(v.subscribers_lost, 0) AS net_subscribers,
+    CAST(COALESCE(a.attributed_items_shipped, 0) AS NUMERIC(12,2)) AS attributed_items_shipped,
+    CAST(COALESCE(a.attributed_revenue_usd, 0) AS NUMERIC(12,2)) AS attributed_revenue_usd,
+    CAST(COALESCE(a.attributed_commission_usd, 0) AS NUMERIC(12,2)) AS attributed_commission_usd,
+    v.last_refreshed_utc AS yt_refreshed_utc,
+    v.last_loaded_utc AS yt_loaded_utc,
+    {{ amazon_loaded_utc('Fee-Earnings') }} AS amazon_loaded_utc,
+    (SELECT MAX(last_loaded_utc) FROM {{ ref('stg_yt_analytics__videos_bridge') }}) AS bridge_loaded_utc,
+    CURRENT_TIMESTAMP AS mart_built_utc
+FROM video_days AS v
+FULL OUTER JOIN attributed_days AS a
+    ON a.activity_date = v.activity_date AND a.video_id = v.video_id
@@ -0,0 +1,28 @@
+-- Incremental: each build recomputes only the days whose YouTube rows were (re)loaded since the previous build and replaces those
+-- days' rows (delete+insert on activity_date). Run `dbt run --full-refresh -s mart_video_device_daily` to rebuild from scratch.
+{{
+    config(
+        unique_key='activity_date',
+        indexes=[{'columns': ['activity_date', 'video_id', 'device_type'], 'unique': True}, {'columns': ['mart_built_utc']}],
+        post_hook={"sql": "{{ covering_index(['video_id', 'activity_date', 'device_type'], ['views', 'engaged_views', 'minutes_watched']) }}", "transaction": False}
+    )
+}}
+
+SELECT
+    activity_date,
+    video_id,
+    device_type,
+    views,
+    engaged_views,
+    minutes_watched,
+    last_refreshed_utc AS yt_refreshed_utc,
+    last_loaded_utc AS yt_loaded_utc,
+    CURRENT_TIMESTAMP AS mart_built_utc
+FROM {{ ref('stg_yt_analytics__daily_video_devicetype') }}
+{% if is_incremental() %}
+WHERE activity_date IN (
+    SELECT activity_date
+    FROM {{ ref('stg_yt_analytics__daily_video_devicetype') }}
+    WHERE last_loaded_utc > {{ mart_watermark('yt_loaded_utc') }}
+)
+{% endif %}
@@ -0,0 +1,44 @@
+-- Incremental: each build recomputes only the months containing days rebuilt in mart_video_daily since the previous build and
+-- replaces those months' rows (delete+insert on activity_month). Run `dbt run --full-refresh -s mart_video_monthly` to rebuild.
+{{
+    config(
+        unique_key='activity_month',
+        indexes=[{'columns': ['activity_month', 'video_id'], 'unique': True}],
+        post_hook={"sql": "{{ covering_index(['video_id', 'activity_month'],
+                                     ['views', 'engaged_views', 'minutes_watched', 'ad_revenue_usd', 'likes', 'shares', 'net_subscribers',
+                                      'attributed_items_shipped', 'attributed_revenue_usd', 'attributed_commission_usd']) }}", "transaction": False}
+    )
+}}
+
+WITH
+{% if is_incremental() %}
+changed_months AS (
+    SELECT DISTINCT CAST(DATE_TRUNC('month', activity_date) AS DATE) AS activity_month
+    FROM {{ ref('mart_video_daily') }}
+    WHERE mart_built_utc > {{ mart_watermark('daily_built_utc') }}
+),
+{% endif %}
+video_days AS (
+    SELECT d.*
+    FROM {{ ref('mart_video_daily') }} AS d
+    {% if is_incremental() %}
+    JOIN changed_months AS m
+        ON d.activity_date >= m.activity_month AND d.activity_date < m.activity_month + INTERVAL '1 month'
+    {% endif %}
+)
+SELECT
+    CAST(DATE_TRUNC('month', activity_date) AS DATE) AS activity_month,
+    video_id,
+    SUM(views) AS views,
+    SUM(engaged_views) AS engaged_views,
+    SUM(minutes_watched) AS minutes_watched,
+    SUM(ad_revenue_usd) AS ad_revenue_usd,
+    SUM(likes) AS likes,
+    SUM(shares) AS shares,
+    SUM(net_subscribers) AS net_subscribers,
+    SUM(attributed_items_shipped) AS attributed_items_shipped,
+    SUM(attributed_revenue_usd) AS attributed_revenue_usd,
+    SUM(attributed_commission_usd) AS attributed_commission_usd,
+    MAX(mart_built_utc) AS daily_built_utc
+FROM video_days
+GROUP BY 1, video_id
@@ -0,0 +1,62 @@
+-- Refresh files are full-year snapshots. How each data year (the year leading the file name) was loaded is read from the load manifest:
+-- replace/delta leave the year holding exactly its newest refresh (unchanged rows keep the source_csv of the refresh that first loaded
+-- them), while append loads every refresh in full, of which only the newest is current.
+-- A newest refresh recorded as a duplicate (identical to a refresh already loaded) is resolved by checksum to the entry that loaded
+-- its rows. Superseded refreshes were never applied.
+WITH manifest AS (
+    SELECT *, CAST(LEFT(object_key, 4) AS INTEGER) AS data_year
+    FROM {{ source('ingestion_meta', 'load_manifest') }}
+    WHERE source_name = 'amazon' AND report_name = 'Fee-Earnings'
+),
+latest_entry AS (
+    SELECT DISTINCT ON (data_year) *
+    FROM manifest
+    WHERE load_mode <> 'superseded'
+    ORDER BY data_year, run_ts DESC, loaded_at DESC
+),
+latest_refresh AS (
+    SELECT DISTINCT ON (latest_entry.data_year)
+        latest_entry.data_year,
+        loaded.object_key AS latest_source_csv,
+        loaded.load_mode AS latest_load_mode
+    FROM latest_entry
+    JOIN manifest AS loaded
+        ON loaded.data_year = latest_entry.data_year
+        AND loaded.load_mode IN ('append', 'replace', 'delta')
+        AND (loaded.object_key = latest_entry.object_key
+             OR (latest_entry.load_mode = 'duplicate' AND loaded.checksum = latest_entry.checksum))
+    ORDER BY latest_entry.data_year, loaded.run_ts DESC, loaded.loaded_at DESC
+),
+add_year AS (
+    SELECT
+        *,
+        CAST(LEFT(source_csv, 4) AS INTEGER) AS data_year
+    FROM {{ source('amazon', 'commissions') }}
+),
+-- Years without a manifest entry keep every row
+current_rows AS (
+    SELECT add_year.*
+    FROM add_year
+    LEFT JOIN latest_refresh USING (data_year)
+    WHERE latest_refresh.latest_load_mode IS DISTINCT FROM 'append'
+       OR add_year.source_csv = latest_refresh.latest_source_csv
+)
+-- Perform type casting and column renaming (snake_case) on current rows
+SELECT
+    "Date Shipped" AS ship_date,
+    "ASIN" AS product_asin,
+    "Name" AS product_name,
+    "Category" AS category_name,
+    "Seller" AS seller,
+    "Tracking ID" AS associate_tracking_id,
+    "Device Type Group" AS device_type_group,
+    "Price($)" AS unit_price_usd,
+    COALESCE("Items Shipped", 0) AS items_shipped,
+    COALESCE("Returns", 0) AS items_returned,
+    COALESCE("Revenue($)", 0) AS revenue_usd,
+    COALESCE("Ad Fees($)", 0) AS commission_usd,
+    data_year,
+    refresh_date,
+    source_csv,
+    wh_loaded_at AS last_loaded_utc
+FROM current_rows
@@ -1,12 +1,37 @@
+-- Incremental: each build finds the (video_id, activity_date) keys with raw rows loaded into the warehouse since the previous build
+-- (wh_loaded_at, so runs landed out of order and rows restored from compacted data are picked up too), deduplicates all raw rows of
+-- those keys again and replaces their rows. Run `dbt run --full-refresh -s stg_yt_analytics__daily_video` to rebuild from scratch.
+{{
+    config(
+        materialized='incremental',
+        incremental_strategy='delete+insert',
+        on_schema_change='append_new_columns',
+        unique_key=['video_id', 'activity_date'],
+        indexes=[{'columns': ['video_id', 'activity_date'], 'unique': True}, {'columns': ['last_loaded_utc']}]
+    )
+}}
+
 -- Before performing casting operations, deduplicate to include only the most recently refreshed rows for each unique video x day
-WITH add_rn AS (
+WITH
+{% if is_incremental() %}
+changed_keys AS (
+    SELECT DISTINCT video_id, "day"
+    FROM {{ source('yt_analytics', 'daily_video') }}
+    WHERE wh_loaded_at > (SELECT COALESCE(MAX(last_loaded_utc), '-infinity') FROM {{ this }})
+),
+{% endif %}
+add_rn AS (
     SELECT
         *,
         ROW_NUMBER() OVER (
             PARTITION BY video_id, "day"
             ORDER BY s3_run_ts DESC
-        ) AS rn
+        ) AS rn,
+        MAX(wh_loaded_at) OVER (PARTITION BY video_id, "day") AS last_loaded_utc
     FROM {{ source('yt_analytics', 'daily_video') }}
+    {% if is_incremental() %}
+    WHERE (video_id, "day") IN (SELECT video_id, "day" FROM changed_keys)
+    {% endif %}
 ),
 deduped AS (
     SELECT *
@@ -18,13 +43,14 @@ SELECT
     CAST("day" AS DATE) AS activity_date,
     video_id,
     CAST(views AS INTEGER) AS views,
-    CAST(engagedViews AS INTEGER) AS engaged_views,
-    CAST(estimatedMinutesWatched AS INTEGER) AS minutes_watched,
-    CAST(estimatedRevenue AS NUMERIC(10,2)) AS ad_revenue_usd,
+    CAST("engagedViews" AS INTEGER) AS engaged_views,
+    CAST("estimatedMinutesWatched" AS INTEGER) AS minutes_watched,
+    CAST("estimatedRevenue" AS NUMERIC(10,2)) AS ad_revenue_usd,
     CAST(likes AS INTEGER) AS likes,
     CAST(dislikes AS INTEGER) AS dislikes,
     CAST(shares AS INTEGER) AS shares,
-    CAST(subscribersGained AS INTEGER) AS subscribers_gained,
-    CAST(subscribersLost AS INTEGER) AS subscribers_lost,
-    s3_run_ts AS last_refreshed_utc
+    CAST("subscribersGained" AS INTEGER) AS subscribers_gained,
+    CAST("subscribersLost" AS INTEGER) AS subscribers_lost,
+    s3_run_ts AS last_refreshed_utc,
+    last_loaded_utc
 FROM deduped
\ No newline at end of file
@@ -0,0 +1,7 @@
+-- Video to featured product pairs. Used by the marts to attribute Amazon commissions to videos.
+SELECT DISTINCT
+    youtube_id AS video_id,
+    asin AS product_asin,
+    wh_loaded_at AS last_loaded_utc
+FROM {{ source('yt_analytics', 'videos_bridge') }}
+WHERE asin IS NOT NULL AND asin <> ''
@@ -0,0 +1,94 @@
+"""
+Builds the YouTube Analytics API client and its OAuth credentials with as little work per launch as possible.
+- The API's discovery document is fetched from Google's discovery service once and cached on disk; clients are built from the
+  cached copy (build_from_document) until it is older than max_age
+- The access token obtained with the refresh token is cached on disk with its expiry, so runs within the token's lifetime start
+  without a refresh round trip. The cache holds only the short-lived access token, keyed to the refresh token it was issued for.
+- googleapiclient, google-auth and httplib2 are only imported when a client or credentials are actually built
+"""
+import datetime as dt
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+import ingestion_utils
+
+discovery = ingestion_utils.lazy_import('googleapiclient.discovery')
+oauth2_credentials = ingestion_utils.lazy_import('google.oauth2.credentials')
+google_auth_httplib2 = ingestion_utils.lazy_import('google_auth_httplib2')
+httplib2 = ingestion_utils.lazy_import('httplib2')
+
+
+def read_cache_file(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+# Write via a temporary file and rename, so processes reading the cache concurrently (e.g. backfill workers) never see a partial file.
+# Readable by the owner only, since the token cache holds a bearer token.
+def write_cache_file(path, obj):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    with open(tmp_path, 'w', opener=lambda p, flags: os.open(p, flags, 0o600)) as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+# Fetch an API's discovery document from the discovery service, as googleapiclient's build() does with dynamic discovery
+def fetch_discovery_document(api_name, api_version):
+    http = httplib2.Http(timeout=30)
+    for uri in (discovery.V2_DISCOVERY_URI, discovery.DISCOVERY_URI):
+        response, content = http.request(uri.format(api=api_name, apiVersion=api_version))
+        if response.status < 400:
+            return json.loads(content)
+    raise discovery.UnknownApiNameOrVersion(f'name: {api_name}  version: {api_version}')
+
+
+# Discovery document of an API version: the cached copy if it was fetched less than max_age seconds ago, otherwise a fresh one
+# (which is cached). If the discovery service cannot be reached, a stale cached copy is used rather than failing the run.
+def get_discovery_document(api_name, api_version, cache_dir, max_age):
+    cache_path = Path(cache_dir) / f'{api_name}_{api_version}.json'
+    cached = read_cache_file(cache_path)
+    if cached is not None and time.time() - cached['fetched_at'] < max_age:
+        return cached['document']
+
+    try:
+        document = fetch_discovery_document(api_name, api_version)
+    except Exception as e:
+        if cached is None:
+            raise
+        print(f'WARNING: Could not refresh the {api_name} {api_version} discovery document. Using the cached copy. \nError: {e}')
+        return cached['document']
+    write_cache_file(cache_path, {'fetched_at': time.time(), 'document': document})
+    return document
+
+
+# API client object built from the cached discovery document (no request when the cache is fresh)
+def build_client(api_name, api_version, credentials, cache_dir, max_age):
+    return discovery.build_from_document(get_discovery_document(api_name, api_version, cache_dir, max_age), credentials=credentials)
+
+
+# OAuth credentials from the authorized user file, using the access token cached by an earlier run while it is still valid.
+# Otherwise the token is refreshed once here (rather than by the first request of every worker thread) and cached for later runs.
+def load_credentials(creds_path, scopes, token_cache_path):
+    credentials = oauth2_credentials.Credentials.from_authorized_user_file(creds_path, scopes=scopes)
+    refresh_token_hash = hashlib.sha256((credentials.refresh_token or '').encode('utf8')).hexdigest()
+
+    cached = read_cache_file(token_cache_path)
+    if cached is not None and cached['refresh_token_sha256'] == refresh_token_hash and cached['scopes'] == sorted(scopes):
+        credentials.token = cached['token']
+        # google-auth compares expiry as a naive UTC datetime
+        credentials.expiry = dt.datetime.fromisoformat(cached['expiry'])
+
+    if not credentials.valid:
+        credentials.refresh(google_auth_httplib2.Request(httplib2.Http()))
+        write_cache_file(token_cache_path, {'refresh_token_sha256': refresh_token_hash,
+                                            'scopes': sorted(scopes),
+                                            'token': credentials.token,
+                                            'expiry': credentials.expiry.isoformat()})
+    return credentials
@@ -0,0 +1,362 @@
+"""
+Backfill YouTube Analytics history (e.g. after a schema change, or for a report newly added to s3_schema.json) in resumable shards.
+- Split the (video, date range) space into shards of videos_per_shard videos x days_per_shard days; the plan is saved in S3
+- Request shards in parallel worker processes, each taking an equal share of the API request quota
+- Land each shard's reports as parquet under backfill/ and checkpoint it as soon as it finishes, so an interrupted backfill
+  resumes from its last checkpoint (--backfill-id) instead of starting over
+- Once every shard is checkpointed, merge them into one standard raw/.../run_ts=.../data.parquet snapshot per report
+  (generate_s3_key layout, loaded by ingest_youtube.py as usual), advance the watermarks and delete the shards
+- Record the run in ingestion_meta (see ingestion_utils.RunMetrics)
+- main() can also be called by run_pipeline.py, which passes in its shared s3 schema, S3 client and run metrics
+"""
+
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from io import BytesIO
+import argparse
+import itertools
+import time
+import datetime as dt
+from dotenv import load_dotenv
+import ingestion_utils
+import api_client
+import land_youtube_s3
+
+pq = ingestion_utils.lazy_import('pyarrow.parquet')
+boto3 = ingestion_utils.lazy_import('boto3')
+
+
+# Report functions (land_youtube_s3.py) for every report that can be backfilled
+REPORT_FUNCS = {report_name: func for func, report_name in land_youtube_s3.REPORT_NAMES.items()}
+
+# API client, credentials and rate limiter of this worker process (set by init_worker)
+_worker = {}
+
+
+# Split the video IDs and [start_date, end_date] into shards of videos_per_shard videos x days_per_shard days, oldest dates first
+def plan_shards(video_ids, start_date, end_date, videos_per_shard, days_per_shard):
+    start_date, end_date = dt.date.fromisoformat(start_date), dt.date.fromisoformat(end_date)
+    date_ranges = []
+    while start_date <= end_date:
+        range_end = min(end_date, start_date + dt.timedelta(days=days_per_shard - 1))
+        date_ranges.append((start_date.isoformat(), range_end.isoformat()))
+        start_date = range_end + dt.timedelta(days=1)
+
+    video_chunks = [video_ids[i:i + videos_per_shard] for i in range(0, len(video_ids), videos_per_shard)]
+    return [{'shard': shard_id, 'start_date': start, 'end_date': end, 'video_ids': chunk}
+            for shard_id, ((start, end), chunk) in enumerate(itertools.product(date_ranges, video_chunks))]
+
+
+# Column names and types of a report, as stored in the plan to detect s3_schema.json changes between a backfill's runs
+def report_columns(report_obj):
+    return [[col, report_obj['col_types'][col]] for col in report_obj['cols']]
+
+
+def shard_data_name(report_name, shard_id):
+    return f'report={report_name}/shard={shard_id:05d}/data.parquet'
+
+
+def shard_checkpoint_name(shard_id):
+    return f'checkpoints/shard={shard_id:05d}.json'
+
+
+# IDs of the shards with a checkpoint, i.e. whose data has fully landed
+def completed_shards(s3, bucket, checkpoint_prefix):
+    return {ingestion_utils.read_s3_json(s3, bucket, obj['s3_key'])['shard']
+            for obj in ingestion_utils.iter_s3_objects(s3, bucket, checkpoint_prefix)}
+
+
+# Set up one worker process: its own API client and S3 client (neither can be shared across processes) and its share of the quota.
+# The access token and discovery document come from the caches warmed by the parent process (see api_client.py).
+def init_worker(client_settings, requests_per_second, max_requests_per_second, retry_settings):
+    creds = api_client.load_credentials(client_settings['creds_path'], land_youtube_s3.OAUTH_SCOPES, client_settings['token_cache_path'])
+    _worker['creds'] = creds
+    _worker['client'] = api_client.build_client(client_settings['api_name'], client_settings['api_version'], creds,
+                                                client_settings['discovery_cache_dir'], client_settings['discovery_max_age'])
+    _worker['limiter'] = ingestion_utils.AdaptiveTokenBucket(requests_per_second, max_rate=max_requests_per_second)
+    _worker['retry_settings'] = retry_settings
+    _worker['s3'] = boto3.client('s3')
+
+
+# Request one shard's reports and land them under the backfill prefix, then write its checkpoint. Runs in a worker process.
+# The checkpoint is written last, so a shard interrupted mid-way is simply requested again when the backfill resumes.
+def run_shard(shard, bucket, key_prefix, report_objs, writer_settings, threads, batch_size):
+    started_at = time.perf_counter()
+    s3 = _worker['s3']
+    api_stats = ingestion_utils.CallStats()
+    land_youtube_s3.configure_api(_worker['client'], _worker['creds'], limiter=_worker['limiter'], stats=api_stats,
+                                  **_worker['retry_settings'])
+
+    sinks, writers = {}, {}
+    for report_obj in report_objs:
+        report_name = report_obj['report_name']
+        sinks[report_name] = ingestion_utils.S3MultipartWriter(s3, bucket, key_prefix + shard_data_name(report_name, shard['shard']),
+                                                               part_size=writer_settings['part_size'])
+        writers[report_name] = land_youtube_s3.ReportParquetWriter(sinks[report_name],
+                                                                   land_youtube_s3.build_arrow_schema(report_obj),
+                                                                   row_group_size=writer_settings['row_group_size'],
+                                                                   compression=writer_settings['compression'],
+                                                                   use_dictionary=writer_settings['use_dictionary'])
+
+    report_funcs = [REPORT_FUNCS[report_obj['report_name']] for report_obj in report_objs]
+    try:
+        for video_id, video_results in land_youtube_s3.iter_report_responses(shard['video_ids'], report_funcs,
+                                                                             start_date=shard['start_date'],
+                                                                             end_date=shard['end_date'],
+                                                                             max_workers=threads,
+                                                                             batch_size=batch_size):
+            for report_obj, result in zip(report_objs, video_results):
+                writers[report_obj['report_name']].append_response(result, video_id)
+
+        # Shard files are landed even when empty, so the merge step finds one file per report for every shard
+        for report_name in writers:
+            writers[report_name].close()
+            sinks[report_name].close()
+    except Exception:
+        for sink in sinks.values():
+            sink.abort()
+        raise
+
+    api_summary = api_stats.summary()
+    checkpoint = {'shard': shard['shard'],
+                  'completed_at': dt.datetime.now(dt.timezone.utc).isoformat(),
+                  'seconds': time.perf_counter() - started_at,
+                  'rows': {report_name: writer.rows_written for report_name, writer in writers.items()},
+                  'bytes': {report_name: sink.bytes_written for report_name, sink in sinks.items()},
+                  'api_calls': sum(s['calls'] for s in api_summary.values()),
+                  'retries': sum(s['retries'] for s in api_summary.values())}
+    ingestion_utils.write_s3_json(s3, bucket, key_prefix + shard_checkpoint_name(shard['shard']), checkpoint, indent=4)
+    return checkpoint
+
+
+# Stream every shard file of a report, in plan order, into one parquet snapshot at merged_key. Memory is bounded by one shard file.
+# Returns the rows and bytes written; nothing is landed if the report has no rows.
+def merge_report_shards(s3, bucket, key_prefix, report_obj, shard_ids, merged_key, writer_settings, upload_executor=None):
+    sink = ingestion_utils.S3MultipartWriter(s3, bucket, merged_key, part_size=writer_settings['part_size'], executor=upload_executor)
+    writer = pq.ParquetWriter(sink, land_youtube_s3.build_arrow_schema(report_obj), compression=writer_settings['compression'],
+                              use_dictionary=writer_settings['use_dictionary'])
+    rows = 0
+    try:
+        for shard_id in shard_ids:
+            body = s3.get_object(Bucket=bucket, Key=key_prefix + shard_data_name(report_obj['report_name'], shard_id))['Body'].read()
+            for batch in pq.ParquetFile(BytesIO(body)).iter_batches(batch_size=writer_settings['row_group_size']):
+                writer.write_batch(batch, row_group_size=writer_settings['row_group_size'])
+                rows += batch.num_rows
+        writer.close()
+        if rows:
+            sink.close()
+        else:
+            sink.abort()
+    except Exception:
+        sink.abort()
+        raise
+    return rows, sink.bytes_written
+
+
+# Delete the shard data and checkpoints of a merged backfill (the plan and merge record are kept)
+def delete_shards(s3, bucket, key_prefix):
+    keys = [obj['s3_key'] for obj in ingestion_utils.iter_s3_objects(s3, bucket, key_prefix)
+            if obj['s3_key'].startswith(key_prefix + 'report=') or obj['s3_key'].startswith(key_prefix + 'checkpoints/')]
+    for i in range(0, len(keys), 1000):
+        s3.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': key} for key in keys[i:i + 1000]], 'Quiet': True})
+    return len(keys)
+
+
+# Plan (or resume) a backfill, request its pending shards and merge them. Standalone runs parse argv and create their own S3 client
+# and run metrics; run_pipeline.py can pass in the s3 schema, S3 client and run metrics it shares between stages.
+# Returns {report_name: merged S3 key, or None} ({} with --no-merge).
+def main(argv=None, schema=None, s3=None, metrics=None):
+
+    # Constants
+    ROOT = Path(__file__).parent.parent
+    CREDS_PATH = ROOT / 'auth' / 'authorized_user.json'
+    TOKEN_CACHE_PATH = ROOT / '.cache' / 'yt_token.json'
+    DISCOVERY_CACHE_DIR = ROOT / '.cache' / 'discovery'
+    DISCOVERY_MAX_AGE = 7 * 24 * 3600
+    NUM_RETRIES = 5
+    SLEEP_TIME = 2
+    MAX_SLEEP_TIME = 120
+    WORKERS = 4
+    THREADS_PER_WORKER = 4
+    REQUESTS_PER_SECOND = 5
+    MAX_REQUESTS_PER_SECOND = 20
+    BATCH_SIZE = 50
+    VIDEOS_PER_SHARD = 200
+    DAYS_PER_SHARD = 180
+    YT_START_DATE = '2023-08-23'
+    LOOKBACK_DAYS = 30
+    API_NAME = 'youtubeanalytics'
+    API_VERSION = 'v2'
+    BUCKET = 'affiliate-youtube-project'
+    ROW_GROUP_SIZE = 100_000
+    PARQUET_COMPRESSION = 'snappy'
+    PARQUET_USE_DICTIONARY = ['day', 'deviceType', 'video_id']
+    S3_PART_SIZE = 8 * 1024 ** 2
+    UPLOAD_WORKERS = 4
+    PLAN_NAME = 'plan.json'
+    MERGED_NAME = 'merged.json'
+    load_dotenv(ROOT / '.env')
+
+    # Load current s3 schema which defines the columns (and types) of each report
+    if schema is None:
+        schema = ingestion_utils.load_s3_schema()
+    source_obj = next(s for s in schema['sources'] if s['source_name'] == f'{API_NAME}_{API_VERSION}')
+
+    default_end_date = (dt.date.today() - dt.timedelta(days=LOOKBACK_DAYS)).isoformat()
+    parser = argparse.ArgumentParser(description='Backfill YouTube Analytics history into S3 in resumable, parallel shards.')
+    parser.add_argument('--backfill-id',
+                        help='Resume this backfill from its last checkpoint (its plan, dates and reports are reused). '
+                             'Without it, a new backfill is planned.')
+    parser.add_argument('--reports', nargs='+', choices=list(REPORT_FUNCS), default=list(REPORT_FUNCS),
+                        help='Reports to backfill (default: all).')
+    parser.add_argument('--start-date', default=YT_START_DATE, help='First day to request (YYYY-MM-DD).')
+    parser.add_argument('--end-date', default=default_end_date,
+                        help=f'Last day to request (YYYY-MM-DD). Defaults to {LOOKBACK_DAYS} days ago: '
+                             'later days are still revised and are covered by incremental runs of land_youtube_s3.py.')
+    parser.add_argument('--videos-per-shard', type=int, default=VIDEOS_PER_SHARD)
+    parser.add_argument('--days-per-shard', type=int, default=DAYS_PER_SHARD)
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='Worker processes. The request quota is divided evenly between them.')
+    parser.add_argument('--no-merge', action='store_true',
+                        help='Stop once every shard is checkpointed; merge later with --backfill-id.')
+    parser.add_argument('--keep-shards', action='store_true', help='Do not delete shard files after merging.')
+    ingestion_utils.add_instrumentation_args(parser)
+    args = parser.parse_args(argv)
+
+    # Run metrics are recorded in the warehouse when the script exits
+    conn_str = ingestion_utils.get_conn_str()
+    if metrics is None:
+        metrics = ingestion_utils.start_run_metrics('backfill_youtube', args, conn_str, profile_dir=ROOT / '.cache' / 'profiles')
+
+    s3 = s3 or boto3.client('s3')
+    report_objs = {r['report_name']: r for r in source_obj['reports']}
+
+    # Load the plan of the backfill being resumed, or plan a new one
+    if args.backfill_id:
+        backfill_id = args.backfill_id
+        plan = ingestion_utils.read_s3_json(s3, BUCKET, ingestion_utils.generate_s3_backfill_key(API_NAME, API_VERSION, backfill_id, PLAN_NAME))
+        if plan is None:
+            raise ValueError(f'No backfill plan found for backfill ID {backfill_id}.')
+        changed = [r for r in plan['reports'] if report_columns(report_objs[r]) != plan['columns'][r]]
+        if changed:
+            raise ValueError(f's3_schema.json has changed for {changed} since backfill {backfill_id} was planned. Start a new backfill.')
+        print(f'INFO: Resuming backfill {backfill_id}: {len(plan["shards"])} shards, {plan["start_date"]} to {plan["end_date"]}, '
+              f'reports {plan["reports"]}')
+    else:
+        backfill_id = dt.datetime.now(dt.timezone.utc).strftime("%Y%m%d%H%M%S")
+        with metrics.span('plan'):
+            video_ids = land_youtube_s3.read_video_ids(ROOT / 'raw_data' / 'YT_Videos_Bridge.csv')
+            plan = {'backfill_id': backfill_id,
+                    'start_date': args.start_date,
+                    'end_date': args.end_date,
+                    'reports': args.reports,
+                    'columns': {r: report_columns(report_objs[r]) for r in args.reports},
+                    'shards': plan_shards(video_ids, args.start_date, args.end_date, args.videos_per_shard, args.days_per_shard)}
+            ingestion_utils.write_s3_json(s3, BUCKET, ingestion_utils.generate_s3_backfill_key(API_NAME, API_VERSION, backfill_id, PLAN_NAME),
+                                          plan, indent=4)
+        print(f'INFO: Planned backfill {backfill_id}: {len(plan["shards"])} shards of up to {args.videos_per_shard} videos x '
+              f'{args.days_per_shard} days, {args.start_date} to {args.end_date}, reports {args.reports}')
+
+    key_prefix = ingestion_utils.generate_s3_backfill_key(API_NAME, API_VERSION, backfill_id, '')
+    merged_key = key_prefix + MERGED_NAME
+    merged = ingestion_utils.read_s3_json(s3, BUCKET, merged_key, default={'reports': {}})
+    if all(report_name in merged['reports'] for report_name in plan['reports']):
+        print(f'INFO: Backfill {backfill_id} has already been merged: {merged["reports"]}')
+        return merged['reports']
+
+    # Request the shards without a checkpoint. Each worker gets 1/workers of the quota, so together they stay within it.
+    done = completed_shards(s3, BUCKET, key_prefix + 'checkpoints/')
+    pending = [shard for shard in plan['shards'] if shard['shard'] not in done]
+    print(f'INFO: {len(done)} shard(s) already checkpointed, {len(pending)} to request.')
+
+    report_list = [report_objs[r] for r in plan['reports']]
+    writer_settings = {'part_size': S3_PART_SIZE, 'row_group_size': ROW_GROUP_SIZE,
+                       'compression': PARQUET_COMPRESSION, 'use_dictionary': PARQUET_USE_DICTIONARY}
+    retry_settings = {'num_retries': NUM_RETRIES, 'sleep_time': SLEEP_TIME, 'max_sleep_time': MAX_SLEEP_TIME}
+    failed = []
+    if pending:
+        # Refresh the access token and discovery document once here, so every worker starts from the caches
+        client_settings = {'creds_path': CREDS_PATH, 'token_cache_path': TOKEN_CACHE_PATH, 'api_name': API_NAME, 'api_version': API_VERSION,
+                           'discovery_cache_dir': DISCOVERY_CACHE_DIR, 'discovery_max_age': DISCOVERY_MAX_AGE}
+        api_client.load_credentials(CREDS_PATH, land_youtube_s3.OAUTH_SCOPES, TOKEN_CACHE_PATH)
+        api_client.get_discovery_document(API_NAME, API_VERSION, DISCOVERY_CACHE_DIR, DISCOVERY_MAX_AGE)
+
+        workers = min(args.workers, len(pending))
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=init_worker,
+                                 initargs=(client_settings, REQUESTS_PER_SECOND / workers, MAX_REQUESTS_PER_SECOND / workers,
+                                           retry_settings)) as executor:
+            shard_futures = {executor.submit(run_shard, shard, BUCKET, key_prefix, report_list, writer_settings,
+                                             THREADS_PER_WORKER, BATCH_SIZE): shard for shard in pending}
+            for future in as_completed(shard_futures):
+                shard = shard_futures[future]
+                try:
+                    checkpoint = future.result()
+                except Exception as e:
+                    failed.append(shard['shard'])
+                    metrics.record('shard', status='failed', errors=1)
+                    print(f'ERROR: Shard {shard["shard"]} ({shard["start_date"]} to {shard["end_date"]}, '
+                          f'{len(shard["video_ids"])} videos) failed. \nError: {e}')
+                    continue
+                done.add(shard['shard'])
+                metrics.record('shard', seconds=checkpoint['seconds'], rows=sum(checkpoint['rows'].values()),
+                               bytes=sum(checkpoint['bytes'].values()), api_calls=checkpoint['api_calls'],
+                               retries=checkpoint['retries'])
+                print(f'INFO: Checkpointed shard {shard["shard"]} ({len(done)}/{len(plan["shards"])}): {checkpoint["rows"]} rows')
+
+    if failed:
+        raise RuntimeError(f'{len(failed)} shard(s) failed: {sorted(failed)}. '
+                           f'Resume from the last checkpoint with --backfill-id {backfill_id}.')
+    if args.no_merge:
+        print(f'INFO: All shards checkpointed. Merge with --backfill-id {backfill_id}.')
+        return {}
+
+    # Merge each report's shards into one standard snapshot. The snapshot is stamped with the merge time, not the backfill's start:
+    # raw keys must sort after every run already landed, since loads and compaction only list keys after the newest one they have seen.
+    merge_ts = dt.datetime.now(dt.timezone.utc)
+    shard_ids = [shard['shard'] for shard in plan['shards']]
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as upload_executor:
+        for report_name in plan['reports']:
+            if report_name in merged['reports']:
+                continue
+            key = ingestion_utils.generate_s3_key(schema='raw',
+                                                  run_timestamp=merge_ts,
+                                                  source=API_NAME,
+                                                  api_version=API_VERSION,
+                                                  report=report_name,
+                                                  format='.parquet')
+            with metrics.span('merge', report_name) as span:
+                rows, bytes_written = merge_report_shards(s3, BUCKET, key_prefix, report_objs[report_name], shard_ids, key,
+                                                          writer_settings, upload_executor=upload_executor)
+                span.add(rows=rows, bytes=bytes_written)
+            # Record each merged report straight away, so a rerun after a failure does not land it twice
+            merged['reports'][report_name] = key if rows else None
+            ingestion_utils.write_s3_json(s3, BUCKET, merged_key, merged, indent=4)
+            if rows:
+                print(f'INFO: Merged {rows} rows ({bytes_written} bytes) for {report_name} into s3://{BUCKET}/{key}')
+            else:
+                print(f'INFO: No rows for {report_name}. Nothing landed.')
+
+    # Incremental runs only need to re-request the revisable tail of the backfilled range
+    watermark_key = ingestion_utils.generate_s3_state_key(source=API_NAME, api_version=API_VERSION, name='watermarks.json')
+    with metrics.span('write_state'):
+        watermarks = land_youtube_s3.read_watermarks(s3, BUCKET, watermark_key)
+        for report_name in plan['reports']:
+            report_watermarks = watermarks.setdefault(report_name, {})
+            for shard in plan['shards']:
+                for video_id in shard['video_ids']:
+                    report_watermarks[video_id] = max(report_watermarks.get(video_id, plan['end_date']), plan['end_date'])
+        land_youtube_s3.write_watermarks(s3, BUCKET, watermark_key, watermarks)
+    print(f'INFO: Updated watermarks in s3://{BUCKET}/{watermark_key}')
+
+    if not args.keep_shards:
+        with metrics.span('cleanup') as span:
+            deleted = delete_shards(s3, BUCKET, key_prefix)
+            span.add(objects=deleted)
+        print(f'INFO: Deleted {deleted} shard objects under s3://{BUCKET}/{key_prefix}')
+
+    return merged['reports']
+
+
+if __name__ == '__main__':
+    main()
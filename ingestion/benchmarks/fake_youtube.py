@@ -0,0 +1,77 @@
+"""
+Offline stand-in for the YouTube Analytics API client built by googleapiclient.discovery.build('youtubeanalytics', 'v2').
+- Supports the call chain used by land_youtube_s3.py: reports().query(...).execute(http=...)
+- Responses are generated by synthetic.report_response (multi-video filters and the video dimension included) and paged by startIndex/maxResults
+- Configurable per-request latency (with jitter) and throttling: a share of requests fail with HTTP 429 rateLimitExceeded,
+  as a real HttpError, so the retry, backoff and adaptive rate limiting paths are exercised too
+"""
+import json
+import random
+import threading
+import time
+import httplib2
+from googleapiclient.errors import HttpError
+import synthetic
+
+
+class FakeYouTubeAnalytics:
+    def __init__(self, published_at=None, latency_s=0.0, jitter_s=0.0, throttle_rate=0.0, retry_after_s=None, seed=0):
+        self.published_at = published_at or {}
+        self.latency_s = latency_s
+        self.jitter_s = jitter_s
+        self.throttle_rate = throttle_rate
+        self.retry_after_s = retry_after_s
+        self.seed = seed
+        self.requests = 0
+        self.throttled = 0
+        self._rnd = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def reports(self):
+        return _Reports(self)
+
+    def _execute(self, params):
+        with self._lock:
+            self.requests += 1
+            delay = self.latency_s + self._rnd.uniform(0, self.jitter_s)
+            throttle = self._rnd.random() < self.throttle_rate
+            if throttle:
+                self.throttled += 1
+        time.sleep(delay)
+        if throttle:
+            raise _throttled_error(self.retry_after_s)
+
+        video_ids = params['filters'].removeprefix('video==').split(',')
+        result = synthetic.report_response(video_ids, params['metrics'], params['dimensions'], params['startDate'], params['endDate'],
+                                           published_at=self.published_at, seed=self.seed)
+        start = params.get('startIndex', 1) - 1
+        if 'maxResults' in params:
+            result['rows'] = result['rows'][start:start + params['maxResults']]
+        return result
+
+
+class _Reports:
+    def __init__(self, client):
+        self._client = client
+
+    def query(self, **params):
+        return _Request(self._client, params)
+
+
+class _Request:
+    def __init__(self, client, params):
+        self._client = client
+        self._params = params
+
+    def execute(self, http=None, num_retries=0):
+        return self._client._execute(self._params)
+
+
+# HttpError shaped like the API's response to exceeding the per-user request rate
+def _throttled_error(retry_after_s=None):
+    headers = {'status': '429', 'content-type': 'application/json'}
+    if retry_after_s is not None:
+        headers['retry-after'] = str(retry_after_s)
+    content = json.dumps({'error': {'code': 429, 'message': 'Rate limit exceeded.',
+                                    'errors': [{'reason': 'rateLimitExceeded', 'message': 'Rate limit exceeded.'}]}})
+    return HttpError(httplib2.Response(headers), content.encode('utf8'))
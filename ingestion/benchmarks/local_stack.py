@@ -0,0 +1,169 @@
+"""
+Local stand-ins for the pipeline's external services, so the benchmarks run without AWS or the project database.
+- LocalS3: thread-safe, in-memory S3 client implementing the boto3 calls the pipeline makes (put/get/list/download,
+  multipart uploads, batch deletes), with optional per-request latency to approximate network round trips
+- LocalPostgres: a scratch database on the Postgres server configured in .env (e.g. a local docker container), created if needed
+  and reset with init_db.py before each stage. It never touches the database named in .env.
+"""
+import io
+import os
+import threading
+import time
+import uuid
+import hashlib
+from contextlib import contextmanager
+import psycopg
+from psycopg import sql
+import init_db
+
+
+class LocalS3:
+    # Error classes looked up by callers as s3.exceptions.<Name>, as on a boto3 client
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+        class NoSuchUpload(Exception):
+            pass
+
+    def __init__(self, latency_s=0.0):
+        self.latency_s = latency_s
+        self.requests = 0
+        self._objects = {}
+        self._uploads = {}
+        self._lock = threading.Lock()
+
+    def _request(self):
+        with self._lock:
+            self.requests += 1
+        if self.latency_s:
+            time.sleep(self.latency_s)
+
+    def _get(self, bucket, key):
+        try:
+            return self._objects[(bucket, key)]
+        except KeyError:
+            raise self.exceptions.NoSuchKey(f'The specified key does not exist: {key}') from None
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        self._request()
+        body = Body.read() if hasattr(Body, 'read') else bytes(Body)
+        with self._lock:
+            self._objects[(Bucket, Key)] = body
+        return {'ETag': f'"{hashlib.md5(body).hexdigest()}"'}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self._request()
+        with self._lock:
+            body = self._get(Bucket, Key)
+        return {'Body': io.BytesIO(body), 'ContentLength': len(body)}
+
+    def download_fileobj(self, Bucket, Key, Fileobj, **kwargs):
+        self._request()
+        with self._lock:
+            body = self._get(Bucket, Key)
+        Fileobj.write(body)
+
+    def list_objects_v2(self, Bucket, Prefix='', StartAfter=None, ContinuationToken=None, MaxKeys=1000, **kwargs):
+        self._request()
+        with self._lock:
+            keys = sorted(key for bucket, key in self._objects if bucket == Bucket and key.startswith(Prefix))
+            bodies = {key: self._objects[(Bucket, key)] for key in keys}
+        after = ContinuationToken or StartAfter
+        if after:
+            keys = [key for key in keys if key > after]
+        page = keys[:MaxKeys]
+        response = {'KeyCount': len(page), 'IsTruncated': len(keys) > MaxKeys}
+        if page:
+            response['Contents'] = [{'Key': key, 'Size': len(bodies[key]), 'ETag': f'"{hashlib.md5(bodies[key]).hexdigest()}"'} for key in page]
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = page[-1]
+        return response
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self._request()
+        with self._lock:
+            for obj in Delete['Objects']:
+                self._objects.pop((Bucket, obj['Key']), None)
+        return {'Deleted': [{'Key': obj['Key']} for obj in Delete['Objects']]}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._request()
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self._uploads[upload_id] = {}
+        return {'Bucket': Bucket, 'Key': Key, 'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self._request()
+        body = bytes(Body)
+        with self._lock:
+            if UploadId not in self._uploads:
+                raise self.exceptions.NoSuchUpload(UploadId)
+            self._uploads[UploadId][PartNumber] = body
+        return {'ETag': f'"{hashlib.md5(body).hexdigest()}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self._request()
+        with self._lock:
+            parts = self._uploads.pop(UploadId)
+            self._objects[(Bucket, Key)] = b''.join(parts[p['PartNumber']] for p in MultipartUpload['Parts'])
+        return {'Bucket': Bucket, 'Key': Key}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self._request()
+        with self._lock:
+            self._uploads.pop(UploadId, None)
+        return {}
+
+    # Total bytes stored under a prefix (not an S3 API call)
+    def stored_bytes(self, Bucket, Prefix=''):
+        with self._lock:
+            return sum(len(body) for (bucket, key), body in self._objects.items() if bucket == Bucket and key.startswith(Prefix))
+
+    def clear(self):
+        with self._lock:
+            self._objects.clear()
+            self._uploads.clear()
+
+
+class LocalPostgres:
+    def __init__(self, dbname='affiliate_bench'):
+        self.dbname = dbname
+        self.host, self.port = os.environ.get("PGHOST"), os.environ.get("PGPORT")
+        self.user, self.password = os.environ.get("PGUSER"), os.environ.get("PGPASSWORD")
+        if dbname == os.environ.get("PGDATABASE"):
+            raise ValueError(f'Refusing to benchmark against {dbname}: it is the project database in .env. Choose a scratch database.')
+
+    @property
+    def conn_str(self):
+        return f"host={self.host} port={self.port} dbname={self.dbname} user={self.user} password={self.password}"
+
+    # Create the scratch database if it does not exist yet (connects to the server's maintenance database)
+    def create(self):
+        maintenance = f"host={self.host} port={self.port} dbname=postgres user={self.user} password={self.password}"
+        with psycopg.connect(maintenance, autocommit=True) as conn:
+            if conn.execute("SELECT 1 FROM pg_database WHERE datname = %s", (self.dbname,)).fetchone() is None:
+                conn.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(self.dbname)))
+
+    # Point code that builds its connection from PG* environment variables (init_db, ingest_amazon) at the scratch database
+    @contextmanager
+    def activate(self):
+        previous = os.environ.get("PGDATABASE")
+        os.environ["PGDATABASE"] = self.dbname
+        try:
+            yield self
+        finally:
+            if previous is None:
+                os.environ.pop("PGDATABASE", None)
+            else:
+                os.environ["PGDATABASE"] = previous
+
+    # Drop and recreate every schema and raw table (init_db.py) in the scratch database
+    def reset(self):
+        with self.activate():
+            init_db.main()
+
+    def count_rows(self, schema_name, table_name):
+        with psycopg.connect(self.conn_str) as conn:
+            return conn.execute(sql.SQL("SELECT COUNT(*) FROM {}").format(sql.Identifier(schema_name, table_name))).fetchone()[0]
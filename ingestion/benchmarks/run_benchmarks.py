@@ -0,0 +1,369 @@
+"""
+Offline benchmarks for the ingestion pipeline: every stage runs against local stand-ins (see local_stack.py, fake_youtube.py)
+on synthetic data (see synthetic.py), so performance changes can be measured and compared without AWS, the YouTube API or the
+project database.
+- Stages: request (land_youtube_s3.request_and_aggregate_report), land (streaming parquet landing of both YouTube reports),
+  ingest_youtube (ingest_youtube.load_report for every report), ingest_amazon (ingest_amazon.ingest_amazon_csv_files) and
+  dbt_staging (the yt_analytics staging models, full refresh) and startup (importing each pipeline script in a fresh interpreter,
+  then building the API client from the cached discovery document)
+- Each stage is run --repeat times after an untimed setup (fresh scratch database, landed files, generated csvs, ...)
+- Reports rows/s, p50/p99 wall time and peak RSS (this process and its workers) per stage
+- --save writes the results to a JSON baseline; --compare checks them against one and exits non-zero on a regression
+
+Example:
+    python ingestion/benchmarks/run_benchmarks.py --videos 500 --days 365 --save baselines/main.json
+    python ingestion/benchmarks/run_benchmarks.py --videos 500 --days 365 --compare baselines/main.json
+"""
+import sys
+from pathlib import Path
+
+# Benchmarks import the pipeline scripts as modules, the same way they import each other
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import argparse
+import contextlib
+import datetime as dt
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import psutil
+from psycopg_pool import ConnectionPool
+from dotenv import load_dotenv
+from dbt.cli.main import dbtRunner
+import ingestion_utils
+import api_client
+import land_youtube_s3
+import ingest_youtube
+import ingest_amazon
+import fake_youtube
+import synthetic
+from local_stack import LocalS3, LocalPostgres
+
+# Pipeline entry points timed by the startup stage
+STARTUP_MODULES = ['land_youtube_s3', 'ingest_youtube', 'ingest_amazon', 'compact_youtube', 'backfill_youtube', 'run_pipeline']
+
+
+# Sample the resident set size of this process and its child processes (e.g. csv parsing workers) in a background thread,
+# keeping the peak seen between start() and stop()
+class RssSampler:
+    def __init__(self, interval_s=0.01):
+        self.interval_s = interval_s
+        self.peak_bytes = 0
+        self._process = psutil.Process()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _rss(self):
+        rss = self._process.memory_info().rss
+        for child in self._process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                pass
+        return rss
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            self.peak_bytes = max(self.peak_bytes, self._rss())
+
+    def start(self):
+        self.peak_bytes = self._rss()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.peak_bytes = max(self.peak_bytes, self._rss())
+        return self.peak_bytes
+
+
+# q-th percentile (0-100) of a list of numbers, interpolating linearly between the closest ranks
+def percentile(values, q):
+    values = sorted(values)
+    rank = (len(values) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+# Run one stage `repeat` times. setup() runs untimed before every repetition; run() is timed and returns the rows it processed.
+# Pipeline output is discarded unless verbose, so printing does not dominate the timings.
+def measure_stage(name, run, setup=None, repeat=3, verbose=False):
+    durations, rows, peak_rss = [], 0, 0
+    for i in range(repeat):
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if verbose else devnull):
+            if setup is not None:
+                setup()
+            sampler = RssSampler()
+            sampler.start()
+            started_at = time.perf_counter()
+            try:
+                rows = run()
+            finally:
+                durations.append(time.perf_counter() - started_at)
+                peak_rss = max(peak_rss, sampler.stop())
+        print(f'INFO: {name} run {i + 1}/{repeat}: {rows} rows in {durations[-1]:.3f}s')
+
+    p50 = percentile(durations, 50)
+    return {'rows': rows,
+            'repeat': repeat,
+            'p50_s': p50,
+            'p99_s': percentile(durations, 99),
+            'min_s': min(durations),
+            'max_s': max(durations),
+            'rows_per_s': rows / p50 if p50 else 0.0,
+            'peak_rss_mb': peak_rss / 1024 ** 2}
+
+
+# Point land_youtube_s3's request functions at the fake client. A fresh limiter per repetition keeps its adaptive rate from
+# carrying over between runs.
+def configure_landing(client, requests_per_second, max_requests_per_second, retry_base_sleep):
+    land_youtube_s3.configure_api(client, None, num_retries=5, sleep_time=retry_base_sleep, max_sleep_time=1,
+                                  limiter=ingestion_utils.AdaptiveTokenBucket(requests_per_second, max_rate=max_requests_per_second),
+                                  stats=ingestion_utils.CallStats())
+
+
+# Stage functions keyed by name, each a dict of run/setup callables sharing the stand-ins and generated data
+def build_stages(args, schema, s3, pg, work_dir):
+    yt_source = next(s for s in schema['sources'] if s['source_name'] == 'youtubeanalytics_v2')
+    amazon_source = next(s for s in schema['sources'] if s['source_name'] == 'amazon')
+    report_funcs = {'report-timebased': land_youtube_s3.make_timebased_yt_request,
+                    'report-devicetype': land_youtube_s3.make_devicetype_yt_request}
+
+    end_date = dt.date(2025, 12, 31)
+    start_date = end_date - dt.timedelta(days=args.days - 1)
+    catalogue = synthetic.video_catalogue(args.videos, start_date, end_date, seed=args.seed)
+    video_ids = [video['youtube_id'] for video in catalogue]
+    client = fake_youtube.FakeYouTubeAnalytics(published_at={v['youtube_id']: v['published_at'] for v in catalogue},
+                                               latency_s=args.latency_ms / 1000, jitter_s=args.jitter_ms / 1000,
+                                               throttle_rate=args.throttle_rate, seed=args.seed)
+    run_ts = dt.datetime(2026, 1, 1, tzinfo=dt.timezone.utc)
+    state = {}
+
+    def setup_landing():
+        configure_landing(client, args.requests_per_second, args.max_requests_per_second, args.retry_base_sleep)
+
+    def run_request():
+        df = land_youtube_s3.request_and_aggregate_report(video_ids, report_funcs['report-timebased'], start_date, end_date,
+                                                          max_workers=args.max_workers, batch_size=args.batch_size)
+        return len(df)
+
+    # Landing is timed on pre-fetched responses, so it measures Arrow assembly, parquet encoding and uploads only
+    def setup_land():
+        if 'responses' not in state:
+            setup_landing()
+            state['responses'] = list(land_youtube_s3.iter_report_responses(video_ids, list(report_funcs.values()), start_date, end_date,
+                                                                           max_workers=args.max_workers, batch_size=args.batch_size))
+
+    def run_land():
+        rows = 0
+        with ThreadPoolExecutor(max_workers=4) as upload_executor:
+            sinks, writers = {}, {}
+            for report_name in report_funcs:
+                report_obj = next(r for r in yt_source['reports'] if r['report_name'] == report_name)
+                key = ingestion_utils.generate_s3_key('raw', run_ts, yt_source['api_name'], yt_source['api_version'], report_name, '.parquet')
+                sinks[report_name] = ingestion_utils.S3MultipartWriter(s3, args.bucket, key, executor=upload_executor)
+                writers[report_name] = land_youtube_s3.ReportParquetWriter(sinks[report_name], land_youtube_s3.build_arrow_schema(report_obj),
+                                                                           use_dictionary=['day', 'deviceType', 'video_id'])
+            for video_id, video_results in state['responses']:
+                for report_name, result in zip(report_funcs, video_results):
+                    writers[report_name].append_response(result, video_id)
+            for report_name in report_funcs:
+                writers[report_name].close()
+                sinks[report_name].close()
+                rows += writers[report_name].rows_written
+        state['landed'] = True
+        return rows
+
+    def ensure_landed():
+        if not state.get('landed'):
+            setup_land()
+            run_land()
+
+    def load_youtube():
+        now = dt.datetime.now(dt.timezone.utc)
+        with ConnectionPool(pg.conn_str, min_size=1, max_size=len(yt_source['reports'])) as pool, \
+             ThreadPoolExecutor(max_workers=4) as prefetch_executor, \
+             ThreadPoolExecutor(max_workers=len(yt_source['reports'])) as report_executor:
+            futures = [report_executor.submit(ingest_youtube.load_report, pool, s3, args.bucket, 'raw', yt_source, report_obj,
+                                              prefetch_executor, 4, 65_536, now)
+                       for report_obj in yt_source['reports']]
+            return sum(future.result()[1].rows for future in futures)
+
+    def setup_ingest_youtube():
+        ensure_landed()
+        pg.reset()
+
+    def setup_ingest_amazon():
+        if 'amazon_dir' not in state:
+            state['amazon_dir'] = Path(work_dir) / 'amazon'
+            years = range(end_date.year - args.amazon_years + 1, end_date.year + 1)
+            synthetic.write_amazon_csvs(state['amazon_dir'], amazon_source, years, args.amazon_rows, end_date, seed=args.seed)
+        pg.reset()
+
+    def run_ingest_amazon():
+        with pg.activate():
+            csv_metadata = ingest_amazon.parse_csv_landing_dir(state['amazon_dir'], amazon_source)
+            ingest_amazon.ingest_amazon_csv_files(csv_metadata, amazon_source)
+        return sum(pg.count_rows(amazon_source['target_wh_schema'], r['target_wh_table']) for r in amazon_source['reports'])
+
+    # dbt runs against the scratch database through a generated profile (profiles.yml is a YAML superset of this JSON)
+    def setup_dbt():
+        if 'dbt_args' not in state:
+            profiles_dir = Path(work_dir) / 'dbt_profiles'
+            profiles_dir.mkdir(exist_ok=True)
+            profile = {'affiliate_youtube': {'target': 'bench', 'outputs': {'bench': {
+                'type': 'postgres', 'host': pg.host, 'port': int(pg.port or 5432), 'user': pg.user, 'password': pg.password or '',
+                'dbname': pg.dbname, 'schema': 'bench', 'threads': 4}}}}
+            (profiles_dir / 'profiles.yml').write_text(json.dumps(profile, indent=4))
+            state['dbt_args'] = ['run', '--select', 'staging.yt_analytics', '--full-refresh',
+                                 '--project-dir', str(Path(__file__).parent.parent.parent / 'dbt'),
+                                 '--profiles-dir', str(profiles_dir),
+                                 '--target-path', str(Path(work_dir) / 'dbt_target'),
+                                 '--log-path', str(Path(work_dir) / 'dbt_logs'),
+                                 '--vars', json.dumps({'raw_database': pg.dbname})]
+        setup_ingest_youtube()
+        load_youtube()
+
+    # Startup is timed in fresh interpreters, as a scheduled run would start. The discovery cache is seeded from the copy of the
+    # document bundled with googleapiclient, so the client build makes no request.
+    def setup_startup():
+        if 'startup_cache_dir' not in state:
+            state['startup_cache_dir'] = Path(work_dir) / 'discovery'
+            static_doc = Path(api_client.discovery.__file__).parent / 'discovery_cache' / 'documents' / 'youtubeAnalytics.v2.json'
+            api_client.write_cache_file(state['startup_cache_dir'] / f'{yt_source["api_name"]}_{yt_source["api_version"]}.json',
+                                        {'fetched_at': time.time(), 'document': json.loads(static_doc.read_text(encoding='utf8'))})
+
+    def run_startup():
+        build_code = ('import land_youtube_s3, api_client; from google.auth.credentials import AnonymousCredentials; '
+                      f'api_client.build_client({yt_source["api_name"]!r}, {yt_source["api_version"]!r}, AnonymousCredentials(), '
+                      f'{str(state["startup_cache_dir"])!r}, float("inf"))')
+        commands = {module: f'import {module}' for module in STARTUP_MODULES}
+        commands['land_youtube_s3+client'] = build_code
+        for name, code in commands.items():
+            started_at = time.perf_counter()
+            subprocess.run([sys.executable, '-c', code], cwd=Path(__file__).parent.parent, check=True)
+            print(f'INFO: {name} started in {time.perf_counter() - started_at:.3f}s')
+        return len(commands)
+
+    def run_dbt():
+        result = dbtRunner().invoke(state['dbt_args'])
+        if not result.success:
+            raise RuntimeError(f'dbt run failed: {result.exception}')
+        return sum(pg.count_rows('bench', f'stg_yt_analytics__{r["target_wh_table"]}') for r in yt_source['reports'])
+
+    return {'request': {'run': run_request, 'setup': setup_landing},
+            'land': {'run': run_land, 'setup': setup_land},
+            'ingest_youtube': {'run': load_youtube, 'setup': setup_ingest_youtube},
+            'ingest_amazon': {'run': run_ingest_amazon, 'setup': setup_ingest_amazon},
+            'dbt_staging': {'run': run_dbt, 'setup': setup_dbt},
+            'startup': {'run': run_startup, 'setup': setup_startup}}
+
+
+# Compare results with a saved baseline. A stage regresses if its p50 time or peak RSS grew, or its rows/s fell, by more than
+# tolerance (a fraction). Returns the names of regressed stages.
+def compare_to_baseline(results, baseline, tolerance):
+    if baseline.get('config') != results['config']:
+        print(f'WARNING: Baseline was recorded with a different configuration: {baseline.get("config")}')
+
+    regressions = []
+    for name, stage in results['stages'].items():
+        base = baseline['stages'].get(name)
+        if base is None:
+            print(f'INFO: {name}: no baseline')
+            continue
+        checks = {'p50_s': stage['p50_s'] > base['p50_s'] * (1 + tolerance),
+                  'rows_per_s': stage['rows_per_s'] < base['rows_per_s'] * (1 - tolerance),
+                  'peak_rss_mb': stage['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance)}
+        changes = ', '.join(f'{metric} {base[metric]:,.3f} -> {stage[metric]:,.3f} ({(stage[metric] / base[metric] - 1) * 100 if base[metric] else 0:+.1f}%)'
+                            for metric in checks)
+        failed = [metric for metric, regressed in checks.items() if regressed]
+        if failed:
+            regressions.append(name)
+            print(f'ERROR: {name} regressed ({", ".join(failed)}): {changes}')
+        else:
+            print(f'INFO: {name}: {changes}')
+    return regressions
+
+
+if __name__ == '__main__':
+
+    # Constants
+    ROOT = Path(__file__).parent.parent.parent
+    STAGES = ['request', 'land', 'ingest_youtube', 'ingest_amazon', 'dbt_staging', 'startup']
+    load_dotenv(ROOT / '.env')
+
+    parser = argparse.ArgumentParser(description='Benchmark the ingestion pipeline offline against local stand-ins.')
+    parser.add_argument('--stages', default=','.join(STAGES), help=f'Comma-separated stages to run (default: all of {STAGES}).')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per stage.')
+    parser.add_argument('--videos', type=int, default=200, help='Videos in the synthetic catalogue.')
+    parser.add_argument('--days', type=int, default=180, help='Days of YouTube history requested.')
+    parser.add_argument('--batch-size', type=int, default=50, help='Videos packed into each API request.')
+    parser.add_argument('--max-workers', type=int, default=8, help='Concurrent API request threads.')
+    parser.add_argument('--latency-ms', type=float, default=20, help='Fake API latency per request.')
+    parser.add_argument('--jitter-ms', type=float, default=10, help='Extra random fake API latency per request (uniform).')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Share of fake API requests answered with HTTP 429.')
+    parser.add_argument('--requests-per-second', type=float, default=100, help='Starting rate of the adaptive rate limiter.')
+    parser.add_argument('--max-requests-per-second', type=float, default=200, help='Ceiling of the adaptive rate limiter.')
+    parser.add_argument('--retry-base-sleep', type=float, default=0.05, help='Base backoff (seconds) when a request is throttled.')
+    parser.add_argument('--amazon-years', type=int, default=2, help='Data years of Amazon csvs per report.')
+    parser.add_argument('--amazon-rows', type=int, default=20_000, help='Rows per Amazon csv.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic data.')
+    parser.add_argument('--bucket', default='affiliate-youtube-project', help='Bucket name used in the in-memory S3 stand-in.')
+    parser.add_argument('--pg-database', default='affiliate_bench',
+                        help='Scratch database (created if missing, reset before each stage) on the Postgres server in .env.')
+    parser.add_argument('--save', type=Path, help='Write results to this JSON baseline.')
+    parser.add_argument('--compare', type=Path, help='Compare results with this JSON baseline; exit 1 on a regression.')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='Allowed relative change before a stage counts as regressed.')
+    parser.add_argument('--verbose', action='store_true', help='Show the pipeline output of each stage.')
+    args = parser.parse_args()
+
+    stage_names = [name.strip() for name in args.stages.split(',') if name.strip()]
+    unknown = set(stage_names) - set(STAGES)
+    if unknown:
+        parser.error(f'Unknown stages {sorted(unknown)}. Choose from {STAGES}.')
+
+    with open(ROOT / 'ingestion' / 's3_schema.json', 'r') as f:
+        schema = json.load(f)
+
+    s3 = LocalS3()
+    pg = LocalPostgres(args.pg_database)
+    if any(name in ('ingest_youtube', 'ingest_amazon', 'dbt_staging') for name in stage_names):
+        pg.create()
+
+    config = {key: value for key, value in vars(args).items() if key not in ('save', 'compare', 'tolerance', 'verbose', 'stages')}
+    results = {'created_at': dt.datetime.now(dt.timezone.utc).isoformat(),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'config': config,
+               'stages': {}}
+
+    with tempfile.TemporaryDirectory(prefix='affiliate_bench_') as work_dir:
+        stages = build_stages(args, schema, s3, pg, work_dir)
+        for name in stage_names:
+            results['stages'][name] = measure_stage(name, stages[name]['run'], stages[name]['setup'], args.repeat, args.verbose)
+            stage = results['stages'][name]
+            print(f'INFO: {name}: {stage["rows"]} rows, {stage["rows_per_s"]:,.0f} rows/s, p50 {stage["p50_s"]:.3f}s, '
+                  f'p99 {stage["p99_s"]:.3f}s, peak RSS {stage["peak_rss_mb"]:.0f} MiB')
+
+    if args.save:
+        args.save.parent.mkdir(parents=True, exist_ok=True)
+        with open(args.save, 'w', encoding='utf8') as f:
+            json.dump(results, f, indent=4)
+        print(f'INFO: Saved baseline to {args.save}')
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf8') as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print(f'ERROR: {len(regressions)} stage(s) regressed against {args.compare}: {regressions}')
+            sys.exit(1)
+        print(f'INFO: No regressions against {args.compare}')
@@ -0,0 +1,95 @@
+"""
+Synthetic, deterministic data for the offline benchmarks at a configurable scale.
+- Video catalogues (YouTube IDs with publish dates), shaped like the youtube_id column of YT_Videos_Bridge.csv
+- YouTube Analytics report responses for any metrics/dimensions/date range/video filter, in the API's response shape
+- Amazon report csvs named and formatted like the files in raw_data/amazon, typed from s3_schema.json
+The same seed always produces the same data, so runs (and baselines) are comparable.
+"""
+import datetime as dt
+import random
+import string
+import zlib
+from pathlib import Path
+
+DEVICE_TYPES = ['MOBILE', 'DESKTOP', 'TV', 'TABLET', 'GAME_CONSOLE']
+ID_ALPHABET = string.ascii_letters + string.digits + '-_'
+
+
+# n_videos YouTube-style 11 character IDs, each with a publish date between start_date and end_date (older videos first)
+def video_catalogue(n_videos, start_date, end_date, seed=0):
+    rnd = random.Random(seed)
+    start_date, end_date = dt.date.fromisoformat(str(start_date)), dt.date.fromisoformat(str(end_date))
+    span_days = max(0, (end_date - start_date).days)
+    videos = [{'youtube_id': ''.join(rnd.choice(ID_ALPHABET) for _ in range(11)),
+               'published_at': start_date + dt.timedelta(days=rnd.randint(0, span_days))}
+              for _ in range(n_videos)]
+    return sorted(videos, key=lambda v: v['published_at'])
+
+
+# Deterministic pseudo-random integer in [0, high) for one (video, day, device, metric) cell
+def _cell_value(seed, *parts, high=1000):
+    return zlib.crc32('|'.join(map(str, (seed,) + parts)).encode('utf8')) % high
+
+
+# A YouTube Analytics reports().query() response (columnHeaders + rows) for the given videos and days.
+# Rows start on each video's publish date (if known), are sorted by day and carry the dimensions in the order requested.
+def report_response(video_ids, metrics, dimensions, start_date, end_date, published_at=None, seed=0):
+    metrics, dimensions = metrics.split(','), dimensions.split(',')
+    published_at = published_at or {}
+    start_date, end_date = dt.date.fromisoformat(str(start_date)[:10]), dt.date.fromisoformat(str(end_date)[:10])
+    devices = DEVICE_TYPES if 'deviceType' in dimensions else [None]
+
+    headers = ([{'name': d, 'columnType': 'DIMENSION', 'dataType': 'STRING'} for d in dimensions]
+               + [{'name': m, 'columnType': 'METRIC', 'dataType': 'FLOAT' if m == 'estimatedRevenue' else 'INTEGER'} for m in metrics])
+    rows = []
+    day = start_date
+    while day <= end_date:
+        iso_day = day.isoformat()
+        for video_id in video_ids:
+            if published_at.get(video_id, start_date) > day:
+                continue
+            for device in devices:
+                # Not every device type has traffic every day
+                if device is not None and _cell_value(seed, video_id, iso_day, device, high=3) == 0:
+                    continue
+                values = {'day': iso_day, 'video': video_id, 'deviceType': device}
+                row = [values[d] for d in dimensions]
+                for m in metrics:
+                    cell = _cell_value(seed, video_id, iso_day, device, m)
+                    row.append(round(cell / 97, 4) if m == 'estimatedRevenue' else cell)
+                rows.append(row)
+        day += dt.timedelta(days=1)
+    return {'kind': 'youtubeAnalytics#resultTable', 'columnHeaders': headers, 'rows': rows}
+
+
+# One csv value for an Amazon column, by its warehouse type (wh_col_types). Prices carry a '$' like Amazon's exports.
+def _amazon_value(rnd, col, col_type, year):
+    if col_type == 'date':
+        return (dt.date(year, 1, 1) + dt.timedelta(days=rnd.randint(0, 364))).isoformat()
+    if col_type in ('integer', 'bigint'):
+        return str(rnd.randint(0, 50))
+    if col_type.startswith('numeric'):
+        return f'${rnd.uniform(0, 500):.2f}'
+    if col == 'ASIN':
+        return 'B0' + ''.join(rnd.choice(string.ascii_uppercase + string.digits) for _ in range(8))
+    return ''.join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randint(4, 16)))
+
+
+# Write one csv per Amazon report (s3_schema.json source_obj) and data year into directory, named YYYY-prefix-suffix-YYYY-MM-DD.csv.
+# Returns the paths written and the total number of data rows.
+def write_amazon_csvs(directory, source_obj, years, rows_per_file, refresh_date, seed=0):
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    rnd = random.Random(seed)
+    paths, total_rows = [], 0
+    for report_obj in source_obj['reports']:
+        col_types = {col: report_obj['wh_col_types'].get(col, 'text') for col in report_obj['cols']}
+        for year in years:
+            path = directory / f'{year}-{report_obj["report_name"]}-{refresh_date}.csv'
+            with open(path, 'w', newline='', encoding='utf8') as f:
+                f.write(','.join(report_obj['cols']) + '\n')
+                for _ in range(rows_per_file):
+                    f.write(','.join(_amazon_value(rnd, col, col_type, year) for col, col_type in col_types.items()) + '\n')
+            paths.append(path)
+            total_rows += rows_per_file
+    return paths, total_rows
@@ -0,0 +1,247 @@
+"""
+Compacts landed and loaded YouTube Analytics snapshots, keeping only the latest row per (video_id, day[, deviceType]).
+- Warehouse: delete rows of raw_youtube tables superseded by a row with a newer s3_run_ts, one partition (and transaction) at a time
+  so loads and dbt runs can continue alongside, then VACUUM each partition
+- S3: fold raw snapshots landed since the last compaction into a compacted parquet dataset partitioned by day
+  (compacted/source=.../report=.../day=YYYY-MM-DD/data.parquet); only the days touched by new snapshots are rewritten
+- Retention: delete raw snapshots older than the retention period once they are both compacted and loaded (load manifest).
+  ingest_youtube.py restores their rows from the compacted dataset into a warehouse that has not loaded them (e.g. after init_db).
+- Report the rows and bytes reclaimed by each step, and record the run in ingestion_meta (see ingestion_utils.RunMetrics)
+- main() can also be called by other scripts, which pass in their s3 schema, S3 client and run metrics
+"""
+import argparse
+import itertools
+from io import BytesIO
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import datetime as dt
+from dotenv import load_dotenv
+import ingestion_utils
+import load_manifest
+from ingest_youtube import retrieve_report_timestamps
+
+pa = ingestion_utils.lazy_import('pyarrow')
+pq = ingestion_utils.lazy_import('pyarrow.parquet')
+boto3 = ingestion_utils.lazy_import('boto3')
+psycopg = ingestion_utils.lazy_import('psycopg')
+sql = ingestion_utils.lazy_import('psycopg.sql')
+
+
+# Run timestamp column added to compacted rows, so later snapshots can be merged in by recency
+S3_RUN_TS_COL = 's3_run_ts'
+
+
+# Partitions of a raw table, oldest first (the DEFAULT partition sorts last)
+def list_partitions(conn, schema_name, table_name):
+    cur = conn.execute("""
+                       SELECT c.relname
+                       FROM pg_inherits AS i
+                       JOIN pg_class AS c ON c.oid = i.inhrelid
+                       WHERE i.inhparent = %s::regclass
+                       ORDER BY c.relname
+                       """, (f'{schema_name}.{table_name}',))
+    return [row[0] for row in cur.fetchall()]
+
+
+# Delete the rows of one partition that have a newer s3_run_ts for the same dedup key anywhere in the table (uses the dedup index),
+# then VACUUM it. Runs in its own transaction on an autocommit connection. Returns (rows deleted, bytes before, bytes after).
+def compact_partition(conn, schema_name, table_name, partition_name, dedup_cols, vacuum_full=False):
+    partition = sql.Identifier(schema_name, partition_name)
+    bytes_before = conn.execute("SELECT pg_total_relation_size(%s::regclass)", (f'{schema_name}.{partition_name}',)).fetchone()[0]
+
+    with conn.transaction():
+        cur = conn.execute(sql.SQL("""
+                                   DELETE FROM {} AS t
+                                   WHERE EXISTS (SELECT 1 FROM {} AS n WHERE {} AND n.s3_run_ts > t.s3_run_ts)
+                                   """).format(partition,
+                                               sql.Identifier(schema_name, table_name),
+                                               sql.SQL(' AND ').join(sql.SQL('n.{col} = t.{col}').format(col=sql.Identifier(col))
+                                                                     for col in dedup_cols)))
+        rows_deleted = cur.rowcount
+
+    # VACUUM makes the space reusable; VACUUM FULL returns it to the OS but locks the partition while it is rewritten
+    conn.execute(sql.SQL('VACUUM (FULL) {}' if vacuum_full else 'VACUUM {}').format(partition))
+    bytes_after = conn.execute("SELECT pg_total_relation_size(%s::regclass)", (f'{schema_name}.{partition_name}',)).fetchone()[0]
+    return rows_deleted, bytes_before, bytes_after
+
+
+# Keep the latest row per dedup key (newest s3_run_ts wins) across one or more tables with the same schema
+def keep_latest(tables, dedup_cols):
+    table = pa.concat_tables(tables)
+    table = table.append_column('__row', pa.array(range(table.num_rows), type=pa.int64()))
+    latest = (table.sort_by([('s3_run_ts', 'descending')])
+                   .group_by(dedup_cols, use_threads=False)
+                   .aggregate([('__row', 'first')]))
+    return table.take(latest['__row_first']).drop_columns(['__row'])
+
+
+# Read a landed snapshot, cast to the report's typed schema (see land_youtube_s3.build_arrow_schema),
+# with its run timestamp attached as an s3_run_ts column
+def read_snapshot(s3, bucket_name, run, raw_schema):
+    buf = BytesIO(s3.get_object(Bucket=bucket_name, Key=run['s3_key'])['Body'].read())
+    table = pq.read_table(buf).select(raw_schema.names).cast(raw_schema)
+    run_ts = dt.datetime.strptime(run['run_ts'], "%Y%m%d%H%M%S").replace(tzinfo=dt.timezone.utc)
+    run_ts_type = pa.timestamp('us', tz='UTC')
+    return table.append_column(pa.field(S3_RUN_TS_COL, run_ts_type), pa.repeat(pa.scalar(run_ts, run_ts_type), table.num_rows))
+
+
+# Merge new rows for one day into its compacted file (creating it if needed). Returns the number of rows in the rewritten file.
+def rewrite_compacted_day(s3, bucket_name, key, day_table, existing_keys, dedup_cols):
+    tables = [day_table]
+    if key in existing_keys:
+        existing = pq.read_table(BytesIO(s3.get_object(Bucket=bucket_name, Key=key)['Body'].read()))
+        tables.insert(0, existing.cast(day_table.schema))
+    merged = keep_latest(tables, dedup_cols).sort_by([(col, 'ascending') for col in dedup_cols])
+
+    buf = BytesIO()
+    pq.write_table(merged, buf, compression='snappy')
+    s3.put_object(Bucket=bucket_name, Key=key, Body=buf.getvalue())
+    return merged.num_rows
+
+
+# Fold raw snapshots landed after last_compacted_key into the compacted dataset. Snapshots are merged in run order so memory is
+# bounded by the distinct rows they cover, not by the number of snapshots. Returns (newest key compacted, stats).
+def compact_report_s3(s3, bucket_name, source_obj, report_obj, last_compacted_key, executor):
+    report_name = report_obj['report_name']
+    dedup_cols = report_obj['dedup_cols']
+    raw_schema = pa.schema([(col, pa.type_for_alias(report_obj['col_types'][col])) for col in report_obj['cols']])
+
+    new_runs = retrieve_report_timestamps(bucket_name, 'raw', source_obj['source_name'], report_name, s3=s3,
+                                          start_after=last_compacted_key)
+    stats = {'snapshots': len(new_runs), 'rows_read': 0, 'days_rewritten': 0, 'rows_compacted': 0}
+    if not new_runs:
+        return last_compacted_key, stats
+
+    merged = None
+    for run in new_runs:
+        table = read_snapshot(s3, bucket_name, run, raw_schema)
+        stats['rows_read'] += table.num_rows
+        merged = table if merged is None else keep_latest([merged, table], dedup_cols)
+
+    # Days already in the compacted dataset (one listing), so only those files are read back before rewriting
+    compacted_prefix = f'compacted/source={source_obj["source_name"]}/report={report_name}/'
+    existing_keys = {obj['s3_key'] for obj in ingestion_utils.iter_s3_objects(s3, bucket_name, compacted_prefix)}
+
+    # Rows sorted by day, so each day is one contiguous slice
+    merged = merged.sort_by([('day', 'ascending')])
+    futures, offset = [], 0
+    for day, rows in itertools.groupby(merged.column('day').to_pylist()):
+        num_rows = sum(1 for _ in rows)
+        key = ingestion_utils.generate_s3_compacted_key(source_obj['api_name'], source_obj['api_version'], report_name, day)
+        futures.append(executor.submit(rewrite_compacted_day, s3, bucket_name, key, merged.slice(offset, num_rows), existing_keys, dedup_cols))
+        offset += num_rows
+    for future in futures:
+        stats['rows_compacted'] += future.result()
+        stats['days_rewritten'] += 1
+
+    return new_runs[-1]['s3_key'], stats
+
+
+# Delete raw snapshots that are compacted (key <= last_compacted_key), loaded (in the load manifest) and older than the cutoff.
+# Returns the deleted runs.
+def apply_retention(s3, bucket_name, source_name, report_name, last_compacted_key, loaded_keys, cutoff):
+    runs = retrieve_report_timestamps(bucket_name, 'raw', source_name, report_name, s3=s3)
+    expired = [run for run in runs
+               if last_compacted_key is not None and run['s3_key'] <= last_compacted_key
+               and run['s3_key'] in loaded_keys
+               and dt.datetime.strptime(run['run_ts'], "%Y%m%d%H%M%S").replace(tzinfo=dt.timezone.utc) < cutoff]
+
+    # delete_objects accepts at most 1000 keys per request
+    for i in range(0, len(expired), 1000):
+        s3.delete_objects(Bucket=bucket_name,
+                          Delete={'Objects': [{'Key': run['s3_key']} for run in expired[i:i + 1000]], 'Quiet': True})
+    return expired
+
+
+# Compact the warehouse and S3 snapshots, then apply retention. Standalone runs parse argv and create their own S3 client and run
+# metrics; callers may pass in their s3 schema, S3 client and run metrics instead. Returns the rows and bytes reclaimed.
+def main(argv=None, schema=None, s3=None, metrics=None):
+
+    # Constants
+    ROOT = Path(__file__).parent.parent
+    BUCKET = 'affiliate-youtube-project'
+    RETENTION_DAYS = 30
+    UPLOAD_WORKERS = 8
+    COMPACTION_STATE_NAME = 'compaction.json'
+    LISTING_INDEX_PATH = ROOT / '.cache' / 's3_listing_index.json'
+    load_dotenv(ROOT / '.env')
+
+    parser = argparse.ArgumentParser(description='Compact YouTube Analytics snapshots in the warehouse and in S3.')
+    parser.add_argument('--retention-days', type=int, default=RETENTION_DAYS,
+                        help='Keep raw S3 snapshots at least this many days, even once compacted and loaded.')
+    parser.add_argument('--vacuum-full', action='store_true',
+                        help='VACUUM FULL each compacted partition (returns space to the OS, but locks one partition at a time).')
+    parser.add_argument('--skip-warehouse', action='store_true', help='Do not compact raw_youtube tables.')
+    parser.add_argument('--skip-s3', action='store_true', help='Do not compact S3 snapshots or apply retention.')
+    ingestion_utils.add_instrumentation_args(parser)
+    args = parser.parse_args(argv)
+
+    # Load current s3 schema which defines mapping between s3 partitions and warehouse tables
+    if schema is None:
+        schema = ingestion_utils.load_s3_schema()
+    source_obj = next(s for s in schema['sources'] if s['source_name'] == 'youtubeanalytics_v2')
+
+    conn_str = ingestion_utils.get_conn_str()
+    if metrics is None:
+        metrics = ingestion_utils.start_run_metrics('compact_youtube', args, conn_str, profile_dir=ROOT / '.cache' / 'profiles')
+
+    totals = {'wh_rows_deleted': 0, 'wh_bytes_reclaimed': 0, 's3_objects_deleted': 0, 's3_bytes_reclaimed': 0}
+
+    # Warehouse: one partition at a time, each in its own short transaction
+    if not args.skip_warehouse:
+        with psycopg.connect(conn_str, autocommit=True) as conn:
+            for report_obj in source_obj['reports']:
+                table_name = report_obj['target_wh_table']
+                for partition_name in list_partitions(conn, source_obj['target_wh_schema'], table_name):
+                    with metrics.span('compact_warehouse', report_obj['report_name']) as span:
+                        rows_deleted, bytes_before, bytes_after = compact_partition(conn, source_obj['target_wh_schema'], table_name,
+                                                                                    partition_name, report_obj['dedup_cols'],
+                                                                                    vacuum_full=args.vacuum_full)
+                        span.add(rows=rows_deleted, bytes=bytes_before - bytes_after)
+                    totals['wh_rows_deleted'] += rows_deleted
+                    totals['wh_bytes_reclaimed'] += bytes_before - bytes_after
+                    print(f'INFO: Compacted {source_obj["target_wh_schema"]}.{partition_name}: {rows_deleted} superseded rows deleted, '
+                          f'{bytes_before} -> {bytes_after} bytes')
+
+    # S3: compact new snapshots per report, then expire raw snapshots that are compacted, loaded and past retention
+    if not args.skip_s3:
+        s3 = s3 or boto3.client('s3')
+        state_key = ingestion_utils.generate_s3_state_key(source=source_obj['api_name'], api_version=source_obj['api_version'],
+                                                          name=COMPACTION_STATE_NAME)
+        compaction_state = ingestion_utils.read_s3_json(s3, BUCKET, state_key, default={})
+
+        listing_index = ingestion_utils.S3ListingIndex(LISTING_INDEX_PATH)
+        cutoff = dt.datetime.now(dt.timezone.utc) - dt.timedelta(days=args.retention_days)
+
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor, psycopg.connect(conn_str) as conn:
+            for report_obj in source_obj['reports']:
+                report_name = report_obj['report_name']
+                with metrics.span('compact_s3', report_name) as span:
+                    last_key, stats = compact_report_s3(s3, BUCKET, source_obj, report_obj, compaction_state.get(report_name), executor)
+                    span.add(files=stats['snapshots'], rows=stats['rows_compacted'], rows_read=stats['rows_read'],
+                             days_rewritten=stats['days_rewritten'])
+                print(f'INFO: Compacted {stats["snapshots"]} new snapshots of {report_name} ({stats["rows_read"]} rows) into '
+                      f'{stats["days_rewritten"]} day partitions ({stats["rows_compacted"]} rows)')
+
+                # Persist progress per report so an interrupted run resumes after the last compacted snapshot
+                compaction_state[report_name] = last_key
+                ingestion_utils.write_s3_json(s3, BUCKET, state_key, compaction_state, indent=4)
+
+                with metrics.span('retention', report_name) as span:
+                    loaded_keys = load_manifest.fetch_loaded_keys(conn, source_obj['source_name'], report_name)
+                    expired = apply_retention(s3, BUCKET, source_obj['source_name'], report_name, last_key, loaded_keys, cutoff)
+                    span.add(files=len(expired), bytes=sum(run['size'] for run in expired))
+                listing_index.remove(f'raw/source={source_obj["source_name"]}/report={report_name}/', [run['s3_key'] for run in expired])
+                totals['s3_objects_deleted'] += len(expired)
+                totals['s3_bytes_reclaimed'] += sum(run['size'] for run in expired)
+                print(f'INFO: Deleted {len(expired)} raw snapshots of {report_name} older than {args.retention_days} days '
+                      f'({sum(run["size"] for run in expired)} bytes)')
+
+        listing_index.save()
+
+    print(f'INFO: Compaction summary: {totals}')
+    return totals
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+High-throughput COPY of Arrow record batches into Postgres.
+- Validate a batch schema's columns against s3_schema.json once per distinct schema, not once per file
+- Attach batch-level metadata (e.g. s3_run_ts, source_csv) as constant Arrow columns instead of appending to every row
+- Serialise each record batch to CSV in Arrow's native writer and stream the buffer into COPY ... FROM STDIN (FORMAT csv)
+- Track rows, bytes and time spent so callers can report rows per second
+Any source that can produce Arrow record batches (parquet from S3, Amazon CSVs) can be loaded through the same engine.
+"""
+import io
+import itertools
+import time
+import ingestion_utils
+
+pa = ingestion_utils.lazy_import('pyarrow')
+pa_csv = ingestion_utils.lazy_import('pyarrow.csv')
+sql = ingestion_utils.lazy_import('psycopg.sql')
+
+
+class CopyEngine:
+    def __init__(self):
+        self.rows = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self._validated_schemas = set()
+
+    # Raise ValueError if any column is neither an expected report column nor a metadata column.
+    # Each distinct (columns, expected columns) combination is only checked once per engine.
+    def validate_columns(self, col_names, expected_cols, metadata_cols=()):
+        schema_key = (tuple(col_names), tuple(expected_cols), tuple(metadata_cols))
+        if schema_key in self._validated_schemas:
+            return
+
+        allowed_cols = set(expected_cols) | set(metadata_cols)
+        unexpected_cols = [col for col in col_names if col not in allowed_cols]
+        if unexpected_cols:
+            raise ValueError(f'Read unexpected columns {unexpected_cols}. Expected columns (s3_schema.json): {list(expected_cols)}')
+        self._validated_schemas.add(schema_key)
+
+    # COPY an iterable of record batches into schema_name.table_name, adding one constant column per entry in `constants`.
+    # Column order is taken from the first batch and passed explicitly to COPY for safety. Runs inside the caller's transaction.
+    # Returns the number of rows copied.
+    def copy_batches(self, cur, schema_name, table_name, batches, constants=None):
+        constants = constants or {}
+        started_at = time.perf_counter()
+        write_options = pa_csv.WriteOptions(include_header=False)
+
+        batches = (self.add_constants(batch, constants) for batch in batches if batch.num_rows > 0)
+        first_batch = next(batches, None)
+        if first_batch is None:
+            return 0
+
+        rows, num_bytes = 0, 0
+        with cur.copy(sql.SQL('COPY {} ({}) FROM STDIN (FORMAT csv)').format(
+            sql.Identifier(schema_name, table_name),
+            sql.SQL(',').join(sql.Identifier(c) for c in first_batch.schema.names))) as copy:
+            for batch in itertools.chain([first_batch], batches):
+                buf = io.BytesIO()
+                pa_csv.write_csv(batch, buf, write_options)
+                copy.write(buf.getbuffer())
+                rows += batch.num_rows
+                num_bytes += buf.tell()
+
+        self.rows += rows
+        self.bytes += num_bytes
+        self.seconds += time.perf_counter() - started_at
+        return rows
+
+    # Append one constant column per entry in `constants` (e.g. per-file metadata of batches copied in one stream)
+    @staticmethod
+    def add_constants(batch, constants):
+        for col, value in constants.items():
+            batch = batch.append_column(col, pa.repeat(value, batch.num_rows))
+        return batch
+
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def summary(self):
+        return f'{self.rows} rows ({self.bytes / 1024 ** 2:.1f} MiB) in {self.seconds:.2f}s, {self.rows_per_second():,.0f} rows/s'
@@ -0,0 +1,84 @@
+"""
+Content fingerprints shared by the landing and ingestion scripts, so data that has not changed is skipped at the cheapest stage.
+- Streaming sha256 checksums of whole files, computed while bytes are read or written rather than in a second pass
+- Per-partition fingerprints (e.g. one per video and day) over a partition's row values, independent of row order
+- Partition fingerprints of landed data are kept as a JSON state object in S3, alongside the landing watermarks. Only days a later
+  run can re-request are kept, so the state stays bounded by the lookback window rather than growing with history
+"""
+import hashlib
+import json
+import ingestion_utils
+
+CHUNK_SIZE = 1024 ** 2
+
+
+# sha256 checksum of a local file's bytes, read in chunks
+def file_checksum(file_path, chunk_size=CHUNK_SIZE):
+    checksum = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+# File-like wrapper that checksums every byte written through it before passing it on to the wrapped sink
+class HashingWriter:
+    def __init__(self, sink):
+        self.sink = sink
+        self._checksum = hashlib.sha256()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._checksum.update(data)
+        return self.sink.write(data)
+
+    def tell(self):
+        return self.sink.tell()
+
+    def flush(self):
+        self.sink.flush()
+
+    def hexdigest(self):
+        return self._checksum.hexdigest()
+
+
+# Fingerprint of one partition's rows (lists of JSON-serialisable values). Rows are hashed individually and sorted,
+# so the fingerprint does not depend on the order the API returned them in.
+def partition_fingerprint(rows):
+    row_hashes = sorted(hashlib.blake2b(json.dumps(row).encode('utf8'), digest_size=16).digest() for row in rows)
+    return hashlib.blake2b(b''.join(row_hashes), digest_size=16).hexdigest()
+
+
+# Partition fingerprints for one report, as last landed ({'video_id|day' partition key: fingerprint}).
+# Fingerprints of changed partitions are staged and only become current once the caller has landed them.
+class PartitionFingerprints:
+    def __init__(self, landed=None):
+        self.landed = landed or {}
+        self.staged = {}
+
+    # True if these rows are identical to what was last landed for the partition; otherwise stage their fingerprint
+    def is_unchanged(self, partition_key, rows):
+        fingerprint = partition_fingerprint(rows)
+        if self.landed.get(partition_key) == fingerprint:
+            return True
+        self.staged[partition_key] = fingerprint
+        return False
+
+    # Landed and staged fingerprints, keeping only partitions whose day (YYYY-MM-DD) is on or after since, if given
+    def current(self, since=None):
+        fingerprints = {**self.landed, **self.staged}
+        if since is None:
+            return fingerprints
+        return {key: value for key, value in fingerprints.items() if key.rpartition('|')[2] >= since}
+
+
+# Read landed partition fingerprints ({report_name: {partition key: fingerprint}}) from the S3 state object
+def read_fingerprints(s3, bucket, key):
+    return ingestion_utils.read_s3_json(s3, bucket, key, default={})
+
+
+# Persist partition fingerprints to the S3 state object. Only called once a run's files have been landed.
+def write_fingerprints(s3, bucket, key, fingerprints):
+    ingestion_utils.write_s3_json(s3, bucket, key, fingerprints)
@@ -1,18 +1,39 @@
 """
-Moves all .csv files from root/raw_data/amazon to the raw_amazon schema in append-only fashion.
+Moves all .csv files from root/raw_data/amazon to the raw_amazon schema.
 - Discover all files and parse csv names to feed metadata ingestion columns
-- Clean .csv files received from data producer for COPY
-- Copy the contents of each .csv file into the appropriate raw_amazon table
+- Validate each file's header against its report's columns, compiled once from s3_schema.json into a set and an Arrow schema
+- Stream each file from a memory map through pyarrow's columnar csv reader in bounded blocks, clean values column-wise and add the
+  metadata columns as constant columns, then copy the batches into the appropriate raw_amazon table (see copy_engine.py)
+  (files bound for the same table share one COPY stream; a failing file is rolled back and skipped on its own)
+- Record each loaded file in the load manifest (ingestion_meta.load_manifest), which is also used to skip files already loaded
+  (by name, or by checksum for files identical to the newest refresh already loaded for their report and data year)
+- Refresh files are full-year snapshots. --mode controls how a new refresh is applied to its data year:
+    append  - load every file in full (default)
+    replace - atomically swap the year's rows for those of the newest refresh
+    delta   - diff the newest refresh against the year's rows; delete rows that disappeared and insert only new/changed rows
+  In replace and delta modes, refreshes older than the newest one loaded for the same year are recorded as superseded and not loaded
+  (mirrors amazon_psql/004_load_raw_amazon__commissions.sql)
+- Manifest lookups, checksums, parsing and COPY are timed per report and the run is recorded in ingestion_meta (see ingestion_utils.RunMetrics)
+- main() can also be called by run_pipeline.py, which passes in its shared s3 schema, connection pool and run metrics
+- A file that fails to load is skipped so the others still load, but the run raises once every file has been attempted
 """
 
 from pathlib import Path
-import os
+import argparse
 import datetime as dt
 from dotenv import load_dotenv
-import psycopg
-from psycopg import sql
-import csv
-import json
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from copy_engine import CopyEngine
+import fingerprint
+import ingestion_utils
+import load_manifest
+
+pa = ingestion_utils.lazy_import('pyarrow')
+pa_csv = ingestion_utils.lazy_import('pyarrow.csv')
+pc = ingestion_utils.lazy_import('pyarrow.compute')
+sql = ingestion_utils.lazy_import('psycopg.sql')
+psycopg_pool = ingestion_utils.lazy_import('psycopg_pool')
 
 # Read contents of raw_data/amazon directory and return per-csv metadata for ingestion step.
 # Skip files which do not conform to the expected format and naming convention with descriptive error messages, rather than halting execution.
@@ -69,94 +90,378 @@ def parse_csv_landing_dir(raw_csv_path, source_obj):
     return csv_metadata
 
 
-# Read amazon csv files into memory and COPY
-def ingest_amazon_csv_files(csv_metadata, source_obj):
+# Metadata columns appended to every amazon row
+METADATA_COLS = ['wh_loaded_at', 'source_csv', 'refresh_date']
+
+# Warehouse types (wh_col_types in s3_schema.json) whose values are cleaned of currency symbols and thousands separators
+NUMERIC_TYPE_PREFIXES = ('integer', 'bigint', 'numeric', 'double precision')
+
+# Bytes of csv parsed into each record batch, which bounds the memory used per file being loaded
+CSV_BLOCK_SIZE = 4 * 1024 ** 2
+
+
+# One amazon report's columns, compiled once per run from s3_schema.json. Every column is read as a string and cast by Postgres
+# on COPY, since the producer formats numbers with currency symbols and thousands separators.
+class AmazonReportSchema:
+    def __init__(self, report_obj):
+        col_types = {col: report_obj['wh_col_types'].get(col, 'text') for col in report_obj['cols']}
+        self.allowed_cols = frozenset(report_obj['cols']) | frozenset(METADATA_COLS)
+        self.numeric_cols = frozenset(col for col, col_type in col_types.items() if col_type.startswith(NUMERIC_TYPE_PREFIXES))
+        self.typed_cols = frozenset(col for col, col_type in col_types.items() if col_type != 'text')
+        self.arrow_schema = pa.schema([(col, pa.string()) for col in report_obj['cols']])
+
+    # Streaming reader over an opened csv. Amazon's exports are unquoted (the \b quotechar previously passed to csv.reader),
+    # so quote characters are read as data.
+    def open_csv(self, source):
+        return pa_csv.open_csv(source,
+                               read_options=pa_csv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+                               parse_options=pa_csv.ParseOptions(delimiter=',', quote_char=False),
+                               convert_options=pa_csv.ConvertOptions(column_types=self.arrow_schema))
+
+    # Clean numeric columns, and turn empty values of typed (non-text) columns into NULL so they load as NULL rather than
+    # failing the COPY. Empty text values stay empty strings.
+    def clean_batch(self, batch):
+        columns = []
+        for col, values in zip(batch.schema.names, batch.columns):
+            if col in self.numeric_cols:
+                values = pc.utf8_trim_whitespace(pc.replace_substring(pc.replace_substring(values, '$', ''), ',', ''))
+            if col in self.typed_cols:
+                values = pc.if_else(pc.equal(values, ''), pa.scalar(None, pa.string()), values)
+            columns.append(values)
+        return pa.record_batch(columns, names=batch.schema.names)
 
-    target_table_list = [t['target_wh_table'] for t in source_obj['reports']]
 
-    # Load environment variables and build connection string for DB connection
-    env_dir = Path(__file__).parent.parent
-    load_dotenv(env_dir / '.env')
+# Validate one amazon csv's header against its report's compiled columns, reading only its first block.
+# Errors are returned rather than raised so that one bad file only skips that file.
+def inspect_amazon_csv(curr_csv, report_schema, wh_loaded_at):
+    curr_csv_name = curr_csv['file_path'].name
+    try:
+        with pa.memory_map(str(curr_csv['file_path']), 'r') as source:
+            csv_headers = report_schema.open_csv(source).schema.names
+        unexpected_cols = [col for col in csv_headers if col not in report_schema.allowed_cols]
+        if unexpected_cols:
+            raise ValueError(f'ERROR: Invalid columns {unexpected_cols} found during csv upload: {curr_csv_name}')
+    except Exception as e:
+        return {'csv': curr_csv, 'error': e}
 
-    host, port = os.environ.get("PGHOST"), os.environ.get("PGPORT")
-    dbname, user, password = os.environ.get("PGDATABASE"), os.environ.get("PGUSER"), os.environ.get("PGPASSWORD")
-    conn_str = f"host={host} port={port} dbname={dbname} user={user} password={password}"
+    return {'csv': curr_csv,
+            'error': None,
+            'schema': report_schema,
+            'cols': tuple(csv_headers + METADATA_COLS),
+            'constants': {'wh_loaded_at': wh_loaded_at, 'source_csv': curr_csv_name, 'refresh_date': curr_csv['refresh_date']},
+            'row_count': 0,
+            'byte_size': curr_csv['file_path'].stat().st_size,
+            'checksum': curr_csv['checksum']}
 
-    with psycopg.connect(conn_str) as conn:
 
-        # Keep track of all previously loaded files to avoid double-loading
+# Stream an inspected file's cleaned record batches, with its metadata columns attached, from a memory map. Counts the rows read
+# into parsed['row_count'] as the batches are consumed.
+def iter_amazon_batches(parsed):
+    parsed['row_count'] = 0
+    with pa.memory_map(str(parsed['csv']['file_path']), 'r') as source:
+        for batch in parsed['schema'].open_csv(source):
+            batch = CopyEngine.add_constants(parsed['schema'].clean_batch(batch), parsed['constants'])
+            parsed['row_count'] += batch.num_rows
+            yield batch
+
+
+# COPY several inspected files bound for the same table (with the same column order) in one transaction and one COPY stream,
+# recording each in the load manifest. Raises on failure, leaving nothing from these files behind.
+def copy_parsed_files(conn, source_name, target_table, parsed_files, copy_engine):
+    with conn.transaction():
         with conn.cursor() as cur:
-            loaded_files = {}
-            for table_name in target_table_list:
-                cur.execute(sql.SQL("SELECT DISTINCT source_csv FROM {}").format(sql.Identifier('raw_amazon', table_name)))
-                loaded_files[table_name] = [val[0] for val in cur.fetchall()]
-            print(loaded_files)
+            copy_engine.copy_batches(cur, 'raw_amazon', target_table,
+                                     itertools.chain.from_iterable(iter_amazon_batches(parsed) for parsed in parsed_files))
 
-            wh_loaded_at = dt.datetime.now()
-        
-        # For each file, load into the database if it hasn't yet been loaded.
-        for curr_csv in csv_metadata:
-            report_cols = next(s for s in source_obj['reports'] if s['report_name'] == curr_csv['report_name'])['cols']
-            target_table = curr_csv['target_table']
-            curr_csv_name = curr_csv['file_path'].name 
-            if curr_csv_name in loaded_files[target_table]:
-                print(f'INFO: File {curr_csv_name} already ingested. Skipping this file.')
-                continue
+            # Record the files in the load manifest within the same transaction as their COPY
+            for parsed in parsed_files:
+                curr_csv = parsed['csv']
+                refresh_ts = dt.datetime.combine(curr_csv['refresh_date'], dt.time(), tzinfo=dt.timezone.utc)
+                load_manifest.record_load(cur, source_name, curr_csv['report_name'], curr_csv['file_path'].name, refresh_ts,
+                                          parsed['row_count'], parsed['byte_size'], parsed['checksum'], 'append')
 
-            # Try to copy each file in its own transaction; if it fails, rollback this file only and continue
-            try:
-                with conn.transaction():
-                    loaded_files[target_table].append(curr_csv['file_path'].name)
-                    with conn.cursor() as cur:
-                
-                        with open(curr_csv['file_path'], 'r', newline='', encoding='utf8') as f:
-                            # Align dialect to data producer's (Amazon's) source formatting
-                            reader = csv.reader(f, delimiter=',', quotechar='\b')
-
-                            # Validate columns match expected schema (defined in s3_schema.json)
-                            csv_headers = next(reader)
-                            metadata_cols = ['wh_loaded_at', 'source_csv', 'refresh_date']
-                            for col in csv_headers:
-                                if col not in report_cols:
-                                    if col not in metadata_cols:
-                                        raise ValueError(f'ERROR: Invalid column {col} found during csv upload: {curr_csv_name}')
-                            cols_ordered = csv_headers + metadata_cols
-
-                            with cur.copy(sql.SQL("COPY {} ({}) FROM STDIN")
-                                          .format(sql.Identifier('raw_amazon', target_table),
-                                                  sql.SQL(',').join(sql.Identifier(s) for s in cols_ordered))) as copy:
-                                
-                                for row in reader:
-                                    # First row = headers
-                                    if reader.line_num <= 1:
-                                        continue
-
-                                    # Add batch-level metadata columns, then copy into our target table
-                                    row.append(wh_loaded_at)
-                                    row.append(curr_csv['file_path'].name)
-                                    row.append(curr_csv['refresh_date'])
-
-                                    # Copy row into target table
-                                    copy.write_row(row)
 
+# Load one group of inspected files over a pooled connection with a single COPY. If that fails, fall back to one transaction
+# per file so only the offending file (e.g. one with a malformed row) is rolled back and skipped. Returns the names of the files loaded.
+def copy_file_group(pool, source_name, target_table, parsed_files, metrics=None):
+    with ingestion_utils.metrics_span(metrics, 'copy', parsed_files[0]['csv']['report_name']) as span, pool.connection() as conn:
+        try:
+            copy_engine = CopyEngine()
+            copy_parsed_files(conn, source_name, target_table, parsed_files, copy_engine)
+            span.add(files=len(parsed_files), rows=copy_engine.rows, bytes=copy_engine.bytes)
+            return [parsed['csv']['file_path'].name for parsed in parsed_files]
+        except Exception as e:
+            if len(parsed_files) > 1:
+                print(f'WARNING: Batched COPY of {len(parsed_files)} files into raw_amazon.{target_table} failed. Retrying file by file.\nError: {e}')
+
+        loaded = []
+        for parsed in parsed_files:
+            curr_csv_name = parsed['csv']['file_path'].name
+            try:
+                copy_engine = CopyEngine()
+                copy_parsed_files(conn, source_name, target_table, [parsed], copy_engine)
+                loaded.append(curr_csv_name)
+                span.add(files=1, rows=copy_engine.rows, bytes=copy_engine.bytes)
             except Exception as e:
-                loaded_files[target_table].pop()
+                span.add(errors=1)
                 print(e)
                 print(f'Encountered error while copying {curr_csv_name}. Skipping this file.')
+        return loaded
 
 
-if __name__ == '__main__':
-    
+# Ways a refresh file can be applied to its data year (see module docstring)
+LOAD_MODES = ('append', 'replace', 'delta')
+
+
+# Apply the newest refresh file for one report and data year in a single transaction (replace or delta mode).
+# Older refreshes of the same year that were pending alongside it are recorded as superseded in the same transaction.
+# Returns (rows deleted, rows inserted), or None if a newer refresh of this year is already loaded.
+def apply_refresh(conn, source_name, parsed, superseded_csvs, mode):
+    curr_csv = parsed['csv']
+    target = sql.Identifier('raw_amazon', curr_csv['target_table'])
+    year_prefix = f'{curr_csv["data_year"]}-'
+    year_pattern = f'{year_prefix}%'
+    data_cols = sql.SQL(',').join(sql.Identifier(c) for c in parsed['cols'] if c not in METADATA_COLS)
+    all_cols = sql.SQL(',').join(sql.Identifier(c) for c in parsed['cols'])
+    refresh_ts = dt.datetime.combine(curr_csv['refresh_date'], dt.time(), tzinfo=dt.timezone.utc)
+
+    with conn.transaction():
+        with conn.cursor() as cur:
+            # Only the most up-to-date refresh of a year is ever applied
+            latest_ts = load_manifest.fetch_latest_run_ts(cur, source_name, curr_csv['report_name'], year_prefix)
+            if latest_ts is not None and refresh_ts <= latest_ts:
+                superseded_csvs = superseded_csvs + [curr_csv]
+                counts = None
+            else:
+                # Land the refresh in a transaction-scoped staging table shaped like the target
+                cur.execute(sql.SQL("CREATE TEMP TABLE amazon_refresh_stage (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP").format(target))
+                CopyEngine().copy_batches(cur, 'pg_temp', 'amazon_refresh_stage', iter_amazon_batches(parsed))
+
+                if mode == 'replace':
+                    cur.execute(sql.SQL("DELETE FROM {} WHERE source_csv LIKE %s").format(target), (year_pattern,))
+                    deleted = cur.rowcount
+                    cur.execute(sql.SQL("INSERT INTO {} ({}) SELECT {} FROM amazon_refresh_stage").format(target, all_cols, all_cols))
+                    counts = (deleted, cur.rowcount)
+                else:
+                    # Match rows on a hash of their data columns, numbering identical rows so duplicates are compared as a multiset.
+                    # Both data-modifying CTEs see the year's rows as they were before this statement.
+                    cur.execute(sql.SQL("""
+                        WITH current_rows AS (
+                            SELECT tableoid AS row_table, ctid AS row_id, md5(ROW({data_cols})::text) AS row_key,
+                                   ROW_NUMBER() OVER (PARTITION BY md5(ROW({data_cols})::text)) AS occurrence
+                            FROM {target}
+                            WHERE source_csv LIKE %s
+                        ), refresh_rows AS (
+                            SELECT {all_cols}, md5(ROW({data_cols})::text) AS row_key,
+                                   ROW_NUMBER() OVER (PARTITION BY md5(ROW({data_cols})::text)) AS occurrence
+                            FROM amazon_refresh_stage
+                        ), deleted AS (
+                            DELETE FROM {target}
+                            WHERE (tableoid, ctid) IN (SELECT c.row_table, c.row_id
+                                                       FROM current_rows c LEFT JOIN refresh_rows r USING (row_key, occurrence)
+                                                       WHERE r.row_key IS NULL)
+                            RETURNING 1
+                        ), inserted AS (
+                            INSERT INTO {target} ({all_cols})
+                            SELECT {all_cols}
+                            FROM refresh_rows r LEFT JOIN current_rows c USING (row_key, occurrence)
+                            WHERE c.row_key IS NULL
+                            RETURNING 1
+                        )
+                        SELECT (SELECT COUNT(*) FROM deleted), (SELECT COUNT(*) FROM inserted)
+                        """).format(target=target, data_cols=data_cols, all_cols=all_cols), (year_pattern,))
+                    counts = cur.fetchone()
+
+                load_manifest.record_load(cur, source_name, curr_csv['report_name'], curr_csv['file_path'].name, refresh_ts,
+                                          parsed['row_count'], parsed['byte_size'], parsed['checksum'], mode)
+
+            # Superseded refreshes are recorded with no rows so later runs do not reconsider them
+            for old_csv in superseded_csvs:
+                old_ts = dt.datetime.combine(old_csv['refresh_date'], dt.time(), tzinfo=dt.timezone.utc)
+                load_manifest.record_load(cur, source_name, old_csv['report_name'], old_csv['file_path'].name, old_ts,
+                                          0, old_csv['file_path'].stat().st_size, old_csv['checksum'], 'superseded')
+    return counts
+
+
+# Apply one refresh over a pooled connection, logging the outcome. A failing refresh is rolled back and skipped.
+# Returns False if it failed.
+def refresh_file_group(pool, source_name, parsed, superseded_csvs, mode, metrics=None):
+    curr_csv_name = parsed['csv']['file_path'].name
+    with ingestion_utils.metrics_span(metrics, 'refresh', parsed['csv']['report_name']) as span:
+        try:
+            with pool.connection() as conn:
+                counts = apply_refresh(conn, source_name, parsed, superseded_csvs, mode)
+        except Exception as e:
+            span.add(errors=1)
+            print(e)
+            print(f'Encountered error while copying {curr_csv_name}. Skipping this file.')
+            return False
+        span.add(files=1 + len(superseded_csvs), files_superseded=len(superseded_csvs) + (counts is None))
+        if counts is not None:
+            span.add(rows=counts[1], rows_deleted=counts[0], bytes=parsed['byte_size'])
+    for old_csv in superseded_csvs:
+        print(f'INFO: File {old_csv["file_path"].name} superseded by a newer refresh. Skipping this file.')
+    if counts is None:
+        print(f'INFO: File {curr_csv_name} superseded by a newer refresh. Skipping this file.')
+    else:
+        print(f'INFO: Successfully ingested {curr_csv_name} ({mode}: {counts[0]} rows deleted, {counts[1]} rows inserted).')
+    return True
+
+
+# Raise once a run has attempted every file if some of them failed (they are not in the load manifest, so the next run retries them)
+def raise_if_failed(failed_csvs):
+    if failed_csvs:
+        raise RuntimeError(f'{len(failed_csvs)} file(s) failed to load and will be retried on the next run: {sorted(failed_csvs)}')
+
+
+# Validate amazon csv files, then stream them into raw_amazon over pooled connections.
+# Files bound for the same table are merged into a single COPY stream; per-file rollback and skip guarantees are kept.
+# Raises RuntimeError once every file has been attempted if any failed, so callers do not treat the run as complete.
+def ingest_amazon_csv_files(csv_metadata, source_obj, max_workers=None, pool_size=3, mode='append', metrics=None, pool=None):
+
+    # Without a shared connection pool (see run_pipeline.py), open one for this call from the PG* environment variables (.env)
+    if pool is None:
+        load_dotenv(Path(__file__).parent.parent / '.env')
+        with psycopg_pool.ConnectionPool(ingestion_utils.get_conn_str(), min_size=1, max_size=pool_size) as pool:
+            return ingest_amazon_csv_files(csv_metadata, source_obj, max_workers, pool_size, mode, metrics, pool)
+
+    # Expected columns and their warehouse types for each report, compiled once
+    report_schemas = {r['report_name']: AmazonReportSchema(r) for r in source_obj['reports']}
+    wh_loaded_at = dt.datetime.now()
+
+    # Keep track of all previously loaded files (per report, from the load manifest) to avoid double-loading
+    with ingestion_utils.metrics_span(metrics, 'manifest_lookup'), pool.connection() as conn:
+        loaded_files = {r['report_name']: load_manifest.fetch_loaded_keys(conn, source_obj['source_name'], r['report_name'])
+                        for r in source_obj['reports']}
+    print(loaded_files)
+
+    pending_csvs = []
+    for curr_csv in csv_metadata:
+        if curr_csv['file_path'].name in loaded_files[curr_csv['report_name']]:
+            print(f'INFO: File {curr_csv["file_path"].name} already ingested. Skipping this file.')
+            continue
+        pending_csvs.append(curr_csv)
+
+    # Checksum pending files (threads: hashing releases the GIL) and set aside files identical to the newest refresh loaded for
+    # their report and data year. Matching an older refresh is not enough: the newest refresh wins, so such a file must be loaded.
+    # Pending files are only compared with loaded ones; in replace/delta mode a pending copy of another is superseded by it anyway.
+    with ingestion_utils.metrics_span(metrics, 'manifest_lookup'), pool.connection() as conn:
+        latest_checksums = {key: load_manifest.fetch_latest_checksum(conn, source_obj['source_name'], key[0], f'{key[1]}-')
+                            for key in {(c['report_name'], c['data_year']) for c in pending_csvs}}
+    with ingestion_utils.metrics_span(metrics, 'checksum') as span, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for curr_csv, checksum in zip(pending_csvs, executor.map(fingerprint.file_checksum, [c['file_path'] for c in pending_csvs])):
+            curr_csv['checksum'] = checksum
+        span.add(files=len(pending_csvs), bytes=sum(c['file_path'].stat().st_size for c in pending_csvs))
+
+    unique_csvs, duplicate_csvs = [], []
+    for curr_csv in pending_csvs:
+        refresh_ts = dt.datetime.combine(curr_csv['refresh_date'], dt.time(), tzinfo=dt.timezone.utc)
+        if load_manifest.is_latest_duplicate(refresh_ts, curr_csv['checksum'], *latest_checksums[(curr_csv['report_name'], curr_csv['data_year'])]):
+            duplicate_csvs.append(curr_csv)
+        else:
+            unique_csvs.append(curr_csv)
+    pending_csvs = unique_csvs
+
+    # Duplicates are recorded with no rows so they are skipped by name from now on
+    if duplicate_csvs:
+        with pool.connection() as conn, conn.transaction(), conn.cursor() as cur:
+            for curr_csv in duplicate_csvs:
+                refresh_ts = dt.datetime.combine(curr_csv['refresh_date'], dt.time(), tzinfo=dt.timezone.utc)
+                load_manifest.record_load(cur, source_obj['source_name'], curr_csv['report_name'], curr_csv['file_path'].name,
+                                          refresh_ts, 0, curr_csv['file_path'].stat().st_size, curr_csv['checksum'], 'duplicate')
+        for curr_csv in duplicate_csvs:
+            print(f'INFO: Contents of {curr_csv["file_path"].name} identical to the newest refresh already ingested. Skipping this file.')
+
+    # In replace/delta mode only the newest pending refresh of each report and data year is parsed and applied
+    superseded = {}
+    if mode != 'append':
+        newest = {}
+        for curr_csv in sorted(pending_csvs, key=lambda c: c['refresh_date'], reverse=True):
+            key = (curr_csv['report_name'], curr_csv['data_year'])
+            if key in newest:
+                superseded[newest[key]['file_path'].name].append(curr_csv)
+            else:
+                newest[key] = curr_csv
+                superseded[curr_csv['file_path'].name] = []
+        pending_csvs = list(newest.values())
+
+    # Validate file headers in parallel (threads: pyarrow releases the GIL); files that fail are skipped
+    with ingestion_utils.metrics_span(metrics, 'parse') as span:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            parsed_files = list(executor.map(inspect_amazon_csv,
+                                             pending_csvs,
+                                             [report_schemas[c['report_name']] for c in pending_csvs],
+                                             [wh_loaded_at] * len(pending_csvs)))
+
+        ok_files, failed_csvs = [], []
+        for parsed in parsed_files:
+            if parsed['error'] is not None:
+                failed_csvs.append(parsed['csv']['file_path'].name)
+                span.add(errors=1)
+                print(parsed['error'])
+                print(f'Encountered error while copying {parsed["csv"]["file_path"].name}. Skipping this file.')
+                continue
+            ok_files.append(parsed)
+        span.add(files=len(ok_files), bytes=sum(p['byte_size'] for p in ok_files))
+
+    # Apply refreshes concurrently, one pooled connection per report and data year
+    if mode != 'append':
+        with ThreadPoolExecutor(max_workers=pool_size) as executor:
+            futures = [executor.submit(refresh_file_group, pool, source_obj['source_name'], parsed,
+                                       superseded[parsed['csv']['file_path'].name], mode, metrics)
+                       for parsed in ok_files]
+            for parsed, future in zip(ok_files, futures):
+                if not future.result():
+                    failed_csvs.append(parsed['csv']['file_path'].name)
+        raise_if_failed(failed_csvs)
+        return
+
+    # Group files by target table and column order so each group can share one COPY stream
+    groups = {}
+    for parsed in ok_files:
+        groups.setdefault((parsed['csv']['target_table'], parsed['cols']), []).append(parsed)
+
+    # COPY groups concurrently, one pooled connection per group
+    with ThreadPoolExecutor(max_workers=pool_size) as executor:
+        futures = [executor.submit(copy_file_group, pool, source_obj['source_name'], target_table, group, metrics)
+                   for (target_table, cols), group in groups.items()]
+        for group, future in zip(groups.values(), futures):
+            loaded = future.result()
+            for curr_csv_name in loaded:
+                print(f'INFO: Successfully ingested {curr_csv_name}.')
+            failed_csvs += [parsed['csv']['file_path'].name for parsed in group if parsed['csv']['file_path'].name not in loaded]
+    raise_if_failed(failed_csvs)
+
+
+# Load the csvs in raw_data/amazon. Standalone runs parse argv and create their own connection pool and run metrics;
+# run_pipeline.py passes in the s3 schema, connection pool and run metrics it shares between stages.
+def main(argv=None, schema=None, pool=None, metrics=None):
+
+    parser = argparse.ArgumentParser(description='Load Amazon report csvs into raw_amazon.')
+    parser.add_argument('--mode', choices=LOAD_MODES, default='append',
+                        help='How refresh files are applied to their data year (default: append)')
+    ingestion_utils.add_instrumentation_args(parser)
+    args = parser.parse_args(argv)
+
     # Constants
     AMAZON_CSV_PATH = Path(__file__).parent.parent / 'raw_data' / 'amazon'
     SOURCE = 'amazon'
     ROOT = Path(__file__).parent.parent
+    load_dotenv(ROOT / '.env')
+
+    # Run metrics are recorded in the warehouse when the script exits
+    if metrics is None:
+        metrics = ingestion_utils.start_run_metrics('ingest_amazon', args, ingestion_utils.get_conn_str(),
+                                                    profile_dir=ROOT / '.cache' / 'profiles')
 
     # Load current s3 schema which defines mapping between s3 partitions and warehouse tables
-    s3_schema_path = ROOT / 'ingestion' / 's3_schema.json'
-    with open(s3_schema_path, 'r') as f:
-        schema = json.load(f)
-    source_obj = next(s for s in schema["sources"] if s["source_name"] == "amazon")
+    if schema is None:
+        schema = ingestion_utils.load_s3_schema()
+    source_obj = next(s for s in schema["sources"] if s["source_name"] == SOURCE)
 
     csv_metadata = parse_csv_landing_dir(raw_csv_path=AMAZON_CSV_PATH, source_obj=source_obj)
-    ingest_amazon_csv_files(csv_metadata, source_obj)
\ No newline at end of file
+    ingest_amazon_csv_files(csv_metadata, source_obj, mode=args.mode, metrics=metrics, pool=pool)
+
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -0,0 +1,93 @@
+"""
+Loads the video bridge csv (raw_data/YT_Videos_Bridge.csv: video -> featured Amazon product, used by the dbt marts) into
+raw_youtube.videos_bridge.
+- The csv's columns are declared in s3_schema.json (source video_bridge) and its header is validated against them before loading
+- The table is replaced in one transaction, and only when the mapping changed, so wh_loaded_at (which the dbt marts use to detect a
+  new mapping) only moves when the mapping does
+- The load is timed and the run is recorded in ingestion_meta (see ingestion_utils.RunMetrics)
+- main() can also be called by run_pipeline.py, which passes in its shared s3 schema, connection pool and run metrics
+"""
+import argparse
+import csv
+from pathlib import Path
+from contextlib import nullcontext
+from dotenv import load_dotenv
+import ingestion_utils
+
+sql = ingestion_utils.lazy_import('psycopg.sql')
+psycopg_pool = ingestion_utils.lazy_import('psycopg_pool')
+
+
+# Video -> featured product (ASIN) pairs from the video bridge csv, one row per pair and in file order. Headers are matched
+# case-insensitively against the report's columns (s3_schema.json); a header missing any of them or carrying others raises ValueError.
+# Videos listed without an ASIN are kept with a NULL asin.
+def read_video_bridge(path, report_obj):
+    with open(path, 'r', newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        csv_headers = [col.strip().lower() for col in next(reader, []) if col.strip()]
+        missing_cols = [col for col in report_obj['cols'] if col not in csv_headers]
+        unexpected_cols = [col for col in csv_headers if col not in report_obj['cols']]
+        if missing_cols or unexpected_cols:
+            raise ValueError(f'ERROR: Invalid columns in {Path(path).name}: missing {missing_cols}, unexpected {unexpected_cols}. '
+                             f'Expected columns (s3_schema.json): {report_obj["cols"]}')
+        rows = [dict(zip(csv_headers, (value.strip() for value in values))) for values in reader]
+    return list(dict.fromkeys((row['youtube_id'], row.get('asin') or None) for row in rows if row.get('youtube_id')))
+
+
+# Replace the contents of the bridge table with the bridge csv's pairs in one transaction, unless they are unchanged.
+# Returns the number of pairs loaded, or None if the mapping was unchanged.
+def load_video_bridge(pool, path, source_obj, report_obj):
+    pairs = read_video_bridge(path, report_obj)
+    table = sql.Identifier(source_obj['target_wh_schema'], report_obj['target_wh_table'])
+    cols = sql.SQL(', ').join(sql.Identifier(col) for col in report_obj['cols'])
+    with pool.connection() as conn, conn.transaction(), conn.cursor() as cur:
+        cur.execute(sql.SQL("SELECT {} FROM {}").format(cols, table))
+        if set(cur.fetchall()) == set(pairs):
+            return None
+        cur.execute(sql.SQL("DELETE FROM {}").format(table))
+        with cur.copy(sql.SQL("COPY {} ({}) FROM STDIN").format(table, cols)) as copy:
+            for pair in pairs:
+                copy.write_row(pair)
+    return len(pairs)
+
+
+# Load the video bridge csv. Standalone runs parse argv and create their own connection pool and run metrics;
+# run_pipeline.py passes in the s3 schema, connection pool and run metrics it shares between stages.
+# Returns the number of pairs loaded, or None if the mapping was unchanged or the csv is missing.
+def main(argv=None, schema=None, pool=None, metrics=None):
+
+    # Constants
+    ROOT = Path(__file__).parent.parent
+    SOURCE = 'video_bridge'
+    VIDEOS_PATH = ROOT / 'raw_data' / 'YT_Videos_Bridge.csv'
+    load_dotenv(ROOT / '.env')
+
+    parser = argparse.ArgumentParser(description='Load the video bridge csv into raw_youtube.videos_bridge.')
+    ingestion_utils.add_instrumentation_args(parser)
+    args = parser.parse_args(argv)
+
+    # Run metrics are recorded in the warehouse when the script exits
+    conn_str = ingestion_utils.get_conn_str()
+    if metrics is None:
+        metrics = ingestion_utils.start_run_metrics('ingest_video_bridge', args, conn_str, profile_dir=ROOT / '.cache' / 'profiles')
+
+    # Load current s3 schema, which declares the bridge's columns and target table
+    if schema is None:
+        schema = ingestion_utils.load_s3_schema()
+    source_obj = next(s for s in schema['sources'] if s['source_name'] == SOURCE)
+    report_obj = source_obj['reports'][0]
+
+    if not VIDEOS_PATH.exists():
+        print(f'WARNING: Video bridge {VIDEOS_PATH} not found. Skipping the video bridge load.')
+        return None
+
+    with (nullcontext(pool) if pool is not None else psycopg_pool.ConnectionPool(conn_str, min_size=1, max_size=1)) as pool, \
+         ingestion_utils.metrics_span(metrics, 'load_bridge') as span:
+        pairs_loaded = load_video_bridge(pool, VIDEOS_PATH, source_obj, report_obj)
+        span.add(rows=pairs_loaded or 0)
+    print('INFO: Video bridge unchanged.' if pairs_loaded is None else f'INFO: Loaded {pairs_loaded} video bridge rows.')
+    return pairs_loaded
+
+
+if __name__ == '__main__':
+    main()
@@ -1,44 +1,60 @@
 """
 Idempotent load of YouTube Analytics API pulls from s3 into our "warehouse" (append-only).
-- Search the source=youtubeanalytics_v2 namespace in our s3 bucket for .parquet files.
-- Query warehouse tables in raw_youtube to prune files which have already been loaded.
-- For those which have not been loaded, server-side COPY into our db with metadata columns.
+- Search the source=youtubeanalytics_v2 namespace in our s3 bucket for .parquet files, listing only keys newer than a local listing index.
+- Check the load manifest (ingestion_meta.load_manifest) to prune files which have already been loaded.
+- Files whose checksum matches the newest file loaded for the report (e.g. a byte-identical re-landing) are recorded but not copied.
+- For those which have not been loaded, stream parquet record batches into our db via COPY (see copy_engine.py) with metadata columns.
+- Rows of raw snapshots deleted by retention (see compact_youtube.py) before they were loaded here, e.g. after init_db, are restored
+  from the compacted dataset.
+- Reports load concurrently (one pooled connection each) while upcoming files are downloaded and decoded ahead of COPY in a bounded worker pool.
+- Listing, manifest lookups, downloads and COPY are timed per report and the run is recorded in ingestion_meta (see ingestion_utils.RunMetrics).
+- main() can also be called by run_pipeline.py, which passes in its shared s3 schema, S3 client, connection pool and run metrics.
+- A file that fails to load is skipped so the others still load, but main() raises once every report has been attempted.
 """
-import json
+import argparse
 from pathlib import Path
-import os
-import pandas as pd
-import boto3
-import psycopg
-from psycopg import sql
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from io import BytesIO
 import datetime as dt
 from dotenv import load_dotenv
+from copy_engine import CopyEngine
+import ingestion_utils
+import fingerprint
+import load_manifest
 
+pa = ingestion_utils.lazy_import('pyarrow')
+pc = ingestion_utils.lazy_import('pyarrow.compute')
+pq = ingestion_utils.lazy_import('pyarrow.parquet')
+boto3 = ingestion_utils.lazy_import('boto3')
+psycopg_pool = ingestion_utils.lazy_import('psycopg_pool')
 
-# Given a source and report name, retrieve all load timestamps in our S3 bucket associated with this report
-def retrieve_report_timestamps(bucket_name, schema_name, source_name, report_name):
-    s3 = boto3.client('s3')
+
+# Given a source and report name, retrieve load timestamps in our S3 bucket associated with this report.
+# Keys sort by run timestamp (see ingestion_utils.generate_s3_key), so with start_after only runs landed after that key are listed.
+def retrieve_report_timestamps(bucket_name, schema_name, source_name, report_name, s3=None, start_after=None):
+    s3 = s3 or boto3.client('s3')
     c_token = None
     obj_list = []
 
     # Implement API pagination
     while True:
         kwargs = {'Bucket': bucket_name,
-                  'Prefix': f'{schema_name}/source={source_name}/report={report_name}'}
+                  'Prefix': f'{schema_name}/source={source_name}/report={report_name}/'}
+        if start_after:
+            kwargs['StartAfter'] = start_after
         if c_token:
             kwargs['ContinuationToken'] = c_token
 
         response = s3.list_objects_v2(**kwargs)
         
-        # Record all valid object keys and their corresponding run timestamps
-        for entry in response['Contents']:
-            key_list = entry['Key'].split('/')
-            for key in key_list:
-                if key.startswith('run_ts='):
-                    obj_list.append({'run_ts': key.lstrip('run_ts='),
-                                    's3_key': entry['Key']
-                                    })
+        # Record all valid object keys, their corresponding run timestamps and sizes. Empty listings have no 'Contents'.
+        for entry in response.get('Contents', []):
+            run = parse_run_key(entry['Key'])
+            if run is not None:
+                run['size'] = entry['Size']
+                obj_list.append(run)
                     
         if not response.get('IsTruncated'):
             break
@@ -47,83 +63,275 @@ def retrieve_report_timestamps(bucket_name, schema_name, source_name, report_nam
     return obj_list
 
 
-if __name__ == '__main__':
+# Parse the run timestamp out of a landed object's key; None for keys without a run_ts= partition
+def parse_run_key(s3_key):
+    for part in s3_key.split('/'):
+        if part.startswith('run_ts='):
+            return {'run_ts': part.removeprefix('run_ts='), 's3_key': s3_key}
+    return None
+
+
+# List a report's runs incrementally: runs already in the local listing index are reused, and S3 is only listed after the
+# newest indexed key. Without an index, the whole report prefix is listed.
+def discover_report_runs(s3, bucket_name, schema_name, source_name, report_name, listing_index=None):
+    if listing_index is None:
+        return retrieve_report_timestamps(bucket_name, schema_name, source_name, report_name, s3=s3)
+
+    prefix = f'{schema_name}/source={source_name}/report={report_name}/'
+    known_keys = listing_index.get(prefix)
+    new_runs = retrieve_report_timestamps(bucket_name, schema_name, source_name, report_name, s3=s3,
+                                          start_after=known_keys[-1] if known_keys else None)
+    listing_index.update(prefix, [run['s3_key'] for run in new_runs])
+    print(f'INFO: Listed {len(new_runs)} new objects for report {report_name} ({len(known_keys)} already indexed)')
+
+    return [run for run in map(parse_run_key, listing_index.get(prefix)) if run is not None]
+
+
+# Download and decode one landed parquet file, returning (table, byte size, sha256 checksum).
+# Runs in the prefetch pool so downloads and decoding overlap with COPY. The checksum is computed as the download streams in.
+def fetch_report_table(s3, bucket_name, s3_key, metrics=None, report_name=None):
+    with ingestion_utils.metrics_span(metrics, 'download', report_name) as span:
+        buf = BytesIO()
+        hashing_buf = fingerprint.HashingWriter(buf)
+        s3.download_fileobj(bucket_name, s3_key, hashing_buf)
+        byte_size = buf.tell()
+        span.add(files=1, bytes=byte_size)
+    with ingestion_utils.metrics_span(metrics, 'decode', report_name) as span:
+        buf.seek(0)
+        table = pq.read_table(buf)
+        span.add(rows=table.num_rows)
+    return table, byte_size, hashing_buf.hexdigest()
+
+
+# Yield (run, future of its decoded table) in run order. At most max_prefetch files are downloaded/decoded ahead of the consumer,
+# which caps memory no matter how many runs are pending.
+def prefetch_report_tables(executor, s3, bucket_name, runs, max_prefetch, metrics=None, report_name=None):
+    runs = deque(runs)
+    in_flight = deque()
+    while runs or in_flight:
+        while runs and len(in_flight) < max_prefetch:
+            run = runs.popleft()
+            in_flight.append((run, executor.submit(fetch_report_table, s3, bucket_name, run['s3_key'], metrics, report_name)))
+        yield in_flight.popleft()
+
+
+# Load every not-yet-loaded run of one report into its warehouse table over a connection borrowed from pool.
+# One transaction per file; on error (download, decode, validation or COPY), skip, print error message, and continue.
+# Returns (report name, CopyEngine, keys of the files that failed).
+def load_report(pool, s3, bucket_name, schema_name, source_obj, report_obj, prefetch_executor, max_prefetch, copy_batch_size, now,
+                listing_index=None, metrics=None):
+    copy_engine = CopyEngine()
+    report_name = report_obj['report_name']
+
+    # All runs (timestamp and s3 key) for current source, report
+    with ingestion_utils.metrics_span(metrics, 'list', report_name) as span:
+        all_runs = discover_report_runs(s3, bucket_name, schema_name, source_obj['source_name'], report_name, listing_index)
+        span.add(files=len(all_runs))
+
+    failed_keys, missing_keys = [], set()
+    with pool.connection() as conn:
+        # Look up files (identified by S3 key) already loaded for this report in the load manifest
+        with ingestion_utils.metrics_span(metrics, 'manifest_lookup', report_name):
+            loaded_keys = load_manifest.fetch_loaded_keys(conn, source_obj['source_name'], report_name)
+            latest_ts, latest_checksum = load_manifest.fetch_latest_checksum(conn, source_obj['source_name'], report_name)
+        print(f'Found {len(loaded_keys)} files already loaded for report {report_obj["report_name"]}')
+
+        # Perform server-side copy for runs not yet loaded into the target warehouse table
+        pending_runs = [run for run in all_runs if run['s3_key'] not in loaded_keys]
+        for run, table_future in prefetch_report_tables(prefetch_executor, s3, bucket_name, pending_runs, max_prefetch, metrics, report_name):
+            with ingestion_utils.metrics_span(metrics, 'load_file', report_name) as file_span:
+                try:
+                    table, byte_size, checksum = table_future.result()
+                    run_ts = dt.datetime.strptime(run['run_ts'], "%Y%m%d%H%M%S").replace(tzinfo=dt.timezone.utc)
+
+                    # Byte-identical to the newest file loaded, so loading it would change nothing: record it with no rows so it is
+                    # not fetched again
+                    if load_manifest.is_latest_duplicate(run_ts, checksum, latest_ts, latest_checksum):
+                        with conn.transaction():
+                            with conn.cursor() as cur:
+                                load_manifest.record_load(cur, source_obj['source_name'], report_obj['report_name'], run['s3_key'],
+                                                          run_ts, 0, byte_size, checksum, 'duplicate')
+                        print(f'INFO: Contents of {run["s3_key"]} already loaded (sha256 {checksum}). Skipping COPY.')
+                        file_span.add(files=1, files_duplicate=1)
+                        continue
+
+                    # Enforce columns are as expected (s3_schema.json); each distinct file schema is only checked once
+                    copy_engine.validate_columns(table.schema.names, report_obj['cols'], metadata_cols=['s3_run_ts', 'wh_loaded_at'])
+
+                    with conn.transaction():
+                        with conn.cursor() as cur:
+                            # Stream record batches into a server-side copy, adding metadata columns as constant columns
+                            rows_copied = copy_engine.copy_batches(cur,
+                                                                   source_obj['target_wh_schema'],
+                                                                   report_obj['target_wh_table'],
+                                                                   table.to_batches(max_chunksize=copy_batch_size),
+                                                                   constants={'s3_run_ts': run_ts, 'wh_loaded_at': now})
+
+                            # Record the file in the load manifest within the same transaction as its COPY
+                            load_manifest.record_load(cur, source_obj['source_name'], report_obj['report_name'], run['s3_key'],
+                                                      run_ts, rows_copied, byte_size, checksum, 'append')
+
+                    if latest_ts is None or run_ts >= latest_ts:
+                        latest_ts, latest_checksum = run_ts, checksum
+                    file_span.add(files=1, rows=rows_copied, bytes=byte_size)
+                    print(f'Successfully copied {rows_copied} rows for report:\n {report_obj}\n From S3 file:\n{run}')
+
+                except Exception as e:
+                    # Deleted since it was indexed (e.g. by retention from another host): drop it from the listing index and leave
+                    # its rows to the compacted dataset
+                    if ingestion_utils.get_error_status(e) == 404:
+                        missing_keys.add(run['s3_key'])
+                        if listing_index is not None:
+                            listing_index.remove(f'{schema_name}/source={source_obj["source_name"]}/report={report_name}/', [run['s3_key']])
+                        print(f'WARNING: {run["s3_key"]} no longer exists in S3. Removed it from the listing index.')
+                        continue
+                    failed_keys.append(run['s3_key'])
+                    file_span.add(errors=1)
+                    if metrics is not None:
+                        metrics.log('load_error', report=report_name, s3_key=run['s3_key'], error=str(e))
+                    print(f'Encountered error while copying.\nReport: {report_obj}\n File: {run}\n Skipping this file.')
+                    print(f'Error details: {e}')
+
+        # Rows whose raw snapshots are gone and were never loaded into this warehouse
+        raw_keys = [run['s3_key'] for run in all_runs if run['s3_key'] not in missing_keys]
+        failed_keys += load_compacted_files(conn, s3, bucket_name, source_obj, report_obj, raw_keys, loaded_keys,
+                                            prefetch_executor, max_prefetch, copy_batch_size, now, copy_engine, metrics)
+
+    # Time spent inside COPY (serialising batches to csv and streaming them to the server), as measured by the engine
+    if metrics is not None:
+        metrics.record('copy', report_name, copy_engine.seconds, rows=copy_engine.rows, bytes=copy_engine.bytes)
+    return report_obj['report_name'], copy_engine, failed_keys
+
+
+# Restore rows from a report's compacted dataset (compacted/, see compact_youtube.py) whose raw snapshots were deleted by retention
+# without being loaded into this warehouse. Rows of runs that are already loaded or restored, or still landed under raw/ (raw_keys,
+# loaded by load_report), are dropped.
+# Each version of a day file is recorded in the load manifest as '<key>@<ETag>', so unchanged files are not downloaded again but a
+# file rewritten by a later compaction is read again. Restored runs are recorded under their raw key once every file has been read,
+# so rewritten files do not restore them twice. Returns the keys of the files that failed.
+def load_compacted_files(conn, s3, bucket_name, source_obj, report_obj, raw_keys, loaded_keys, prefetch_executor, max_prefetch,
+                         copy_batch_size, now, copy_engine, metrics=None):
+    report_name = report_obj['report_name']
+    with ingestion_utils.metrics_span(metrics, 'list', report_name) as span:
+        compacted_files = [{**obj, 'version_key': f'{obj["s3_key"]}@{obj["etag"]}'}
+                           for obj in ingestion_utils.iter_s3_objects(s3, bucket_name,
+                                                                      f'compacted/source={source_obj["source_name"]}/report={report_name}/')]
+        compacted_files = [obj for obj in compacted_files if obj['version_key'] not in loaded_keys]
+        span.add(files=len(compacted_files))
+
+    skip_keys = set(raw_keys) | set(loaded_keys)
+    restored_runs, failed_keys = {}, []
+    for obj, table_future in prefetch_report_tables(prefetch_executor, s3, bucket_name, compacted_files, max_prefetch, metrics, report_name):
+        with ingestion_utils.metrics_span(metrics, 'load_file', report_name) as file_span:
+            try:
+                table, byte_size, checksum = table_future.result()
+                copy_engine.validate_columns(table.schema.names, report_obj['cols'], metadata_cols=['s3_run_ts', 'wh_loaded_at'])
+
+                # Keep the rows of runs whose raw snapshot is neither loaded nor still landed
+                run_ts_values = pc.unique(table['s3_run_ts']).to_pylist()
+                run_keys = {ts: ingestion_utils.generate_s3_key('raw', ts, source_obj['api_name'], source_obj['api_version'], report_name,
+                                                                '.parquet')
+                            for ts in run_ts_values}
+                restore_ts = [ts for ts in run_ts_values if run_keys[ts] not in skip_keys]
+                table = table.filter(pc.is_in(table['s3_run_ts'], value_set=pa.array(restore_ts, type=table.schema.field('s3_run_ts').type)))
+
+                with conn.transaction():
+                    with conn.cursor() as cur:
+                        rows_copied = copy_engine.copy_batches(cur,
+                                                               source_obj['target_wh_schema'],
+                                                               report_obj['target_wh_table'],
+                                                               table.to_batches(max_chunksize=copy_batch_size),
+                                                               constants={'wh_loaded_at': now})
+                        load_manifest.record_load(cur, source_obj['source_name'], report_name, obj['version_key'],
+                                                  max(run_ts_values, default=None), rows_copied, byte_size, checksum, 'restore')
+
+                for entry in pc.value_counts(table['s3_run_ts']).to_pylist():
+                    restored_run = restored_runs.setdefault(run_keys[entry['values']], [entry['values'], 0])
+                    restored_run[1] += entry['counts']
+                file_span.add(files=1, rows=rows_copied, bytes=byte_size)
+                if rows_copied:
+                    print(f'INFO: Restored {rows_copied} rows of {len(restore_ts)} expired runs of {report_name} from {obj["s3_key"]}')
+
+            except Exception as e:
+                failed_keys.append(obj['s3_key'])
+                file_span.add(errors=1)
+                if metrics is not None:
+                    metrics.log('load_error', report=report_name, s3_key=obj['s3_key'], error=str(e))
+                print(f'Encountered error while restoring compacted rows.\nReport: {report_obj}\n File: {obj}\n Skipping this file.')
+                print(f'Error details: {e}')
+
+    # Recorded only when every file was read, so a run with rows in a file that failed is still restored from it next time
+    if restored_runs and not failed_keys:
+        with conn.transaction(), conn.cursor() as cur:
+            for raw_key, (run_ts, row_count) in restored_runs.items():
+                load_manifest.record_load(cur, source_obj['source_name'], report_name, raw_key, run_ts, row_count, None, None, 'restore')
+    return failed_keys
+
+
+# Load every report's pending runs. Standalone runs parse argv and create their own S3 client, connection pool and run metrics;
+# run_pipeline.py passes in the ones it shares between stages. Returns {report_name: CopyEngine summary}.
+# Raises RuntimeError if any file failed to load (after every other file has been loaded), so callers do not treat the run as complete.
+def main(argv=None, schema=None, s3=None, pool=None, metrics=None):
 
     # Constants
     ROOT = Path(__file__).parent.parent
     BUCKET = 'affiliate-youtube-project'
     S3_SCHEMA = 'raw'
+    COPY_BATCH_SIZE = 65_536
+    PREFETCH_WORKERS = 4
+    MAX_PREFETCH = 4
+    LISTING_INDEX_PATH = ROOT / '.cache' / 's3_listing_index.json'
     load_dotenv(ROOT / '.env')
 
+    parser = argparse.ArgumentParser(description='Load landed YouTube Analytics reports from S3 into raw_youtube.')
+    parser.add_argument('--full-listing', action='store_true',
+                        help='Ignore the local listing index and list every landed object again.')
+    ingestion_utils.add_instrumentation_args(parser)
+    args = parser.parse_args(argv)
+
     # Load current s3 schema which defines mapping between s3 partitions and warehouse tables
-    s3_schema_path = ROOT / 'ingestion' / 's3_schema.json'
-    with open(s3_schema_path, 'r') as f:
-        schema = json.load(f)
-    print(schema)
+    if schema is None:
+        schema = ingestion_utils.load_s3_schema()
+        print(schema)
     
-    s3 = boto3.client('s3')
+    s3 = s3 or boto3.client('s3')
     now = dt.datetime.now(dt.timezone.utc)
+
+    # Run metrics are recorded in the warehouse when the script exits
+    conn_str = ingestion_utils.get_conn_str()
+    if metrics is None:
+        metrics = ingestion_utils.start_run_metrics('ingest_youtube', args, conn_str, profile_dir=ROOT / '.cache' / 'profiles')
     
+    # Start from the persisted listing index unless a full listing is requested; it is saved again once all reports are listed
+    listing_index = ingestion_utils.S3ListingIndex(LISTING_INDEX_PATH, reset=args.full_listing)
+
     # Source has 1:many relationship with reports. Each report maps to a target table in the corresponding source's schema.
+    # Reports are listed and loaded concurrently, each over its own pooled connection; downloads for all reports share one prefetch pool.
+    report_jobs = []
     for source_obj in schema['sources']:
         # Not currently implemented for amazon
         if source_obj['source_name'] != 'youtubeanalytics_v2':
             continue
+        report_jobs.extend((source_obj, report_obj) for report_obj in source_obj['reports'])
 
-        for report_obj in source_obj['reports']:
-            
-            # All runs (timestamp and s3 key) for current source, report
-            all_runs = retrieve_report_timestamps(BUCKET, S3_SCHEMA, source_obj['source_name'], report_obj['report_name'])
-
-            # Scan corresponding warehouse table for existing timestamps
-            host, port = os.environ.get("PGHOST"), os.environ.get("PGPORT")
-            dbname, user, password = os.environ.get("PGDATABASE"), os.environ.get("PGUSER"), os.environ.get("PGPASSWORD")
-            conn_str = f"host={host} port={port} dbname={dbname} user={user} password={password}"
-
-            with psycopg.connect(conn_str) as conn:
-                # Scan relevant warehouse table for files (identified by s3_run_ts timestamp) already present for this table
-                with conn.cursor() as cur:
-                        cur.execute(sql.SQL("SELECT DISTINCT s3_run_ts FROM {}")
-                                    .format(sql.Identifier(source_obj['target_wh_schema'], report_obj['target_wh_table'])))
-                        found_ts = [val[0].strftime("%Y%m%d%H%M%S") for val in cur.fetchall()]
-                        print(found_ts)
-                print(f'Found the following timestamps for report {report_obj}: {found_ts}')
-                
-                # Perform server-side copy for runs not yet loaded into the target warehouse table
-                # One transaction per file; on error, skip, print error message, and continue
-                for run in all_runs:
-                    if run['run_ts'] in found_ts:
-                        continue
-                    try: 
-                        with conn.transaction():
-                            with conn.cursor() as cur:
-                                # Download the s3 object associated with this key
-                                buf = BytesIO()
-                                parquet_file = s3.download_fileobj(BUCKET, run['s3_key'], buf)
-                                buf.seek(0)
-
-                                # Add metadata columns and convert df to iterable of tuples
-                                df = pd.read_parquet(buf)
-                                df['s3_run_ts'] = dt.datetime.strptime(run['run_ts'], "%Y%m%d%H%M%S").replace(tzinfo=dt.timezone.utc)
-                                df['wh_loaded_at'] = now
-                                df_fmt = list(df.itertuples(index=False, name=None))
-
-                                # Enforce columns are as expected (s3_schema.json)
-                                for col in df.columns:
-                                    if col not in report_obj['cols']:
-                                        if col not in ['s3_run_ts', 'wh_loaded_at']:
-                                            raise ValueError(f'Read unexpected column {col} from file {run}. Aborting copy operation.')
-                                        
-                                # Perform server-side copy. Specify column ordering for safety      
-                                with cur.copy(sql.SQL('COPY {} ({}) FROM STDIN').format(
-                                    sql.Identifier(source_obj['target_wh_schema'], report_obj['target_wh_table']),
-                                    sql.SQL(',').join(sql.Identifier(c) for c in df.columns))) as copy:
-                                    for record in df_fmt:
-                                        copy.write_row(record)
-
-                                print(f'Successfully copied report:\n {report_obj}\n From S3 file:\n{run}')
-
-
-                    except Exception as e:
-                        print(f'Encountered error while copying.\nReport: {report_obj}\n File: {run}\n Skipping this file.')
-                        print(f'Error details: {e}')
\ No newline at end of file
+    summaries, failed_keys = {}, []
+    with (nullcontext(pool) if pool is not None else psycopg_pool.ConnectionPool(conn_str, min_size=1, max_size=max(1, len(report_jobs)))) as pool, \
+         ThreadPoolExecutor(max_workers=PREFETCH_WORKERS) as prefetch_executor, \
+         ThreadPoolExecutor(max_workers=max(1, len(report_jobs))) as report_executor:
+        futures = [report_executor.submit(load_report, pool, s3, BUCKET, S3_SCHEMA, source_obj, report_obj,
+                                          prefetch_executor, MAX_PREFETCH, COPY_BATCH_SIZE, now, listing_index, metrics)
+                   for source_obj, report_obj in report_jobs]
+        for future in futures:
+            report_name, copy_engine, report_failed_keys = future.result()
+            failed_keys += report_failed_keys
+            summaries[report_name] = copy_engine.summary()
+            print(f'INFO: Finished loading {report_name}: {summaries[report_name]}')
+
+    listing_index.save()
+    if failed_keys:
+        raise RuntimeError(f'{len(failed_keys)} file(s) failed to load and will be retried on the next run: {failed_keys}')
+    return summaries
+
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -2,7 +2,65 @@
 Utility functions applicable to several scripts in the ingestion step for this project.
 """
 
+import atexit
+import cProfile
 import datetime as dt
+import email.utils
+import importlib
+import io
+import pstats
+import socket
+import sys
+import tracemalloc
+import uuid
+from collections import deque
+from concurrent import futures
+from pathlib import Path
+import json
+import os
+import random
+import threading
+import time
+from functools import wraps
+
+
+# Stand-in for a module that is only imported on first attribute access, so scripts (and tests importing them) only pay for heavy
+# dependencies such as pandas, boto3, psycopg or googleapiclient on the code paths that actually use them.
+# Use as `pd = ingestion_utils.lazy_import('pandas')` in place of `import pandas as pd`.
+class LazyModule:
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attr):
+        if self.__dict__['_module'] is None:
+            self.__dict__['_module'] = importlib.import_module(self.__dict__['_name'])
+        return getattr(self.__dict__['_module'], attr)
+
+    def __repr__(self):
+        return f"<lazy module '{self.__dict__['_name']}'>"
+
+
+def lazy_import(name):
+    return LazyModule(name)
+
+
+psycopg = lazy_import('psycopg')
+sql = lazy_import('psycopg.sql')
+psycopg_json = lazy_import('psycopg.types.json')
+
+# libpq connection string for the project database, built from the PG* environment variables (loaded from .env by the caller)
+def get_conn_str():
+    host, port = os.environ.get("PGHOST"), os.environ.get("PGPORT")
+    dbname, user, password = os.environ.get("PGDATABASE"), os.environ.get("PGUSER"), os.environ.get("PGPASSWORD")
+    return f"host={host} port={port} dbname={dbname} user={user} password={password}"
+
+
+# Current s3 schema (ingestion/s3_schema.json), which defines each source's reports, columns and warehouse tables
+def load_s3_schema():
+    with open(Path(__file__).parent / 's3_schema.json', 'r') as f:
+        return json.load(f)
+
 
 # For consistent key structure across sources
 def generate_s3_key(schema, run_timestamp, source, api_version, report, format):
@@ -15,4 +73,567 @@ def generate_s3_key(schema, run_timestamp, source, api_version, report, format):
     run_timestamp_str = run_timestamp.strftime("%Y%m%d%H%M%S")
     filename = f'data{format}'
 
-    return f'{schema}/source={source}/report={report}/run_ts={run_timestamp_str}/{filename}'
\ No newline at end of file
+    return f'{schema}/source={source}/report={report}/run_ts={run_timestamp_str}/{filename}'
+
+
+# Key for small pipeline state objects (e.g. watermarks) kept next to, but outside of, the raw data namespace
+def generate_s3_state_key(source, api_version, name):
+
+    if isinstance(api_version, str):
+        source = f'{source}_{api_version}'
+
+    return f'state/source={source}/{name}'
+
+
+# Key for one day's partition of a report's compacted dataset (latest row per key, see compact_youtube.py)
+def generate_s3_compacted_key(source, api_version, report, day):
+
+    if isinstance(api_version, str):
+        source = f'{source}_{api_version}'
+
+    return f'compacted/source={source}/report={report}/day={day}/data.parquet'
+
+
+# Key for an object of a sharded backfill (plan, shard data, checkpoints; see backfill_youtube.py), kept outside of the raw data
+# namespace until the shards are merged into a standard generate_s3_key snapshot
+def generate_s3_backfill_key(source, api_version, backfill_id, name):
+
+    if isinstance(api_version, str):
+        source = f'{source}_{api_version}'
+
+    return f'backfill/source={source}/backfill_id={backfill_id}/{name}'
+
+
+# All objects (key, size and ETag) under an S3 prefix, in key order
+def iter_s3_objects(s3, bucket_name, prefix):
+    c_token = None
+    while True:
+        kwargs = {'Bucket': bucket_name, 'Prefix': prefix}
+        if c_token:
+            kwargs['ContinuationToken'] = c_token
+        response = s3.list_objects_v2(**kwargs)
+        for entry in response.get('Contents', []):
+            yield {'s3_key': entry['Key'], 'size': entry['Size'], 'etag': entry['ETag'].strip('"')}
+        if not response.get('IsTruncated'):
+            break
+        c_token = response.get('NextContinuationToken')
+
+
+# JSON state object (watermarks, fingerprints, plans, checkpoints, ...) stored in S3, or default if it does not exist yet
+def read_s3_json(s3, bucket_name, key, default=None):
+    try:
+        response = s3.get_object(Bucket=bucket_name, Key=key)
+    except s3.exceptions.NoSuchKey:
+        return default
+    return json.loads(response['Body'].read())
+
+
+# Write a JSON state object to S3. Objects meant to be read by people pass an indent; without one the JSON is written compactly.
+def write_s3_json(s3, bucket_name, key, obj, indent=None):
+    separators = None if indent is not None else (',', ':')
+    s3.put_object(Bucket=bucket_name, Key=key, Body=json.dumps(obj, indent=indent, separators=separators).encode('utf8'))
+
+
+# Local, persisted index of the object keys already listed under each S3 prefix. Because generate_s3_key produces keys that sort by
+# run timestamp, a later listing only needs to start after the newest indexed key (list_objects_v2 StartAfter).
+class S3ListingIndex:
+    # With reset=True the persisted index is ignored (and overwritten on save), forcing a full listing
+    def __init__(self, path, reset=False):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._keys = {}
+        if not reset:
+            try:
+                with open(self.path, 'r', encoding='utf8') as f:
+                    self._keys = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                pass
+
+    # All indexed keys under this prefix, in sorted order
+    def get(self, prefix):
+        with self._lock:
+            return list(self._keys.get(prefix, []))
+
+    def update(self, prefix, keys):
+        with self._lock:
+            self._keys[prefix] = sorted(set(self._keys.get(prefix, [])) | set(keys))
+
+    # Drop keys that no longer exist in S3 (e.g. after compaction or retention)
+    def remove(self, prefix, keys):
+        with self._lock:
+            keys = set(keys)
+            self._keys[prefix] = [key for key in self._keys.get(prefix, []) if key not in keys]
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f'{self.path.name}.tmp')
+        with self._lock:
+            with open(tmp_path, 'w', encoding='utf8') as f:
+                json.dump(self._keys, f, indent=4)
+            os.replace(tmp_path, self.path)
+
+
+# Classification of API errors used by call_with_retry
+THROTTLED, RETRYABLE, FATAL = 'throttled', 'retryable', 'fatal'
+RETRYABLE_STATUS_CODES = {408, 500, 502, 503, 504}
+THROTTLE_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded', 'RequestLimitExceeded', 'SlowDown', 'Throttling'}
+QUOTA_REASONS = {'quotaExceeded', 'dailyLimitExceeded'}
+PROGRAMMING_ERRORS = (TypeError, ValueError, KeyError, IndexError, AttributeError, NameError, AssertionError)
+
+
+# HTTP status code carried by an exception from googleapiclient (e.resp), botocore (e.response dict) or requests (e.response), if any
+def get_error_status(e):
+    resp = getattr(e, 'resp', None)
+    if resp is not None and getattr(resp, 'status', None) is not None:
+        return int(resp.status)
+    response = getattr(e, 'response', None)
+    if isinstance(response, dict):
+        return response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return getattr(response, 'status_code', None)
+
+
+# Error reasons reported in the body of a Google API error (e.g. quotaExceeded) or the code of a botocore error (e.g. SlowDown)
+def get_error_reasons(e):
+    reasons = set()
+    for detail in getattr(e, 'error_details', None) or []:
+        if isinstance(detail, dict) and 'reason' in detail:
+            reasons.add(detail['reason'])
+    content = getattr(e, 'content', None)
+    if content:
+        try:
+            for entry in json.loads(content).get('error', {}).get('errors', []):
+                reasons.add(entry.get('reason'))
+        except (ValueError, AttributeError):
+            pass
+    response = getattr(e, 'response', None)
+    if isinstance(response, dict):
+        reasons.add(response.get('Error', {}).get('Code'))
+    reasons.discard(None)
+    return reasons
+
+
+# Sort an exception into THROTTLED (slow down, then retry), RETRYABLE (transient, retry) or FATAL (retrying cannot help).
+# Exhausted daily quotas are fatal so the run stops immediately instead of stalling on retries that cannot succeed.
+def classify_error(e):
+    status, reasons = get_error_status(e), get_error_reasons(e)
+    if reasons & QUOTA_REASONS:
+        return FATAL
+    if status == 429 or reasons & THROTTLE_REASONS:
+        return THROTTLED
+    if status is not None:
+        return RETRYABLE if status in RETRYABLE_STATUS_CODES else FATAL
+    return FATAL if isinstance(e, PROGRAMMING_ERRORS) else RETRYABLE
+
+
+# Seconds requested by a Retry-After header (either delta-seconds or an HTTP date), or None if the error carries no such header
+def get_retry_after(e):
+    headers = getattr(e, 'resp', None)
+    response = getattr(e, 'response', None)
+    if isinstance(response, dict):
+        headers = response.get('ResponseMetadata', {}).get('HTTPHeaders')
+    elif response is not None and hasattr(response, 'headers'):
+        headers = response.headers
+    if not hasattr(headers, 'get'):
+        return None
+
+    value = headers.get('retry-after') or headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0.0, (retry_at - dt.datetime.now(dt.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+# Token bucket shared by concurrent API callers. Starts at `rate` requests per second and adapts (AIMD): each success nudges the
+# rate up towards max_rate, each throttling response halves it (down to min_rate) and can pause every caller for a Retry-After period.
+class AdaptiveTokenBucket:
+    def __init__(self, rate, max_rate=None, min_rate=0.1, burst=1, increase_step=0.1):
+        self.rate = rate
+        self.max_rate = max_rate if max_rate is not None else rate
+        self.min_rate = min_rate
+        self.burst = burst
+        self.increase_step = increase_step
+        self._tokens = burst
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    # Block until the caller may make its next request
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._paused_until:
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+                    self._updated_at = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+                else:
+                    wait = self._paused_until - now
+            time.sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def on_throttle(self, retry_after=None):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = 0
+            self._updated_at = time.monotonic()
+            if retry_after:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+
+# Thread-safe per-function counters for calls made through call_with_retry: calls, attempts, retries, failures and latency
+class CallStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, name, attempts, latency, succeeded):
+        with self._lock:
+            entry = self._stats.setdefault(name, {'calls': 0, 'attempts': 0, 'retries': 0, 'failures': 0,
+                                                  'total_latency_s': 0.0, 'max_latency_s': 0.0})
+            entry['calls'] += 1
+            entry['attempts'] += attempts
+            entry['retries'] += attempts - 1
+            entry['failures'] += 0 if succeeded else 1
+            entry['total_latency_s'] += latency
+            entry['max_latency_s'] = max(entry['max_latency_s'], latency)
+
+    def summary(self):
+        with self._lock:
+            return {name: {**entry, 'mean_latency_s': entry['total_latency_s'] / entry['calls']}
+                    for name, entry in self._stats.items()}
+
+
+# Call func, retrying retryable and throttled errors with exponential backoff and full jitter (capped at max_sleep).
+# A Retry-After header sets the minimum wait. If a limiter (AdaptiveTokenBucket) is given, a token is taken before every attempt
+# and throttling is reported to it so that all callers sharing it back off together. Fatal errors are raised immediately.
+def call_with_retry(func, args=(), kwargs=None, num_retries=3, base_sleep=1, max_sleep=60, limiter=None, stats=None):
+    kwargs = kwargs or {}
+    started_at = time.monotonic()
+    for attempt in range(1, num_retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            kind = classify_error(e)
+            retry_after = get_retry_after(e)
+            if kind == THROTTLED and limiter is not None:
+                limiter.on_throttle(retry_after)
+
+            if kind == FATAL or attempt == num_retries:
+                if stats is not None:
+                    stats.record(func.__name__, attempt, time.monotonic() - started_at, succeeded=False)
+                print(f'ERROR: {func.__name__} failed with a {kind} error on attempt {attempt} of {num_retries}. Not retrying.')
+                raise e
+
+            sleep_time = random.uniform(0, min(max_sleep, base_sleep * 2 ** (attempt - 1)))
+            if retry_after is not None:
+                sleep_time = max(sleep_time, min(max_sleep, retry_after))
+            print(f'ERROR: {func.__name__} failed with arguments {args}, {kwargs} on attempt {attempt} ({kind}). Waiting {sleep_time:.1f} seconds before retry. \nError: {e}')
+            time.sleep(sleep_time)
+        else:
+            if limiter is not None:
+                limiter.on_success()
+            if stats is not None:
+                stats.record(func.__name__, attempt, time.monotonic() - started_at, succeeded=True)
+            return result
+
+
+# Decorator form of call_with_retry for functions whose retry settings are known at definition time
+def retry(num_retries=3, base_sleep=1, max_sleep=60, limiter=None, stats=None):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return call_with_retry(func, args, kwargs, num_retries, base_sleep, max_sleep, limiter, stats)
+        return wrapper
+    return decorator
+
+
+# Write-only file-like object that streams its contents to S3 as a multipart upload, so the full object never has to be held in memory.
+# Parts of part_size bytes are uploaded on `executor` (if given) while the caller keeps writing. At most max_in_flight parts are
+# queued or uploading at once; write() blocks until one finishes, so memory stays bounded when S3 is slower than the caller.
+# Objects smaller than one part are sent with a single put_object. close() completes the upload; abort() discards it.
+class S3MultipartWriter:
+    def __init__(self, s3, bucket, key, part_size=8 * 1024 ** 2, executor=None, max_in_flight=2):
+        if part_size < 5 * 1024 ** 2:
+            raise ValueError(f'S3 multipart parts must be at least 5 MiB, got {part_size} bytes.')
+        self.s3, self.bucket, self.key = s3, bucket, key
+        self.part_size = part_size
+        self.executor = executor
+        self.max_in_flight = max_in_flight
+        self.bytes_written = 0
+        self.closed = False
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+        self._in_flight = deque()
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.bytes_written
+
+    def flush(self):
+        pass
+
+    def write(self, data):
+        self._buffer += data
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def _upload_part(self, body):
+        if self._upload_id is None:
+            self._upload_id = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        part_number = len(self._parts) + 1
+        kwargs = {'Bucket': self.bucket, 'Key': self.key, 'UploadId': self._upload_id, 'PartNumber': part_number, 'Body': body}
+        if self.executor is not None:
+            while len(self._in_flight) >= self.max_in_flight:
+                self._in_flight.popleft().result()
+            future = self.executor.submit(self.s3.upload_part, **kwargs)
+            self._in_flight.append(future)
+            self._parts.append((part_number, future))
+        else:
+            self._parts.append((part_number, self.s3.upload_part(**kwargs)))
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._upload_id is None:
+                self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer))
+            else:
+                if self._buffer:
+                    self._upload_part(bytes(self._buffer))
+                parts = [{'PartNumber': n, 'ETag': (r.result() if hasattr(r, 'result') else r)['ETag']} for n, r in self._parts]
+                self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                                  MultipartUpload={'Parts': parts})
+                self._upload_id = None
+        except Exception:
+            self.abort()
+            raise
+        self._buffer = bytearray()
+        self.closed = True
+
+    def abort(self):
+        if self._upload_id is not None:
+            # Let in-flight parts settle first so none are left behind after the abort
+            futures.wait([r for _, r in self._parts if hasattr(r, 'result')])
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+            self._upload_id = None
+        self._buffer = bytearray()
+        self.closed = True
+
+
+# Counters with their own column in ingestion_meta.stage_metrics; any other counter is kept in its counters jsonb column
+STAGE_METRIC_COLUMNS = ('rows', 'bytes', 'api_calls', 'retries', 'errors')
+METRICS_TABLES = {'runs': ('ingestion_meta', 'pipeline_runs'), 'stages': ('ingestion_meta', 'stage_metrics')}
+PROFILERS = ('cprofile', 'tracemalloc')
+
+
+# Timing span for one stage (and optionally one report) of a run. Counters added while it is open are recorded with its duration
+# when it closes, and a span that exits with an exception counts as an error. A span without metrics records nothing.
+class Span:
+    def __init__(self, metrics, stage, report=None):
+        self.metrics, self.stage, self.report = metrics, stage, report
+        self.counters = {}
+        self.seconds = 0.0
+
+    def add(self, **counters):
+        for name, value in counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def __enter__(self):
+        self._started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.seconds = time.perf_counter() - self._started_at
+        if exc_type is not None:
+            self.add(errors=1)
+        if self.metrics is not None:
+            self.metrics.record(self.stage, self.report, self.seconds, status='failed' if exc_type else 'ok', **self.counters)
+        return False
+
+
+# Span on metrics, or a span that is discarded when the caller is not collecting metrics
+def metrics_span(metrics, stage, report=None):
+    return metrics.span(stage, report) if metrics is not None else Span(None, stage, report)
+
+
+# Timing spans and counters for one run of an ingestion script, aggregated per (stage, report). Thread-safe.
+# - Every closed span (and direct record() call) is also written as one JSON line to log_path ('-' for stdout), if given
+# - profile='cprofile' profiles the main thread and 'tracemalloc' traces Python allocations in every thread; results are printed
+#   (and the cProfile stats saved to profile_dir) when the run is closed
+# - close() writes the run to ingestion_meta.pipeline_runs and its stages to ingestion_meta.stage_metrics
+class RunMetrics:
+    def __init__(self, pipeline, args=None, log_path=None, profile=None, profile_dir=None):
+        if profile is not None and profile not in PROFILERS:
+            raise ValueError(f'Unsupported profiler {profile}. Choose from {PROFILERS}.')
+        self.run_id = uuid.uuid4()
+        self.pipeline = pipeline
+        self.args = args or {}
+        self.started_at = dt.datetime.now(dt.timezone.utc)
+        self.finished_at = None
+        self.status = 'running'
+        self.error = None
+        self.counters = {}
+        self.profile = profile
+        self.profile_dir = Path(profile_dir) if profile_dir else None
+        self._stages = {}
+        self._lock = threading.Lock()
+        self._profiler = None
+        self._closed = False
+        self._log = None
+        if log_path == '-':
+            self._log = sys.stdout
+        elif log_path:
+            Path(log_path).parent.mkdir(parents=True, exist_ok=True)
+            self._log = open(log_path, 'a', encoding='utf8')
+        self.log('run_start', args=self.args)
+
+    def span(self, stage, report=None):
+        return Span(self, stage, report)
+
+    # Record a duration measured elsewhere (e.g. CopyEngine.seconds) and/or counters for a stage
+    def record(self, stage, report=None, seconds=0.0, status='ok', **counters):
+        with self._lock:
+            entry = self._stages.setdefault((stage, report or ''), {'spans': 0, 'total_seconds': 0.0, 'max_seconds': 0.0, 'counters': {}})
+            entry['spans'] += 1
+            entry['total_seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+            for name, value in counters.items():
+                entry['counters'][name] = entry['counters'].get(name, 0) + value
+        self.log('span', stage=stage, report=report, seconds=round(seconds, 6), status=status, **counters)
+
+    # Write one structured (JSON) log line for an event of this run
+    def log(self, event, **fields):
+        if self._log is None:
+            return
+        line = json.dumps({'ts': dt.datetime.now(dt.timezone.utc).isoformat(), 'run_id': str(self.run_id), 'pipeline': self.pipeline,
+                           'event': event, **fields}, default=str)
+        with self._lock:
+            self._log.write(line + '\n')
+            self._log.flush()
+
+    # Aggregated spans and counters, one dict per (stage, report)
+    def summary(self):
+        with self._lock:
+            return [{'stage': stage, 'report': report, **{k: v for k, v in entry.items() if k != 'counters'}, **entry['counters']}
+                    for (stage, report), entry in self._stages.items()]
+
+    def start_profiling(self):
+        if self.profile == 'cprofile':
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        elif self.profile == 'tracemalloc':
+            tracemalloc.start(25)
+
+    def stop_profiling(self, top=25):
+        if self.profile == 'cprofile' and self._profiler is not None:
+            self._profiler.disable()
+            if self.profile_dir is not None:
+                self.profile_dir.mkdir(parents=True, exist_ok=True)
+                profile_path = self.profile_dir / f'{self.pipeline}_{self.run_id}.prof'
+                self._profiler.dump_stats(profile_path)
+                print(f'INFO: Saved cProfile stats to {profile_path}')
+            out = io.StringIO()
+            pstats.Stats(self._profiler, stream=out).sort_stats('cumulative').print_stats(top)
+            print(out.getvalue())
+            self._profiler = None
+        elif self.profile == 'tracemalloc' and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            self.counters.update(tracemalloc_current_bytes=current, tracemalloc_peak_bytes=peak)
+            print(f'INFO: tracemalloc: {current / 1024 ** 2:.1f} MiB allocated at exit, {peak / 1024 ** 2:.1f} MiB peak. Top allocations:')
+            for stat in tracemalloc.take_snapshot().statistics('lineno')[:top]:
+                print(f'  {stat}')
+            tracemalloc.stop()
+
+    def finish(self, status='succeeded', error=None):
+        if self.finished_at is None:
+            self.finished_at = dt.datetime.now(dt.timezone.utc)
+            self.status, self.error = status, error
+
+    # Insert the run and its stage metrics in one transaction
+    def write(self, conn):
+        with conn.transaction():
+            with conn.cursor() as cur:
+                cur.execute(sql.SQL("""
+                                    INSERT INTO {} (run_id, pipeline, started_at, finished_at, status, error, hostname, args, counters)
+                                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                                    """).format(sql.Identifier(*METRICS_TABLES['runs'])),
+                            (self.run_id, self.pipeline, self.started_at, self.finished_at, self.status, self.error, socket.gethostname(),
+                             psycopg_json.Jsonb(self.args), psycopg_json.Jsonb(self.counters)))
+                with self._lock:
+                    rows = [(self.run_id, stage, report, entry['spans'], entry['total_seconds'], entry['max_seconds'],
+                             *(entry['counters'].get(col, 0) for col in STAGE_METRIC_COLUMNS),
+                             psycopg_json.Jsonb({k: v for k, v in entry['counters'].items() if k not in STAGE_METRIC_COLUMNS}))
+                            for (stage, report), entry in self._stages.items()]
+                cur.executemany(sql.SQL("""
+                                        INSERT INTO {} (run_id, stage, report_name, spans, total_seconds, max_seconds,
+                                                        rows, bytes, api_calls, retries, errors, counters)
+                                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                                        """).format(sql.Identifier(*METRICS_TABLES['stages'])), rows)
+
+    # End the run: stop profiling, log and (if conn_str is given) persist its metrics. Metrics are best effort, so failing to
+    # write them only prints a warning. Safe to call more than once.
+    def close(self, conn_str=None):
+        if self._closed:
+            return
+        self._closed = True
+        self.finish()
+        self.stop_profiling()
+        self.log('run_end', status=self.status, error=self.error, seconds=(self.finished_at - self.started_at).total_seconds(),
+                 stages=self.summary())
+        if conn_str is not None:
+            try:
+                with psycopg.connect(conn_str) as conn:
+                    self.write(conn)
+                print(f'INFO: Recorded run {self.run_id} ({self.status}) in ingestion_meta.pipeline_runs')
+            except Exception as e:
+                print(f'WARNING: Could not record run metrics for {self.pipeline}. Error: {e}')
+        if self._log is not None and self._log is not sys.stdout:
+            self._log.close()
+
+
+# Instrumentation flags shared by the ingestion scripts (read by start_run_metrics)
+def add_instrumentation_args(parser):
+    parser.add_argument('--profile', choices=PROFILERS,
+                        help='Profile the run: cprofile (main thread, stats saved under .cache/profiles) or tracemalloc (allocations).')
+    parser.add_argument('--log-json', metavar='PATH',
+                        help="Append structured JSON logs (one line per stage span and run event) to PATH, or '-' for stdout.")
+    parser.add_argument('--no-run-metrics', action='store_true',
+                        help='Do not record this run in ingestion_meta.pipeline_runs / stage_metrics.')
+
+
+# Start collecting metrics for this script run. They are written when the interpreter exits, whether the run succeeded or
+# raised: an uncaught exception marks the run as failed before the exit handler persists it.
+def start_run_metrics(pipeline, args, conn_str, profile_dir=None):
+    metrics = RunMetrics(pipeline, args=json.loads(json.dumps(vars(args), default=str)), log_path=args.log_json, profile=args.profile,
+                         profile_dir=profile_dir)
+
+    previous_excepthook = sys.excepthook
+    def excepthook(exc_type, exc, tb):
+        metrics.finish('failed', error=f'{exc_type.__name__}: {exc}')
+        previous_excepthook(exc_type, exc, tb)
+    sys.excepthook = excepthook
+
+    atexit.register(metrics.close, None if args.no_run_metrics else conn_str)
+    metrics.start_profiling()
+    return metrics
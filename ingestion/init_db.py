@@ -1,43 +1,95 @@
 """
 Resets the database and re-initializes:
 - All schemas (raw schema per source, development, and production)
-- Ingestion-related tables (others are materialized with dbt later in the pipeline)
+- Ingestion-related tables, including the load manifest and run metrics (others are materialized with dbt later in the pipeline)
+- Raw tables are built from s3_schema.json: typed columns (wh_col_types), range partitioned by year on the load metadata column
+  (wh_partition_col, plus a DEFAULT partition for anything outside the created years) and indexed on their dedup keys (wh_indexes)
+- Sources without a wh_partition_col (the video bridge, raw_youtube.videos_bridge) get a plain table
 """
 import os
+import datetime as dt
 from pathlib import Path
 import psycopg
+from psycopg import sql
 from dotenv import load_dotenv
+import ingestion_utils
 
-def main():
+
+# DDL statements for one report's raw table: the partitioned parent, one partition per year from the source's
+# wh_partition_start_year through last_year, a DEFAULT partition, the report's indexes and a table comment.
+# Sources without a wh_partition_col get a plain (unpartitioned) table.
+def build_raw_table_ddl(source_obj, report_obj, last_year):
+    schema_name, table_name = source_obj['target_wh_schema'], report_obj['target_wh_table']
+    table = sql.Identifier(schema_name, table_name)
+    partition_col = source_obj.get('wh_partition_col')
+    col_types = {**{col: report_obj['wh_col_types'][col] for col in report_obj['cols']}, **source_obj['wh_metadata_cols']}
+    col_defs = sql.SQL(', ').join(sql.SQL('{} {}').format(sql.Identifier(col), sql.SQL(col_type)) for col, col_type in col_types.items())
+
+    if partition_col is None:
+        statements = [sql.SQL("CREATE TABLE IF NOT EXISTS {} ({})").format(table, col_defs)]
+    else:
+        statements = [sql.SQL("CREATE TABLE IF NOT EXISTS {} ({}) PARTITION BY RANGE ({})").format(
+            table, col_defs, sql.Identifier(partition_col))]
+
+        # Year bounds are given in UTC for timestamptz partition keys
+        bound_suffix = ' 00:00:00+00' if col_types[partition_col].startswith('timestamptz') else ''
+        for year in range(source_obj['wh_partition_start_year'], last_year + 1):
+            statements.append(sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES FROM ({}) TO ({})").format(
+                sql.Identifier(schema_name, f'{table_name}_{year}'), table,
+                sql.Literal(f'{year}-01-01{bound_suffix}'), sql.Literal(f'{year + 1}-01-01{bound_suffix}')))
+        statements.append(sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} DEFAULT").format(
+            sql.Identifier(schema_name, f'{table_name}_default'), table))
+
+    # Indexes created on the parent are created on (and attached from) every partition
+    for i, index in enumerate(report_obj.get('wh_indexes', [])):
+        opclass = sql.SQL(f' {index["opclass"]}') if 'opclass' in index else sql.SQL('')
+        statements.append(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} USING {} ({})").format(
+            sql.Identifier(f'{table_name}_{index["method"]}_{i}_idx'), table, sql.SQL(index['method']),
+            sql.SQL(', ').join(sql.SQL('{}{}').format(sql.Identifier(col), opclass) for col in index['cols'])))
+
+    if 'description' in report_obj:
+        statements.append(sql.SQL("COMMENT ON TABLE {} IS {}").format(table, sql.Literal(report_obj['description'])))
+    return statements
+
+
+# Standalone runs load the s3 schema themselves; callers may pass in the one they already loaded
+def main(schema=None):
     # Load environment variables and build connection string for DB connection
     env_dir = Path(__file__).parent.parent
     load_dotenv(env_dir / '.env')
 
-    host, port = os.environ.get("PGHOST"), os.environ.get("PGPORT")
-    dbname, user, password = os.environ.get("PGDATABASE"), os.environ.get("PGUSER"), os.environ.get("PGPASSWORD")
-    conn_str = f"host={host} port={port} dbname={dbname} user={user} password={password}"
+    conn_str = ingestion_utils.get_conn_str()
 
-    # Load DDL SQL (/sql) into memory
+    # Load DDL SQL (/sql) and the s3 schema (raw table definitions) into memory
     sql_dir = Path(__file__).parent / 'sql'
 
+    if schema is None:
+        schema = ingestion_utils.load_s3_schema()
+
     with open(os.path.join(sql_dir, 'reset_db.sql'), 'r') as f:
         query_reset_db = f.read()
 
     with open(os.path.join(sql_dir, 'init_schemas.sql'), 'r') as f:
         query_init_schemas = f.read()
 
-    with open(os.path.join(sql_dir, 'init_src_amazon.sql'), 'r') as f:
-        query_init_src_amazon = f.read()
+    with open(os.path.join(sql_dir, 'init_load_manifest.sql'), 'r') as f:
+        query_init_load_manifest = f.read()
 
-    with open(os.path.join(sql_dir, 'init_src_youtube.sql'), 'r') as f:
-        query_init_src_youtube = f.read()
+    with open(os.path.join(sql_dir, 'init_run_metrics.sql'), 'r') as f:
+        query_init_run_metrics = f.read()
 
     # Open Postgres connection and perform DDL.
     with psycopg.connect(conninfo=conn_str) as conn:
         conn.execute(query_reset_db)
         conn.execute(query_init_schemas)
-        conn.execute(query_init_src_amazon)
-        conn.execute(query_init_src_youtube)
+        # Partitions are created through next year; later rows land in each table's DEFAULT partition until init_db is rerun
+        last_year = dt.date.today().year + 1
+        for source_obj in schema['sources']:
+            for report_obj in source_obj['reports']:
+                for statement in build_raw_table_ddl(source_obj, report_obj, last_year):
+                    conn.execute(statement)
+        conn.execute(query_init_load_manifest)
+        conn.execute(query_init_run_metrics)
 
         # Fetch schemas and tables that were added
         with conn.cursor() as cur:
@@ -50,22 +102,32 @@ def main():
             cur.execute("""
                         SELECT t.table_name
                         FROM information_schema.tables AS t
-                        WHERE t.table_schema = 'raw_amazon'
+                        JOIN pg_class AS c ON c.relname = t.table_name AND c.relnamespace = t.table_schema::regnamespace
+                        WHERE t.table_schema = 'raw_amazon' AND NOT c.relispartition
                         """)
             tables_amz = [s[0] for s in cur.fetchall()]
 
             cur.execute("""
-                        SELECT table_name
+                        SELECT t.table_name
                         FROM information_schema.tables AS t
-                        WHERE t.table_schema = 'raw_youtube'
+                        JOIN pg_class AS c ON c.relname = t.table_name AND c.relnamespace = t.table_schema::regnamespace
+                        WHERE t.table_schema = 'raw_youtube' AND NOT c.relispartition
                         """)
             tables_yt = [s[0] for s in cur.fetchall()]
 
+            cur.execute("""
+                        SELECT table_name
+                        FROM information_schema.tables AS t
+                        WHERE t.table_schema = 'ingestion_meta'
+                        """)
+            tables_meta = [s[0] for s in cur.fetchall()]
+
     # Ensure DDL was executed successfully
-    new_schemas = [s for s in schemas if s in ['raw_amazon', 'raw_youtube', 'dev', 'prod_marts']]
+    new_schemas = [s for s in schemas if s in ['raw_amazon', 'raw_youtube', 'ingestion_meta', 'dev', 'prod_marts']]
     print(f'Successfully created schemas: {new_schemas}')
     print(f'Successfully created raw_amazon tables: {tables_amz}')
     print(f'Successfully created raw_youtube tables: {tables_yt}')
+    print(f'Successfully created ingestion_meta tables: {tables_meta}')
 
 
 if __name__ == '__main__':
@@ -1,76 +1,264 @@
 """
 Land youtube channel performance data received via the YouTube Analytics API in S3.
-- Make GET requests to YouTube's API (day x video grain)
-- Append daily totals for each video into one dataset using pandas
-- Store as .parquet file in S3 so we can idempotently load into our warehouse
+- Make GET requests to YouTube's API (day x video grain), packing many video IDs into each request where possible
+- Append daily totals for each video into Arrow record batches typed from s3_schema.json
+- Stream row groups into a .parquet file in S3 (multipart upload) so we can idempotently load into our warehouse
+- By default, only request the trailing days YouTube may still revise (per-video watermarks kept in S3)
+- Serve settled days from an on-disk response cache so reruns, retries and backfills barely touch the API
+- Only land (video, day) partitions whose contents changed since they were last landed (partition fingerprints kept in S3)
+- Time each stage (requests, parquet encoding, uploads, state) and record the run in ingestion_meta (see ingestion_utils.RunMetrics)
+- main() can also be called by run_pipeline.py, which passes in its shared s3 schema, S3 client and run metrics
+- Start fast: heavy dependencies are imported on first use, and the API client and access token come from local caches (see api_client.py)
 """
 
 from pathlib import Path
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import argparse
+import csv
+import threading
 import time
-import random
-import io
 import datetime as dt
-import pandas as pd
 from dotenv import load_dotenv
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-import boto3
 import ingestion_utils
+import api_client
+import fingerprint
+from response_cache import ResponseCache
 
+pd = ingestion_utils.lazy_import('pandas')
+pa = ingestion_utils.lazy_import('pyarrow')
+pq = ingestion_utils.lazy_import('pyarrow.parquet')
+boto3 = ingestion_utils.lazy_import('boto3')
+httplib2 = ingestion_utils.lazy_import('httplib2')
+google_auth_httplib2 = ingestion_utils.lazy_import('google_auth_httplib2')
+googleapiclient_errors = ingestion_utils.lazy_import('googleapiclient.errors')
 
-# Decorator for API request retries
+
+# httplib2 is not thread-safe, so each worker thread executes requests over its own authorized transport
+_thread_local = threading.local()
+
+def get_thread_http():
+    if not hasattr(_thread_local, 'http'):
+        _thread_local.http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http())
+    return _thread_local.http
+
+
+# Decorator for API request retries. Settings are read at call time from the module-level objects set by configure_api:
+# errors are classified (quota/bad request errors are not retried), backoff is exponential with jitter and honours Retry-After,
+# and every attempt takes a token from the rate limiter shared by all worker threads.
 def api_retry_decorator(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
-        for i in range(1, NUM_RETRIES + 1):
-            try:
-                result = func(*args, **kwargs)
-                break
-            except Exception as e:
-                if i < NUM_RETRIES:
-                    print(f'ERROR: {func.__name__} failed with arguments {args}, {kwargs} on attempt {i}. Waiting {SLEEP_TIME * i} seconds before retry. \nError: {e}')
-                    time.sleep(SLEEP_TIME * i)
-                else:
-                    print(f'ERROR: All attempts to run {func.__name__} have failed.')
-                    raise e
-        return result
+        return ingestion_utils.call_with_retry(func, args, kwargs,
+                                               num_retries=NUM_RETRIES,
+                                               base_sleep=SLEEP_TIME,
+                                               max_sleep=MAX_SLEEP_TIME,
+                                               limiter=rate_limiter,
+                                               stats=api_stats)
     return wrapper
 
 
-# Make an API request to the YouTube API for a daily view of various performance metrics for a specific video. with retry logic
+# Set the module-level API client, credentials, retry settings, rate limiter, call stats and response cache used by the request
+# functions below (by main(), backfill worker processes and the benchmarks).
+def configure_api(client, credentials, num_retries, sleep_time, max_sleep_time, limiter, stats, cache=None):
+    global yt_analytics, creds, NUM_RETRIES, SLEEP_TIME, MAX_SLEEP_TIME, rate_limiter, api_stats, response_cache
+    yt_analytics, creds = client, credentials
+    NUM_RETRIES, SLEEP_TIME, MAX_SLEEP_TIME = num_retries, sleep_time, max_sleep_time
+    rate_limiter, api_stats, response_cache = limiter, stats, cache
+    _batching_rejected.clear()
+
+
+# OAuth scopes the authorized user file was issued for (see generate_oauth_creds.py)
+OAUTH_SCOPES = ["https://www.googleapis.com/auth/yt-analytics.readonly",
+                "https://www.googleapis.com/auth/yt-analytics-monetary.readonly"]
+
+# Metrics and dimensions requested for each report landed in S3
+YT_REPORT_SPECS = {
+    'report-timebased': {
+        'metrics': 'engagedViews,views,comments,likes,dislikes,shares,estimatedMinutesWatched,subscribersGained,subscribersLost,estimatedRevenue',
+        'dimensions': 'day'
+    },
+    'report-devicetype': {
+        'metrics': 'engagedViews,views,estimatedMinutesWatched',
+        'dimensions': 'day,deviceType'
+    }
+}
+
+
+# Maximum rows returned per report query. A batched query (videos x days, times device types) can return more, so the remaining
+# rows are requested page by page with startIndex.
+API_MAX_RESULTS = 10_000
+
+# Request one page of a report (start_index is 1-based)
 @api_retry_decorator
-def make_timebased_yt_request(video_id, start_date, end_date):
+def query_yt_report_page(report_spec, dimensions, video_filter, start_date, end_date, start_index):
     result = yt_analytics.reports().query(
     ids='channel==MINE',
     startDate=start_date,
     endDate=end_date,
-    metrics='engagedViews,views,comments,likes,dislikes,shares,estimatedMinutesWatched,subscribersGained,subscribersLost,estimatedRevenue',
-    dimensions='day',
+    metrics=report_spec['metrics'],
+    dimensions=dimensions,
     sort='day',
-    filters=f'video=={video_id}'
-    ).execute()
+    filters=f'video=={video_filter}',
+    startIndex=start_index,
+    maxResults=API_MAX_RESULTS
+    ).execute(http=get_thread_http())
+    return result
+
+
+# Query a report for one video, or for a list of videos at once. A list is packed into one comma-separated video filter
+# and the video dimension is added so rows can be split back out per video (see split_batched_response).
+# Full pages are followed by requests for the next page, and all rows are returned as a single response.
+def query_yt_report(report_spec, video_id, start_date, end_date):
+    dimensions = report_spec['dimensions']
+    if isinstance(video_id, (list, tuple)):
+        dimensions = f'{dimensions},video'
+        video_id = ','.join(video_id)
+
+    result = query_yt_report_page(report_spec, dimensions, video_id, start_date, end_date, start_index=1)
+    page = result
+    while len(page.get('rows', [])) == API_MAX_RESULTS:
+        page = query_yt_report_page(report_spec, dimensions, video_id, start_date, end_date, start_index=len(result['rows']) + 1)
+        result['rows'] = result['rows'] + page.get('rows', [])
     return result
 
 
+# Make an API request to the YouTube API for a daily view of various performance metrics for a specific video (or list of videos). with retry logic
+def make_timebased_yt_request(video_id, start_date, end_date):
+    return query_yt_report(YT_REPORT_SPECS['report-timebased'], video_id, start_date, end_date)
+
+
 # Make an API request to the YouTube API for a daily view of viewership metrics by day and viewer's device type
-@api_retry_decorator
 def make_devicetype_yt_request(video_id, start_date, end_date):
-    result = yt_analytics.reports().query(
-    ids='channel==MINE',
-    startDate=start_date,
-    endDate=end_date,
-    metrics='engagedViews,views,estimatedMinutesWatched',
-    dimensions='day,deviceType',
-    sort='day',
-    filters=f'video=={video_id}'
-    ).execute()
-    return result
+    return query_yt_report(YT_REPORT_SPECS['report-devicetype'], video_id, start_date, end_date)
+
+
+# Split a multi-video response into one single-video response per ID (same shape as a per-video request), in video_ids order.
+# Rows for IDs that were not requested are dropped with a warning rather than failing the whole batch.
+def split_batched_response(result, video_ids):
+    headers = result['columnHeaders']
+    video_idx = next(i for i, entry in enumerate(headers) if entry['name'] == 'video')
+    split_headers = [entry for i, entry in enumerate(headers) if i != video_idx]
+
+    rows_by_video = {video_id: [] for video_id in video_ids}
+    unknown_ids = set()
+    for row in result.get('rows', []):
+        if row[video_idx] not in rows_by_video:
+            unknown_ids.add(row[video_idx])
+            continue
+        rows_by_video[row[video_idx]].append([val for i, val in enumerate(row) if i != video_idx])
+    if unknown_ids:
+        print(f'WARNING: Skipped rows for video IDs that were not requested: {sorted(unknown_ids)}')
+
+    return [{'columnHeaders': split_headers, 'rows': rows_by_video[video_id]} for video_id in video_ids]
+
+
+# Report functions whose batched queries have been rejected this run; skip straight to per-video requests for these
+_batching_rejected = set()
+
+# Fetch a report for a chunk of video IDs with as few API calls as possible and return one response per video, in video_ids order.
+# If YouTube rejects the batched query (HTTP 400), fall back to one request per video.
+def fetch_report_batch(get_report_func, video_ids, start_date, end_date):
+    if len(video_ids) > 1 and get_report_func not in _batching_rejected:
+        try:
+            result = get_report_func(list(video_ids), start_date, end_date)
+            return split_batched_response(result, video_ids)
+        except googleapiclient_errors.HttpError as e:
+            if ingestion_utils.get_error_status(e) != 400:
+                raise e
+            _batching_rejected.add(get_report_func)
+            print(f'WARNING: Batched {get_report_func.__name__} request was rejected. Falling back to per-video requests. \nError: {e}')
+
+    return [get_report_func(video_id, start_date, end_date) for video_id in video_ids]
+
+
+# Report name for each report function, used to key cached responses
+REPORT_NAMES = {make_timebased_yt_request: 'report-timebased',
+                make_devicetype_yt_request: 'report-devicetype'}
+
+def response_cache_key(get_report_func, video_id):
+    report_name = REPORT_NAMES[get_report_func]
+    report_spec = YT_REPORT_SPECS[report_name]
+    return [video_id, report_name, report_spec['metrics'], report_spec['dimensions']]
+
+
+# Shift a YYYY-MM-DD day string by a number of days
+def shift_day(day, days):
+    return (dt.date.fromisoformat(day) + dt.timedelta(days=days)).strftime("%Y-%m-%d")
+
+
+# Keep only the rows of a response whose day falls within [start_date, end_date] (ISO day strings compare chronologically)
+def filter_response_days(result, start_date, end_date):
+    day_idx = next(i for i, entry in enumerate(result['columnHeaders']) if entry['name'] == 'day')
+    return {'columnHeaders': result['columnHeaders'],
+            'rows': [row for row in result.get('rows', []) if start_date <= row[day_idx] <= end_date]}
+
+
+# Return one response per video for a chunk of video IDs, serving settled days from response_cache where possible.
+# If every video in the chunk has a cache entry covering start_date, only the days after the cached range (the open tail) are
+# requested from the API. Settled days from any API response are written back so later runs, retries and backfills can reuse them.
+# Neither cached nor written back rows ever extend past end_date, so windows ending in the past (e.g. backfill shards) stay exact.
+def request_report_batch(get_report_func, video_ids, start_date, end_date):
+    if response_cache is None:
+        return fetch_report_batch(get_report_func, video_ids, start_date, end_date)
+
+    settled_through = min(response_cache.settled_through(), end_date)
+    keys = [response_cache_key(get_report_func, video_id) for video_id in video_ids]
+    entries = [response_cache.get(key) for key in keys]
+    if all(entry is not None and entry['start_date'] <= start_date for entry in entries):
+        fetch_start = max(start_date, shift_day(min(entry['settled_through'] for entry in entries), 1))
+    else:
+        entries = [None] * len(video_ids)
+        fetch_start = start_date
+
+    fetched = [None] * len(video_ids)
+    if fetch_start <= end_date:
+        fetched = fetch_report_batch(get_report_func, video_ids, fetch_start, end_date)
+
+    results = []
+    for key, entry, fetched_result in zip(keys, entries, fetched):
+        # Combine cached days before fetch_start with freshly requested days
+        if entry is None:
+            result = fetched_result
+        else:
+            result = filter_response_days(entry, start_date, min(end_date, shift_day(fetch_start, -1)))
+            if fetched_result is not None:
+                result['rows'] = result['rows'] + fetched_result.get('rows', [])
+        results.append(result)
+
+        # Write back newly settled days. Existing entries are only extended when the fetched range is contiguous with them.
+        if entry is None:
+            if settled_through >= start_date:
+                response_cache.put(key, {'start_date': start_date,
+                                         'settled_through': settled_through,
+                                         **filter_response_days(result, start_date, settled_through)})
+        elif fetched_result is not None and settled_through > entry['settled_through'] and fetch_start <= shift_day(entry['settled_through'], 1):
+            cached_rows = filter_response_days(entry, entry['start_date'], shift_day(fetch_start, -1))['rows']
+            new_rows = filter_response_days(fetched_result, fetch_start, settled_through)['rows']
+            response_cache.put(key, {'start_date': entry['start_date'],
+                                     'settled_through': settled_through,
+                                     'columnHeaders': entry['columnHeaders'],
+                                     'rows': cached_rows + new_rows})
+
+    return results
+
+
+# Convert a single YouTube Analytics API response into a dataframe tagged with its video ID (columns sorted for a stable layout)
+def response_to_df(result, video_id):
+    col_names = []
+    for entry in result['columnHeaders']:
+        col_names.append(entry['name'])
+
+    df = pd.DataFrame(result['rows'], columns=col_names)
+    df['video_id'] = video_id
+    return df[sorted(df.columns)]
 
 
-# Loop through video IDs to request daily performance by video, then aggregate and return a dataframe object representing total performance by video and date.
-# Necessary because YouTube does not provide video x day granularity but does provide a video ID filter.
-def request_and_aggregate_report(video_ids, get_report_func, start_date, end_date=dt.date.today()):
+# Request several reports for every video ID concurrently and yield (video_id, [response per report function]) in video_ids order.
+# All reports for a chunk of batch_size videos are submitted side by side; pacing is left to the shared rate limiter rather than per-call sleeps.
+# At most 2 * max_workers chunks are in flight, so memory stays bounded no matter how many videos are requested.
+def iter_report_responses(video_ids, get_report_funcs, start_date, end_date=dt.date.today(), max_workers=1, batch_size=1):
 
     # Convert dates from datetime/date to string if needed
     if isinstance(start_date, dt.datetime) or isinstance(start_date, dt.date):
@@ -78,77 +266,331 @@ def request_and_aggregate_report(video_ids, get_report_func, start_date, end_dat
     if isinstance(end_date, dt.datetime) or isinstance(end_date, dt.date):
         end_date = end_date.strftime("%Y-%m-%d")
 
-    # Make API requests, collect results as list of dfs
-    results = []
-    for video_id in video_ids:
-        result = get_report_func(video_id, start_date, end_date)
-        time.sleep(random.random())   # Small delay between requests
-
-        col_names = []
-        for entry in result['columnHeaders']:
-            col_names.append(entry['name'])
-        
-        df = pd.DataFrame(result['rows'], columns=col_names)
-        df['video_id'] = video_id
-        df = df[sorted(df.columns)]
-        results.append(df)
+    batches = deque(video_ids[i:i + batch_size] for i in range(0, len(video_ids), batch_size))
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while batches or in_flight:
+            while batches and len(in_flight) < 2 * max_workers:
+                batch = batches.popleft()
+                in_flight.append((batch, [executor.submit(request_report_batch, func, batch, start_date, end_date)
+                                          for func in get_report_funcs]))
+
+            batch, batch_futures = in_flight.popleft()
+            batch_results = [future.result() for future in batch_futures]
+            for j, video_id in enumerate(batch):
+                yield video_id, [report_results[j] for report_results in batch_results]
+
+
+# Request several reports for every video ID concurrently, then aggregate and return one dataframe per report function (same order as get_report_funcs).
+# Results are collected in video_ids order regardless of completion order, so the output is deterministic.
+def request_and_aggregate_reports(video_ids, get_report_funcs, start_date, end_date=dt.date.today(), max_workers=1, batch_size=1):
+    results = [[] for _ in get_report_funcs]
+    for video_id, video_results in iter_report_responses(video_ids, get_report_funcs, start_date, end_date, max_workers, batch_size):
+        for i, result in enumerate(video_results):
+            results[i].append(response_to_df(result, video_id))
 
     # Join DFs together
-    df_combined = pd.concat(results, ignore_index=True)
-    return df_combined
+    return [pd.concat(report_results, ignore_index=True) for report_results in results]
 
 
-if __name__ == '__main__':
-    
+# Request daily performance by video, then aggregate and return a dataframe object representing total performance by video and date.
+# Videos are requested batch_size at a time (video x day rows split back out per video), or one at a time with batch_size=1.
+def request_and_aggregate_report(video_ids, get_report_func, start_date, end_date=dt.date.today(), max_workers=1, batch_size=1):
+    return request_and_aggregate_reports(video_ids, [get_report_func], start_date, end_date, max_workers, batch_size)[0]
+
+
+# Arrow schema for a report, typed from its cols and col_types in s3_schema.json (columns in the order listed there)
+def build_arrow_schema(report_obj):
+    return pa.schema([(col, pa.type_for_alias(report_obj['col_types'][col])) for col in report_obj['cols']])
+
+
+# Assemble API responses column by column into Arrow record batches and write each full row group straight to a ParquetWriter,
+# so memory is bounded by one row group rather than by the whole report.
+# With partition fingerprints, a video's rows for a day are dropped if they are identical to what was last landed for that day.
+class ReportParquetWriter:
+    def __init__(self, sink, schema, row_group_size=100_000, compression='snappy', use_dictionary=True, fingerprints=None):
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self.fingerprints = fingerprints
+        self.rows_written = 0
+        self.rows_unchanged = 0
+        self.seconds = 0.0
+        self._writer = pq.ParquetWriter(sink, schema, compression=compression, use_dictionary=use_dictionary)
+        self._columns = {name: [] for name in schema.names}
+        self._pending_rows = 0
+
+    # Append the rows of one single-video API response, tagged with its video ID
+    def append_response(self, result, video_id):
+        rows = result.get('rows', [])
+        if not rows:
+            return
+        headers = [entry['name'] for entry in result['columnHeaders']]
+        unexpected = set(headers) - set(self.schema.names)
+        if unexpected:
+            raise ValueError(f'Received unexpected columns {unexpected} for video {video_id}. Update s3_schema.json before landing.')
+
+        if self.fingerprints is not None:
+            rows = self._changed_rows(rows, headers.index('day'), video_id)
+            if not rows:
+                return
+
+        for i, name in enumerate(headers):
+            self._columns[name].extend(row[i] for row in rows)
+        self._columns['video_id'].extend([video_id] * len(rows))
+        self._pending_rows += len(rows)
+
+        if self._pending_rows >= self.row_group_size:
+            self._flush()
+
+    # Keep only the rows of days whose partition fingerprint differs from the last landed one
+    def _changed_rows(self, rows, day_index, video_id):
+        rows_by_day = {}
+        for row in rows:
+            rows_by_day.setdefault(row[day_index], []).append(row)
+
+        changed_rows = []
+        for day, day_rows in rows_by_day.items():
+            if self.fingerprints.is_unchanged(f'{video_id}|{day}', day_rows):
+                self.rows_unchanged += len(day_rows)
+            else:
+                changed_rows.extend(day_rows)
+        return changed_rows
+
+    # Encode the pending rows as one row group. Time spent building and encoding batches is tracked in self.seconds.
+    def _flush(self):
+        if not self._pending_rows:
+            return
+        started_at = time.perf_counter()
+        batch = pa.record_batch([pa.array(self._columns[field.name], type=field.type) for field in self.schema], schema=self.schema)
+        self._writer.write_batch(batch, row_group_size=self.row_group_size)
+        self.rows_written += self._pending_rows
+        self._columns = {name: [] for name in self.schema.names}
+        self._pending_rows = 0
+        self.seconds += time.perf_counter() - started_at
+
+    def close(self):
+        self._flush()
+        started_at = time.perf_counter()
+        self._writer.close()
+        self.seconds += time.perf_counter() - started_at
+
+
+# Unique YouTube IDs from the video bridge seed file, in file order. Read with csv rather than pandas, which landing otherwise never needs.
+def read_video_ids(path):
+    with open(path, 'r', newline='', encoding='utf-8-sig') as f:
+        return list(dict.fromkeys(row['youtube_id'] for row in csv.DictReader(f) if row['youtube_id']))
+
+
+# Read per-report, per-video high-water marks ({report_name: {video_id: last requested day}}) from the S3 state object.
+# Returns an empty dict if no incremental run has completed yet.
+def read_watermarks(s3, bucket, key):
+    return ingestion_utils.read_s3_json(s3, bucket, key, default={})
+
+
+# Persist high-water marks to the S3 state object. Only called once a run's files have been landed.
+def write_watermarks(s3, bucket, key, watermarks):
+    ingestion_utils.write_s3_json(s3, bucket, key, watermarks, indent=4)
+
+
+# Group video IDs by the first day that must be requested for them, so each group can be requested over a single date range.
+# Videos without a watermark (e.g. newly added to YT_Videos_Bridge.csv) start from default_start; others re-request their last
+# lookback_days to pick up YouTube's revisions. A video's start is the earliest across reports so both reports share one window.
+def plan_incremental_windows(video_ids, watermarks, report_names, default_start, lookback_days):
+    default_start = dt.date.fromisoformat(default_start)
+    windows = {}
+    for video_id in video_ids:
+        starts = []
+        for report_name in report_names:
+            watermark = watermarks.get(report_name, {}).get(video_id)
+            if watermark is None:
+                starts.append(default_start)
+            else:
+                starts.append(max(default_start, dt.date.fromisoformat(watermark) - dt.timedelta(days=lookback_days)))
+        windows.setdefault(min(starts), []).append(video_id)
+
+    return dict(sorted(windows.items()))
+
+
+# Land both reports for every video. Standalone runs parse argv and create their own S3 client and run metrics; run_pipeline.py
+# passes in the s3 schema, S3 client and run metrics it shares between stages. Returns {report_name: landed S3 key, or None}.
+def main(argv=None, schema=None, s3=None, metrics=None):
+
     # Constants
     ROOT = Path(__file__).parent.parent
     CREDS_PATH = ROOT / 'auth' / 'authorized_user.json'
     NUM_RETRIES = 3
     SLEEP_TIME = 2
+    MAX_SLEEP_TIME = 60
+    MAX_WORKERS = 8
+    REQUESTS_PER_SECOND = 5
+    MAX_REQUESTS_PER_SECOND = 20
+    BATCH_SIZE = 50
     YT_START_DATE = '2023-08-23'
+    LOOKBACK_DAYS = 30
+    CACHE_DIR = ROOT / '.cache' / 'yt_responses'
+    CACHE_MAX_BYTES = 512 * 1024 ** 2
+    CACHE_SETTLE_DAYS = 30
+    TOKEN_CACHE_PATH = ROOT / '.cache' / 'yt_token.json'
+    DISCOVERY_CACHE_DIR = ROOT / '.cache' / 'discovery'
+    DISCOVERY_MAX_AGE = 7 * 24 * 3600
     API_NAME = 'youtubeanalytics'
     API_VERSION = 'v2'
+    BUCKET = 'affiliate-youtube-project'
+    ROW_GROUP_SIZE = 100_000
+    PARQUET_COMPRESSION = 'snappy'
+    PARQUET_USE_DICTIONARY = ['day', 'deviceType', 'video_id']
+    S3_PART_SIZE = 8 * 1024 ** 2
+    FINGERPRINTS_NAME = 'fingerprints.json'
+    UPLOAD_WORKERS = 4
     load_dotenv(ROOT / '.env')
+
+    # Load current s3 schema which defines the columns (and types) of each report
+    if schema is None:
+        schema = ingestion_utils.load_s3_schema()
+    source_obj = next(s for s in schema['sources'] if s['source_name'] == f'{API_NAME}_{API_VERSION}')
+
+    parser = argparse.ArgumentParser(description='Land YouTube Analytics reports in S3.')
+    parser.add_argument('--full-refresh', action='store_true',
+                        help=f'Ignore stored watermarks and fingerprints; request and land every day since {YT_START_DATE}.')
+    parser.add_argument('--lookback-days', type=int, default=LOOKBACK_DAYS,
+                        help='Number of trailing days to re-request for videos that already have a watermark.')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Bypass the on-disk response cache and request every day from the API.')
+    ingestion_utils.add_instrumentation_args(parser)
+    args = parser.parse_args(argv)
+
+    # Run metrics are recorded in the warehouse when the script exits
+    if metrics is None:
+        metrics = ingestion_utils.start_run_metrics('land_youtube_s3', args, ingestion_utils.get_conn_str(),
+                                                    profile_dir=ROOT / '.cache' / 'profiles')
     
     # Get current timestamp (UTC) to identify this batch
     now = dt.datetime.now(dt.timezone.utc)
 
-    # Load creds from file
-    creds = Credentials.from_authorized_user_file(CREDS_PATH, scopes=["https://www.googleapis.com/auth/yt-analytics.readonly",
-              "https://www.googleapis.com/auth/yt-analytics-monetary.readonly"])
+    # Load creds from file, reusing the cached access token while it is valid
+    credentials = api_client.load_credentials(CREDS_PATH, OAUTH_SCOPES, TOKEN_CACHE_PATH)
 
-    # Create a YouTube Analytics API client object
-    yt_analytics = build(API_NAME, API_VERSION, credentials=creds)
+    # Create a YouTube Analytics API client object from the cached discovery document
+    client = api_client.build_client(API_NAME, API_VERSION, credentials, DISCOVERY_CACHE_DIR, DISCOVERY_MAX_AGE)
     print('INFO: Finished loading youtube analytics API client object.')
 
+    # One adaptive limiter shared by all worker threads: throughput ramps up towards the quota ceiling and backs off together when throttled.
+    # Days older than the settling period are served from (and written to) the on-disk response cache.
+    stats = ingestion_utils.CallStats()
+    configure_api(client, credentials, NUM_RETRIES, SLEEP_TIME, MAX_SLEEP_TIME,
+                  limiter=ingestion_utils.AdaptiveTokenBucket(REQUESTS_PER_SECOND, max_rate=MAX_REQUESTS_PER_SECOND),
+                  stats=stats,
+                  cache=None if args.no_cache else ResponseCache(CACHE_DIR, CACHE_MAX_BYTES, CACHE_SETTLE_DAYS))
+
     # Load unique YouTube IDs from seed file
-    video_metadata = pd.read_csv(ROOT / 'raw_data' / 'YT_Videos_Bridge.csv')
-    video_ids = list(video_metadata['youtube_id'].unique())
-
-    # Make API requests for both types of reports
-    df_timebased = request_and_aggregate_report(video_ids, make_timebased_yt_request, start_date=YT_START_DATE, end_date=now)
-    df_devicetype = request_and_aggregate_report(video_ids, make_devicetype_yt_request, start_date=YT_START_DATE, end_date=now)
-    print('INFO: Finished making API requests and aggregated results in pandas DataFrame objects.')
-
-    # Write resulting dfs to in-memory parquet files
-    buf_timebased, buf_devicetype = io.BytesIO(), io.BytesIO()
-    df_timebased.to_parquet(buf_timebased, engine='pyarrow', index=False)
-    df_devicetype.to_parquet(buf_devicetype, engine='pyarrow', index=False)
-    buf_timebased.seek(0), buf_devicetype.seek(0)
-    print('INFO: Wrote DataFrame objects into memory-based file-like objects.')
-
-    # Write these buffered IO objects to storage
-    s3 = boto3.client('s3')
-    reports_dict = {'report-timebased': buf_timebased,
-                    'report-devicetype': buf_devicetype}
-
-    for report_name, fileobj in reports_dict.items():
+    video_ids = read_video_ids(ROOT / 'raw_data' / 'YT_Videos_Bridge.csv')
+
+    # Determine which days to request for each video: all history on a full refresh, otherwise only the revisable tail
+    s3 = s3 or boto3.client('s3')
+    report_funcs = {'report-timebased': make_timebased_yt_request,
+                    'report-devicetype': make_devicetype_yt_request}
+    watermark_key = ingestion_utils.generate_s3_state_key(source=API_NAME, api_version=API_VERSION, name='watermarks.json')
+    with metrics.span('read_state'):
+        watermarks = read_watermarks(s3, BUCKET, watermark_key)
+    if args.full_refresh:
+        windows = {dt.date.fromisoformat(YT_START_DATE): video_ids}
+    else:
+        windows = plan_incremental_windows(video_ids, watermarks, list(report_funcs), YT_START_DATE, args.lookback_days)
+    print(f'INFO: Requesting {len(windows)} date window(s): {[(str(start), len(ids)) for start, ids in windows.items()]}')
+
+    # Fingerprints of the (video, day) partitions already landed; a full refresh lands every partition again
+    fingerprints_key = ingestion_utils.generate_s3_state_key(source=API_NAME, api_version=API_VERSION, name=FINGERPRINTS_NAME)
+    with metrics.span('read_state'):
+        landed_fingerprints = {} if args.full_refresh else fingerprint.read_fingerprints(s3, BUCKET, fingerprints_key)
+    fingerprints = {report_name: fingerprint.PartitionFingerprints(landed_fingerprints.get(report_name))
+                    for report_name in report_funcs}
+
+    # Open one streaming parquet writer per report. Parts are uploaded to S3 in the background while requests continue.
+    upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+    sinks, writers = {}, {}
+    for report_name in report_funcs:
+        report_obj = next(r for r in source_obj['reports'] if r['report_name'] == report_name)
         key = ingestion_utils.generate_s3_key(schema='raw',
                                             run_timestamp=now,
                                             source=API_NAME,
                                             api_version=API_VERSION,
                                             report=report_name,
                                             format='.parquet')
-        s3.upload_fileobj(fileobj, 'affiliate-youtube-project', key)
+        sinks[report_name] = ingestion_utils.S3MultipartWriter(s3, BUCKET, key, part_size=S3_PART_SIZE, executor=upload_executor)
+        writers[report_name] = ReportParquetWriter(sinks[report_name],
+                                                   build_arrow_schema(report_obj),
+                                                   row_group_size=ROW_GROUP_SIZE,
+                                                   compression=PARQUET_COMPRESSION,
+                                                   use_dictionary=PARQUET_USE_DICTIONARY,
+                                                   fingerprints=fingerprints[report_name])
 
-    print('INFO: Successfully loaded files into S3.')
\ No newline at end of file
+    # Make API requests for both types of reports, one pass per date window, appending each response to its report's writer
+    try:
+        for start_date, window_video_ids in windows.items():
+            with metrics.span('request') as span:
+                for video_id, video_results in iter_report_responses(window_video_ids,
+                                                                     list(report_funcs.values()),
+                                                                     start_date=start_date,
+                                                                     end_date=now,
+                                                                     max_workers=MAX_WORKERS,
+                                                                     batch_size=BATCH_SIZE):
+                    for report_name, result in zip(report_funcs, video_results):
+                        writers[report_name].append_response(result, video_id)
+                    span.add(videos=1)
+        print('INFO: Finished making API requests and streamed results into parquet writers.')
+        print(f'INFO: API call stats: {stats.summary()}')
+
+        # API calls are shared by both reports (one query function), so they are counted for the run as a whole
+        for func_name, func_stats in stats.summary().items():
+            metrics.record('api', seconds=func_stats['total_latency_s'], api_calls=func_stats['calls'], retries=func_stats['retries'],
+                           errors=func_stats['failures'], attempts=func_stats['attempts'])
+
+        # Finish both reports' files and complete their uploads concurrently. A report with no changed partitions lands no file.
+        def finish_report(report_name):
+            with metrics.span('upload', report_name):
+                writers[report_name].close()
+                if writers[report_name].rows_written:
+                    sinks[report_name].close()
+                else:
+                    sinks[report_name].abort()
+            metrics.record('serialise', report_name, writers[report_name].seconds, rows=writers[report_name].rows_written,
+                           bytes=sinks[report_name].bytes_written, rows_unchanged=writers[report_name].rows_unchanged)
+            return report_name, writers[report_name].rows_written, writers[report_name].rows_unchanged, sinks[report_name].bytes_written
+
+        with ThreadPoolExecutor(max_workers=len(report_funcs)) as executor:
+            for report_name, rows_written, rows_unchanged, bytes_written in executor.map(finish_report, report_funcs):
+                if rows_written:
+                    print(f'INFO: Landed {rows_written} rows ({bytes_written} bytes) for {report_name} in s3://{BUCKET}/{sinks[report_name].key}'
+                          f' ({rows_unchanged} unchanged rows skipped)')
+                else:
+                    print(f'INFO: No changed partitions for {report_name} ({rows_unchanged} unchanged rows). Nothing landed.')
+    except Exception:
+        for sink in sinks.values():
+            sink.abort()
+        raise
+    finally:
+        upload_executor.shutdown()
+
+    print('INFO: Successfully loaded files into S3.')
+
+    # Advance watermarks only now that the files have landed, so a failed run is simply retried from the old marks
+    end_day = now.strftime("%Y-%m-%d")
+    for report_name in report_funcs:
+        watermarks.setdefault(report_name, {}).update({video_id: end_day for video_id in video_ids})
+    with metrics.span('write_state'):
+        write_watermarks(s3, BUCKET, watermark_key, watermarks)
+    print(f'INFO: Updated watermarks in s3://{BUCKET}/{watermark_key}')
+
+    # Days before the earliest window requested now are never re-requested by later runs (watermarks only advance), so their
+    # fingerprints are dropped
+    fingerprints_since = min(windows).strftime("%Y-%m-%d") if windows else None
+    landed_fingerprints.update({report_name: fingerprints[report_name].current(since=fingerprints_since) for report_name in report_funcs})
+    with metrics.span('write_state'):
+        fingerprint.write_fingerprints(s3, BUCKET, fingerprints_key, landed_fingerprints)
+    print(f'INFO: Updated partition fingerprints in s3://{BUCKET}/{fingerprints_key}')
+
+    return {report_name: sinks[report_name].key if writers[report_name].rows_written else None for report_name in report_funcs}
+
+
+if __name__ == '__main__':
+    main()
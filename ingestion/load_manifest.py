@@ -0,0 +1,63 @@
+"""
+Read and write the load manifest (ingestion_meta.load_manifest, created by init_db.py).
+- One row per source file loaded into a raw table: source, report, object key/file name, run timestamp, row count, byte size, checksum
+- Rows are written with the same cursor (and therefore transaction) as the file's COPY, so the ledger never disagrees with the raw tables
+- Loaders fetch the keys already loaded for a report once (primary key index scan) and check pending files against a set
+- Checksums let loaders recognise a new file whose contents are identical to the newest file already loaded (a no-op to load)
+- Each row records how the file was loaded (load_mode), so the dbt models can tell which of a data year's rows are current
+"""
+import ingestion_utils
+
+sql = ingestion_utils.lazy_import('psycopg.sql')
+
+MANIFEST_TABLE = ('ingestion_meta', 'load_manifest')
+
+
+# Set of object keys (S3 keys or csv file names) already loaded for this source and report
+def fetch_loaded_keys(conn, source_name, report_name):
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("SELECT object_key FROM {} WHERE source_name = %s AND report_name = %s").format(sql.Identifier(*MANIFEST_TABLE)),
+                    (source_name, report_name))
+        return {row[0] for row in cur.fetchall()}
+
+
+# (run timestamp, checksum) of the newest file recorded for a report among files whose object key starts with key_prefix,
+# or (None, None). Only a file identical to this one is safe to skip: the warehouse keeps the newest run's values, so a newer file
+# matching an older run (e.g. values that were revised and then reverted) must still be loaded. Rows restored from compacted data
+# are not files of the report, so they are left out.
+def fetch_latest_checksum(conn, source_name, report_name, key_prefix=''):
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("""
+                            SELECT run_ts, checksum FROM {}
+                            WHERE source_name = %s AND report_name = %s AND starts_with(object_key, %s) AND load_mode <> 'restore'
+                            ORDER BY run_ts DESC NULLS LAST, loaded_at DESC
+                            LIMIT 1
+                            """).format(sql.Identifier(*MANIFEST_TABLE)),
+                    (source_name, report_name, key_prefix))
+        return cur.fetchone() or (None, None)
+
+
+# True if a file with this run timestamp and checksum would reload exactly what the newest loaded file (latest_ts, latest_checksum)
+# already loaded
+def is_latest_duplicate(run_ts, checksum, latest_ts, latest_checksum):
+    return latest_checksum is not None and checksum == latest_checksum and run_ts >= latest_ts
+
+
+# Record a loaded file. Call with the cursor used for the file's COPY, inside its transaction.
+# load_mode is one of: append, replace, delta, restore (rows were copied) or duplicate, superseded (recorded without rows).
+def record_load(cur, source_name, report_name, object_key, run_ts, row_count, byte_size, checksum, load_mode):
+    cur.execute(sql.SQL("""
+                        INSERT INTO {} (source_name, report_name, object_key, run_ts, row_count, byte_size, checksum, load_mode)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                        """).format(sql.Identifier(*MANIFEST_TABLE)),
+                (source_name, report_name, object_key, run_ts, row_count, byte_size, checksum, load_mode))
+
+
+# Latest run timestamp recorded for a report among files whose object key starts with key_prefix (e.g. an Amazon data year '2024-')
+def fetch_latest_run_ts(cur, source_name, report_name, key_prefix):
+    cur.execute(sql.SQL("""
+                        SELECT MAX(run_ts) FROM {}
+                        WHERE source_name = %s AND report_name = %s AND starts_with(object_key, %s)
+                        """).format(sql.Identifier(*MANIFEST_TABLE)),
+                (source_name, report_name, key_prefix))
+    return cur.fetchone()[0]
@@ -0,0 +1,71 @@
+"""
+Persistent on-disk cache for YouTube Analytics API responses.
+- Each entry holds the rows for days YouTube no longer revises ("settled" days) and the date range those rows cover
+- Only days older than the settling period are ever stored, so cached rows can be reused as-is on later runs
+- Lookups mark an entry as recently used; least recently used entries are evicted once the cache exceeds its size bound
+- Entry sizes and LRU order are kept in memory (scanned from disk once at startup), so puts don't rescan the cache directory
+"""
+import hashlib
+import json
+import os
+import threading
+import datetime as dt
+from collections import OrderedDict
+from pathlib import Path
+
+
+class ResponseCache:
+    def __init__(self, cache_dir, max_bytes, settle_days):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.settle_days = settle_days
+        self._lock = threading.Lock()
+
+        # {path: size in bytes}, least recently used first, and the running total of those sizes
+        self._index = OrderedDict()
+        for path in sorted(self.cache_dir.glob('*.json'), key=lambda p: p.stat().st_mtime):
+            self._index[path] = path.stat().st_size
+        self._total_bytes = sum(self._index.values())
+
+    # Last day (YYYY-MM-DD) treated as immutable; anything after it is still open and must be refetched
+    def settled_through(self):
+        return (dt.date.today() - dt.timedelta(days=self.settle_days)).strftime("%Y-%m-%d")
+
+    # Map a JSON-serialisable key (e.g. [video_id, report, metrics, dimensions]) to its file in the cache directory
+    def _path(self, key):
+        digest = hashlib.sha256(json.dumps(key).encode('utf8')).hexdigest()
+        return self.cache_dir / f'{digest}.json'
+
+    # Return the cached entry for this key, or None. A hit refreshes the entry's position in the LRU order.
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf8') as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        with self._lock:
+            if path in self._index:
+                self._index.move_to_end(path)
+        return entry
+
+    # Store an entry (written atomically), then evict least recently used entries until the cache fits within max_bytes
+    def put(self, key, entry):
+        path = self._path(key)
+        tmp_path = path.with_name(f'{path.stem}.{threading.get_ident()}.tmp')
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(entry, f)
+        size = tmp_path.stat().st_size
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._total_bytes += size - self._index.pop(path, 0)
+            self._index[path] = size
+            self._evict()
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and self._index:
+            path, size = self._index.popitem(last=False)
+            self._total_bytes -= size
+            path.unlink(missing_ok=True)
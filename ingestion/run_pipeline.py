@@ -0,0 +1,254 @@
+"""
+Run the daily pipeline end to end in one process, as a dependency graph of stages:
+    land_youtube -> ingest_youtube ---+
+               ingest_video_bridge ---+--> dbt_staging --> dbt_marts
+                     ingest_amazon ---+
+- A stage starts as soon as the stages it depends on have finished, so the YouTube, video bridge and Amazon branches (and the
+  reports within each stage) run concurrently and a run takes as long as its critical path
+- Stages share one .env load, one parsed s3_schema.json, one boto3 session/client and one psycopg_pool connection pool
+- A stage is skipped when its inputs have not changed since it last succeeded (input fingerprints kept in .cache/pipeline_state.json).
+  Stages downstream of a failed stage are not run. --force reruns every stage (or the stages named).
+- A load stage in which any file failed to load fails as a whole (after loading the rest), so its fingerprint is not saved and the
+  next run retries the failed files even if no other input changed
+- Each stage is timed and the run is recorded in ingestion_meta (see ingestion_utils.RunMetrics)
+"""
+
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import argparse
+import datetime as dt
+import hashlib
+import json
+import threading
+import time
+from dotenv import load_dotenv
+import ingestion_utils
+import fingerprint
+import land_youtube_s3
+import ingest_youtube
+import ingest_amazon
+import ingest_video_bridge
+
+boto3 = ingestion_utils.lazy_import('boto3')
+psycopg_pool = ingestion_utils.lazy_import('psycopg_pool')
+dbt_main = ingestion_utils.lazy_import('dbt.cli.main')
+
+
+# One node of the pipeline graph. inputs() returns a JSON-serialisable description of what the stage reads (e.g. the newest
+# landed keys); the stage is skipped when it matches the last successful run. Stages without inputs() always run.
+class Stage:
+    def __init__(self, name, run, deps=(), inputs=None):
+        self.name = name
+        self.run = run
+        self.deps = tuple(deps)
+        self.inputs = inputs
+
+
+def inputs_fingerprint(inputs):
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode('utf8')).hexdigest()
+
+
+# Last successful input fingerprint of each stage, persisted locally after every stage that succeeds
+class PipelineState:
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        try:
+            with open(self.path, 'r') as f:
+                self._fingerprints = json.load(f)
+        except FileNotFoundError:
+            self._fingerprints = {}
+
+    def get(self, stage_name):
+        with self._lock:
+            return self._fingerprints.get(stage_name)
+
+    def set(self, stage_name, stage_fingerprint):
+        with self._lock:
+            self._fingerprints[stage_name] = stage_fingerprint
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, 'w') as f:
+                json.dump(self._fingerprints, f, indent=4)
+
+
+# Run one stage unless its inputs are unchanged. Returns its status ('succeeded', 'skipped' or 'failed') and timing.
+def run_stage(stage, state, force=False, metrics=None):
+    started_at = time.perf_counter()
+    try:
+        stage_fingerprint = inputs_fingerprint(stage.inputs()) if stage.inputs is not None else None
+        if not force and stage_fingerprint is not None and state.get(stage.name) == stage_fingerprint:
+            print(f'INFO: Inputs of stage {stage.name} are unchanged since it last succeeded. Skipping.')
+            if metrics is not None:
+                metrics.record(stage.name, status='skipped')
+            return {'status': 'skipped', 'seconds': time.perf_counter() - started_at}
+
+        print(f'INFO: Starting stage {stage.name}.')
+        with ingestion_utils.metrics_span(metrics, stage.name):
+            result = stage.run()
+    except Exception as e:
+        print(f'ERROR: Stage {stage.name} failed. \nError: {e}')
+        if metrics is not None:
+            metrics.log('stage_error', stage=stage.name, error=str(e))
+        return {'status': 'failed', 'seconds': time.perf_counter() - started_at, 'error': f'{type(e).__name__}: {e}'}
+
+    if stage_fingerprint is not None:
+        state.set(stage.name, stage_fingerprint)
+    seconds = time.perf_counter() - started_at
+    print(f'INFO: Finished stage {stage.name} in {seconds:.1f}s.')
+    return {'status': 'succeeded', 'seconds': seconds, 'result': result}
+
+
+# Run every stage as soon as all of its dependencies have finished, each on its own thread. A stage whose dependency failed
+# (or was itself blocked) is marked 'blocked' and not run. Returns {stage name: result of run_stage} once every stage has finished.
+def run_graph(stages, state, force=(), metrics=None):
+    stages = {stage.name: stage for stage in stages}
+    unknown = {dep for stage in stages.values() for dep in stage.deps} - set(stages)
+    if unknown:
+        raise ValueError(f'Stages depend on unknown stages: {unknown}')
+
+    results, running = {}, {}
+    with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+        while len(results) < len(stages):
+            progressed = False
+            for name, stage in stages.items():
+                if name in results or name in running.values() or not all(dep in results for dep in stage.deps):
+                    continue
+                progressed = True
+                not_succeeded = [dep for dep in stage.deps if results[dep]['status'] in ('failed', 'blocked')]
+                if not_succeeded:
+                    results[name] = {'status': 'blocked', 'seconds': 0.0, 'error': f'Upstream stage(s) {not_succeeded} did not succeed'}
+                    print(f'WARNING: Not running stage {name}: upstream stage(s) {not_succeeded} did not succeed.')
+                    continue
+                running[executor.submit(run_stage, stage, state, name in force, metrics)] = name
+
+            if not running:
+                if not progressed:
+                    raise ValueError(f'Stages {set(stages) - set(results)} depend on each other in a cycle.')
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+
+    return results
+
+
+# Files under the dbt project that define its models (not build artefacts), as (relative path, checksum) pairs
+def dbt_project_files(dbt_dir):
+    paths = [dbt_dir / 'dbt_project.yml'] + [p for d in ('models', 'macros', 'seeds', 'snapshots') for p in (dbt_dir / d).rglob('*')
+                                             if p.is_file()]
+    return sorted((str(p.relative_to(dbt_dir)), fingerprint.file_checksum(p)) for p in paths)
+
+
+# Files loaded into the raw tables so far, per source and report (from the load manifest)
+def load_manifest_summary(pool):
+    with pool.connection() as conn:
+        return conn.execute("""
+                            SELECT source_name, report_name, COUNT(*), MAX(loaded_at)
+                            FROM ingestion_meta.load_manifest
+                            GROUP BY source_name, report_name
+                            ORDER BY source_name, report_name
+                            """).fetchall()
+
+
+if __name__ == '__main__':
+
+    # Constants
+    ROOT = Path(__file__).parent.parent
+    BUCKET = 'affiliate-youtube-project'
+    S3_SCHEMA = 'raw'
+    POOL_SIZE = 6
+    DBT_DIR = ROOT / 'dbt'
+    AMAZON_CSV_PATH = ROOT / 'raw_data' / 'amazon'
+    VIDEOS_PATH = ROOT / 'raw_data' / 'YT_Videos_Bridge.csv'
+    LISTING_INDEX_PATH = ROOT / '.cache' / 's3_listing_index.json'
+    STATE_PATH = ROOT / '.cache' / 'pipeline_state.json'
+    STAGES = ['land_youtube', 'ingest_youtube', 'ingest_video_bridge', 'ingest_amazon', 'dbt_staging', 'dbt_marts']
+    load_dotenv(ROOT / '.env')
+
+    parser = argparse.ArgumentParser(description='Run the pipeline: land -> ingest -> dbt staging, with independent sources in parallel.')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES,
+                        help='Stages to run (default: all). Stages left out are treated as succeeded by their dependents.')
+    parser.add_argument('--force', nargs='*', choices=STAGES, metavar='STAGE',
+                        help='Run these stages (or every stage, if none are named) even if their inputs are unchanged.')
+    parser.add_argument('--full-refresh', action='store_true', help='Passed to land_youtube_s3.py.')
+    parser.add_argument('--no-cache', action='store_true', help='Passed to land_youtube_s3.py.')
+    parser.add_argument('--full-listing', action='store_true', help='Passed to ingest_youtube.py.')
+    parser.add_argument('--amazon-mode', choices=ingest_amazon.LOAD_MODES, default='append', help='Passed to ingest_amazon.py as --mode.')
+    parser.add_argument('--dbt-select', default='staging', help='dbt node selection for the dbt staging stage.')
+    parser.add_argument('--dbt-marts-select', default='marts', help='dbt node selection for the dbt marts stage.')
+    parser.add_argument('--dbt-target', help='dbt target (profiles.yml) for the dbt stages. Defaults to the profile\'s default target.')
+    ingestion_utils.add_instrumentation_args(parser)
+    args = parser.parse_args()
+    force = set(STAGES) if args.force == [] else set(args.force or [])
+
+    # Shared by every stage: s3 schema, S3 client, connection pool and run metrics
+    schema = ingestion_utils.load_s3_schema()
+    conn_str = ingestion_utils.get_conn_str()
+    metrics = ingestion_utils.start_run_metrics('run_pipeline', args, conn_str, profile_dir=ROOT / '.cache' / 'profiles')
+    s3 = boto3.session.Session().client('s3')
+    yt_source = next(s for s in schema['sources'] if s['source_name'] == 'youtubeanalytics_v2')
+
+    # Inputs of each stage. Landing depends on the (UTC) day and the video list; loads on the files waiting for them;
+    # dbt on its model definitions and on what has been loaded into the raw tables (and the video bridge).
+    def land_inputs():
+        if args.full_refresh:
+            return None
+        return {'day': dt.datetime.now(dt.timezone.utc).date(), 'videos': fingerprint.file_checksum(VIDEOS_PATH), 'no_cache': args.no_cache}
+
+    # Read-only probe: the listing index is consulted (only keys after its newest are listed) but not updated; ingest_youtube.py does that
+    def ingest_youtube_inputs():
+        listing_index = ingestion_utils.S3ListingIndex(LISTING_INDEX_PATH, reset=args.full_listing)
+        newest_keys = {}
+        for report_obj in yt_source['reports']:
+            known_keys = listing_index.get(f'{S3_SCHEMA}/source={yt_source["source_name"]}/report={report_obj["report_name"]}/')
+            new_runs = ingest_youtube.retrieve_report_timestamps(BUCKET, S3_SCHEMA, yt_source['source_name'], report_obj['report_name'],
+                                                                 s3=s3, start_after=known_keys[-1] if known_keys else None)
+            newest_keys[report_obj['report_name']] = max([run['s3_key'] for run in new_runs] + known_keys[-1:], default=None)
+        return {'reports': newest_keys}
+
+    def ingest_video_bridge_inputs():
+        return {'videos': fingerprint.file_checksum(VIDEOS_PATH) if VIDEOS_PATH.exists() else None}
+
+    def ingest_amazon_inputs():
+        return {'mode': args.amazon_mode,
+                'files': sorted((p.name, p.stat().st_size, p.stat().st_mtime_ns) for p in AMAZON_CSV_PATH.glob('*.csv'))}
+
+    def dbt_inputs(select):
+        return {'select': select, 'target': args.dbt_target, 'project': dbt_project_files(DBT_DIR),
+                'loaded': load_manifest_summary(pool), 'videos': fingerprint.file_checksum(VIDEOS_PATH) if VIDEOS_PATH.exists() else None}
+
+    def run_dbt(select):
+        dbt_args = ['run', '--select', select, '--project-dir', str(DBT_DIR)]
+        if args.dbt_target:
+            dbt_args += ['--target', args.dbt_target]
+        result = dbt_main.dbtRunner().invoke(dbt_args)
+        if not result.success:
+            raise RuntimeError(f'dbt run failed: {result.exception}')
+
+    land_argv = ['--full-refresh'] * args.full_refresh + ['--no-cache'] * args.no_cache
+    with psycopg_pool.ConnectionPool(conn_str, min_size=1, max_size=POOL_SIZE) as pool:
+        stages = [Stage('land_youtube', lambda: land_youtube_s3.main(land_argv, schema=schema, s3=s3, metrics=metrics),
+                        inputs=land_inputs),
+                  Stage('ingest_youtube', lambda: ingest_youtube.main(['--full-listing'] * args.full_listing, schema=schema, s3=s3,
+                                                                      pool=pool, metrics=metrics),
+                        deps=['land_youtube'], inputs=ingest_youtube_inputs),
+                  Stage('ingest_video_bridge', lambda: ingest_video_bridge.main([], schema=schema, pool=pool, metrics=metrics),
+                        inputs=ingest_video_bridge_inputs),
+                  Stage('ingest_amazon', lambda: ingest_amazon.main(['--mode', args.amazon_mode], schema=schema, pool=pool,
+                                                                    metrics=metrics),
+                        inputs=ingest_amazon_inputs),
+                  Stage('dbt_staging', lambda: run_dbt(args.dbt_select), deps=['ingest_youtube', 'ingest_video_bridge', 'ingest_amazon'],
+                        inputs=lambda: dbt_inputs(args.dbt_select)),
+                  Stage('dbt_marts', lambda: run_dbt(args.dbt_marts_select), deps=['dbt_staging'],
+                        inputs=lambda: dbt_inputs(args.dbt_marts_select))]
+
+        # Stages left out of --stages are dropped from the graph, along with the dependencies on them
+        stages = [Stage(stage.name, stage.run, [dep for dep in stage.deps if dep in args.stages], stage.inputs)
+                  for stage in stages if stage.name in args.stages]
+        results = run_graph(stages, PipelineState(STATE_PATH), force=force, metrics=metrics)
+
+    for name, result in results.items():
+        print(f'INFO: {name}: {result["status"]} ({result["seconds"]:.1f}s)' + (f' - {result["error"]}' if 'error' in result else ''))
+    failed = [name for name, result in results.items() if result['status'] in ('failed', 'blocked')]
+    if failed:
+        raise RuntimeError(f'Pipeline stages did not succeed: {failed}')
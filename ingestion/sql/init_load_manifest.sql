@@ -0,0 +1,14 @@
+-- One row per source file loaded into a raw table, written in the same transaction as the file's COPY.
+-- Loaders check pending work against this ledger (primary key lookup) instead of scanning the raw tables.
+CREATE TABLE IF NOT EXISTS ingestion_meta.load_manifest (
+    source_name text NOT NULL, -- source_name in s3_schema.json
+    report_name text NOT NULL, -- report_name in s3_schema.json
+    object_key text NOT NULL, -- S3 object key (youtube; '<key>@<ETag>' for compacted day files) or csv file name (amazon)
+    run_ts timestamptz, -- s3_run_ts (youtube) or refresh_date (amazon)
+    row_count bigint NOT NULL,
+    byte_size bigint,
+    checksum text, -- sha256 of the file's bytes
+    load_mode text NOT NULL, -- append, replace, delta or restore (rows copied), duplicate or superseded (recorded without rows)
+    loaded_at timestamptz NOT NULL DEFAULT current_timestamp,
+    PRIMARY KEY (source_name, report_name, object_key)
+);
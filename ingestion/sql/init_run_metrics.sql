@@ -0,0 +1,31 @@
+-- One row per run of an ingestion script, written when the run ends (see ingestion_utils.RunMetrics)
+CREATE TABLE IF NOT EXISTS ingestion_meta.pipeline_runs (
+    run_id uuid PRIMARY KEY,
+    pipeline text NOT NULL, -- script name, e.g. ingest_youtube
+    started_at timestamptz NOT NULL,
+    finished_at timestamptz,
+    status text NOT NULL, -- succeeded or failed
+    error text, -- uncaught exception of a failed run
+    hostname text,
+    args jsonb, -- command line arguments
+    counters jsonb -- run-level counters (e.g. tracemalloc peak)
+);
+
+CREATE INDEX IF NOT EXISTS pipeline_runs_pipeline_started_at_idx ON ingestion_meta.pipeline_runs (pipeline, started_at);
+
+-- Timing spans and counters of a run, aggregated per stage and report
+CREATE TABLE IF NOT EXISTS ingestion_meta.stage_metrics (
+    run_id uuid NOT NULL REFERENCES ingestion_meta.pipeline_runs (run_id) ON DELETE CASCADE,
+    stage text NOT NULL, -- e.g. request, download, copy
+    report_name text NOT NULL, -- report_name in s3_schema.json, or '' for stages spanning all reports
+    spans integer NOT NULL,
+    total_seconds double precision NOT NULL, -- sum over spans; concurrent spans can add up to more than the run's wall time
+    max_seconds double precision NOT NULL,
+    rows bigint NOT NULL,
+    bytes bigint NOT NULL,
+    api_calls bigint NOT NULL,
+    retries bigint NOT NULL,
+    errors bigint NOT NULL,
+    counters jsonb, -- any other counters
+    PRIMARY KEY (run_id, stage, report_name)
+);
@@ -1,5 +1,6 @@
 -- WARNING: All database schemas, tables, and data will be dropped
 DROP SCHEMA IF EXISTS raw_amazon CASCADE;
 DROP SCHEMA IF EXISTS raw_youtube CASCADE;
+DROP SCHEMA IF EXISTS ingestion_meta CASCADE;
 DROP SCHEMA IF EXISTS dev CASCADE;
 DROP SCHEMA IF EXISTS prod_marts CASCADE;
\ No newline at end of file